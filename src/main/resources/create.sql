@@ -5,10 +5,13 @@ CREATE TABLE Caregivers (
     PRIMARY KEY (Username)
 );
 
+-- one row per free slot; Slot is the slot's start in minutes after midnight
+-- (540 = 09:00, the start of the default AvailabilityHours)
 CREATE TABLE Availabilities (
     Time date,
     Username varchar(255) REFERENCES Caregivers,
-    PRIMARY KEY (Time, Username)
+    Slot smallint NOT NULL DEFAULT 540,
+    PRIMARY KEY (Time, Slot, Username)
 );
 
 CREATE TABLE Vaccines (
@@ -24,11 +27,88 @@ CREATE TABLE Patient (
     PRIMARY KEY (Username)
 );
 
+-- appointment IDs are handed out by the server so reserve never computes max(ID)+1
+CREATE SEQUENCE AppointmentIDs AS int START WITH 1 INCREMENT BY 1 CACHE 50;
+
 CREATE TABLE Appointments (
-    ID int,
+    ID int DEFAULT (NEXT VALUE FOR AppointmentIDs),
     Time date,
     p_name varchar(255) REFERENCES Patient(Username),
     c_name varchar(255) REFERENCES Caregivers(Username),
     v_name varchar(255) REFERENCES  Vaccines(Name),
+    Slot smallint NOT NULL DEFAULT 540,
+    Lot varchar(64),
+    PRIMARY KEY (ID)
+);
+
+-- show_appointments looks appointments up by patient or caregiver in ID order;
+-- the INCLUDE columns make both lookups index-only.
+CREATE INDEX IX_Appointments_Patient ON Appointments (p_name, ID) INCLUDE (Time, Slot, c_name, v_name);
+CREATE INDEX IX_Appointments_Caregiver ON Appointments (c_name, ID) INCLUDE (Time, Slot, p_name, v_name);
+
+-- reserve's caregiver assignment counts and orders each day's appointments per caregiver
+CREATE INDEX IX_Appointments_Time ON Appointments (Time, c_name);
+
+-- Availabilities needs no extra index: its clustered primary key (Time, Slot, Username)
+-- already serves the "caregivers free on a day, by slot and username" lookups, and
+-- reserve's "earliest free slot of the day" is the first key at or after (Time).
+
+-- patients waiting for a dose and a slot on any day from FirstDay to LastDay;
+-- they are booked in ID (joining) order as capacity frees up
+CREATE TABLE Waitlist (
+    ID int IDENTITY(1, 1),
+    p_name varchar(255) REFERENCES Patient(Username),
+    v_name varchar(255) REFERENCES Vaccines(Name),
+    FirstDay date,
+    LastDay date,
+    PRIMARY KEY (ID),
+    UNIQUE (p_name, v_name)
+);
+
+-- promotion after add_doses or a cancellation walks one vaccine's waiters in order
+CREATE INDEX IX_Waitlist_Vaccine ON Waitlist (v_name, ID) INCLUDE (p_name, FirstDay, LastDay);
+
+-- doses left per delivery lot; Lot '' holds doses received without a lot number.
+-- Per vaccine these add up to Vaccines.Doses.
+CREATE TABLE DoseLots (
+    v_name varchar(255) REFERENCES Vaccines(Name),
+    Lot varchar(64),
+    Expires date,
+    Doses int,
+    PRIMARY KEY (v_name, Lot)
+);
+
+-- append-only history of every dose change (receipts, adjustments, reservations,
+-- cancellations, expiries, and the rollups compaction leaves of older entries).
+-- Per vaccine the entries add up to Vaccines.Doses, which is kept in step with
+-- them as the balance reads use.
+CREATE TABLE DoseLedger (
+    ID bigint IDENTITY(1, 1),
+    v_name varchar(255) REFERENCES Vaccines(Name),
+    Lot varchar(64),
+    Kind varchar(16),
+    Doses int,
+    AppointmentID int,
+    Recorded datetime2 DEFAULT SYSUTCDATETIME(),
     PRIMARY KEY (ID)
-);
\ No newline at end of file
+);
+
+CREATE INDEX IX_DoseLedger_Vaccine ON DoseLedger (v_name, ID);
+
+-- daily summaries for the report command, kept in step with Appointments and
+-- Availabilities by every call that changes them, so a date range is read from
+-- one row per day and vaccine or caregiver instead of the appointment history
+CREATE TABLE DailyVaccineUsage (
+    Time date,
+    v_name varchar(255) REFERENCES Vaccines(Name),
+    Appointments int NOT NULL DEFAULT 0,
+    PRIMARY KEY (Time, v_name)
+);
+
+CREATE TABLE DailyCaregiverUsage (
+    Time date,
+    c_name varchar(255) REFERENCES Caregivers(Username),
+    Appointments int NOT NULL DEFAULT 0,
+    OpenSlots int NOT NULL DEFAULT 0,
+    PRIMARY KEY (Time, c_name)
+);
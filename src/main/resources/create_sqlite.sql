@@ -0,0 +1,90 @@
+-- SQLite equivalent of create.sql, used by the embedded backend (DBBackend=sqlite).
+-- Usernames compare case-insensitively, as they do under SQL Server's default collation.
+
+CREATE TABLE IF NOT EXISTS Caregivers (
+    Username varchar(255) COLLATE NOCASE,
+    Salt BINARY(16),
+    Hash BINARY(16),
+    PRIMARY KEY (Username)
+);
+
+CREATE TABLE IF NOT EXISTS Availabilities (
+    Time date,
+    Username varchar(255) COLLATE NOCASE REFERENCES Caregivers,
+    Slot smallint NOT NULL DEFAULT 540,
+    PRIMARY KEY (Time, Slot, Username)
+);
+
+CREATE TABLE IF NOT EXISTS Vaccines (
+    Name varchar(255) COLLATE NOCASE,
+    Doses int,
+    PRIMARY KEY (Name)
+);
+
+CREATE TABLE IF NOT EXISTS Patient (
+    Username varchar(255) COLLATE NOCASE,
+    Salt BINARY(16),
+    Hash BINARY(16),
+    PRIMARY KEY (Username)
+);
+
+-- AUTOINCREMENT never reuses an ID, like the AppointmentIDs sequence
+CREATE TABLE IF NOT EXISTS Appointments (
+    ID integer PRIMARY KEY AUTOINCREMENT,
+    Time date,
+    p_name varchar(255) COLLATE NOCASE REFERENCES Patient(Username),
+    c_name varchar(255) COLLATE NOCASE REFERENCES Caregivers(Username),
+    v_name varchar(255) COLLATE NOCASE REFERENCES Vaccines(Name),
+    Slot smallint NOT NULL DEFAULT 540,
+    Lot varchar(64)
+);
+
+CREATE INDEX IF NOT EXISTS IX_Appointments_Patient ON Appointments (p_name, ID);
+CREATE INDEX IF NOT EXISTS IX_Appointments_Caregiver ON Appointments (c_name, ID);
+CREATE INDEX IF NOT EXISTS IX_Appointments_Time ON Appointments (Time, c_name);
+
+CREATE TABLE IF NOT EXISTS Waitlist (
+    ID integer PRIMARY KEY AUTOINCREMENT,
+    p_name varchar(255) COLLATE NOCASE REFERENCES Patient(Username),
+    v_name varchar(255) COLLATE NOCASE REFERENCES Vaccines(Name),
+    FirstDay date,
+    LastDay date,
+    UNIQUE (p_name, v_name)
+);
+
+CREATE INDEX IF NOT EXISTS IX_Waitlist_Vaccine ON Waitlist (v_name, ID);
+
+CREATE TABLE IF NOT EXISTS DoseLots (
+    v_name varchar(255) COLLATE NOCASE REFERENCES Vaccines(Name),
+    Lot varchar(64),
+    Expires date,
+    Doses int,
+    PRIMARY KEY (v_name, Lot)
+);
+
+CREATE TABLE IF NOT EXISTS DoseLedger (
+    ID integer PRIMARY KEY AUTOINCREMENT,
+    v_name varchar(255) COLLATE NOCASE REFERENCES Vaccines(Name),
+    Lot varchar(64),
+    Kind varchar(16),
+    Doses int,
+    AppointmentID int,
+    Recorded datetime DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS IX_DoseLedger_Vaccine ON DoseLedger (v_name, ID);
+
+CREATE TABLE IF NOT EXISTS DailyVaccineUsage (
+    Time date,
+    v_name varchar(255) COLLATE NOCASE REFERENCES Vaccines(Name),
+    Appointments int NOT NULL DEFAULT 0,
+    PRIMARY KEY (Time, v_name)
+);
+
+CREATE TABLE IF NOT EXISTS DailyCaregiverUsage (
+    Time date,
+    c_name varchar(255) COLLATE NOCASE REFERENCES Caregivers(Username),
+    Appointments int NOT NULL DEFAULT 0,
+    OpenSlots int NOT NULL DEFAULT 0,
+    PRIMARY KEY (Time, c_name)
+);
@@ -0,0 +1,27 @@
+-- Moves an existing database from client-computed max(ID)+1 appointment IDs to
+-- the AppointmentIDs sequence used by create.sql. Safe to run more than once.
+--
+-- The sequence starts after the largest ID already in Appointments, so existing
+-- rows keep their IDs and new bookings continue the numbering.
+
+SET XACT_ABORT ON;
+BEGIN TRANSACTION;
+
+-- hold the table so no old-style reserve can insert while we switch over
+DECLARE @next int = (SELECT COALESCE(MAX(ID), 0) + 1 FROM Appointments WITH (TABLOCKX, HOLDLOCK));
+
+IF NOT EXISTS (SELECT * FROM sys.sequences WHERE name = 'AppointmentIDs')
+BEGIN
+    EXEC ('CREATE SEQUENCE AppointmentIDs AS int START WITH ' + CAST(@next AS varchar(11)) + ' INCREMENT BY 1 CACHE 50;');
+END;
+
+IF NOT EXISTS (
+    SELECT * FROM sys.default_constraints
+    WHERE parent_object_id = OBJECT_ID('Appointments')
+      AND parent_column_id = COLUMNPROPERTY(OBJECT_ID('Appointments'), 'ID', 'ColumnId')
+)
+BEGIN
+    EXEC ('ALTER TABLE Appointments ADD CONSTRAINT DF_Appointments_ID DEFAULT (NEXT VALUE FOR AppointmentIDs) FOR ID;');
+END;
+
+COMMIT TRANSACTION;
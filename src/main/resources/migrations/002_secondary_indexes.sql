@@ -0,0 +1,12 @@
+-- Adds the secondary indexes from create.sql to an existing database.
+-- Safe to run more than once.
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Appointments_Patient' AND object_id = OBJECT_ID('Appointments'))
+BEGIN
+    CREATE INDEX IX_Appointments_Patient ON Appointments (p_name, ID) INCLUDE (Time, c_name, v_name);
+END;
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Appointments_Caregiver' AND object_id = OBJECT_ID('Appointments'))
+BEGIN
+    CREATE INDEX IX_Appointments_Caregiver ON Appointments (c_name, ID) INCLUDE (Time, p_name, v_name);
+END;
@@ -0,0 +1,7 @@
+-- Adds the per-day index used by reserve's caregiver assignment strategies.
+-- Safe to run more than once.
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Appointments_Time' AND object_id = OBJECT_ID('Appointments'))
+BEGIN
+    CREATE INDEX IX_Appointments_Time ON Appointments (Time, c_name);
+END;
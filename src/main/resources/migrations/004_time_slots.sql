@@ -0,0 +1,56 @@
+-- Adds time slots to an existing database: Availabilities and Appointments get
+-- a Slot column (start of the slot in minutes after midnight) and the
+-- Availabilities key becomes (Time, Slot, Username). Existing rows become one
+-- 09:00 slot, which is what a whole day was before. Safe to run more than once.
+
+SET XACT_ABORT ON;
+BEGIN TRANSACTION;
+
+IF COL_LENGTH('Availabilities', 'Slot') IS NULL
+BEGIN
+    ALTER TABLE Availabilities ADD Slot smallint NOT NULL CONSTRAINT DF_Availabilities_Slot DEFAULT 540;
+END;
+
+IF COL_LENGTH('Appointments', 'Slot') IS NULL
+BEGIN
+    ALTER TABLE Appointments ADD Slot smallint NOT NULL CONSTRAINT DF_Appointments_Slot DEFAULT 540;
+END;
+
+-- the old key was created without a name, so look it up
+DECLARE @pk sysname = (
+    SELECT name FROM sys.key_constraints
+    WHERE parent_object_id = OBJECT_ID('Availabilities') AND type = 'PK'
+);
+IF NOT EXISTS (
+    SELECT * FROM sys.index_columns ic
+    JOIN sys.indexes i ON i.object_id = ic.object_id AND i.index_id = ic.index_id
+    WHERE i.object_id = OBJECT_ID('Availabilities') AND i.is_primary_key = 1
+      AND ic.column_id = COLUMNPROPERTY(OBJECT_ID('Availabilities'), 'Slot', 'ColumnId')
+)
+BEGIN
+    EXEC ('ALTER TABLE Availabilities DROP CONSTRAINT ' + @pk + ';');
+    EXEC ('ALTER TABLE Availabilities ADD PRIMARY KEY (Time, Slot, Username);');
+END;
+
+COMMIT TRANSACTION;
+
+-- show_appointments reads Slot too, so both lookups stay index-only
+IF NOT EXISTS (
+    SELECT * FROM sys.index_columns ic
+    JOIN sys.indexes i ON i.object_id = ic.object_id AND i.index_id = ic.index_id
+    WHERE i.name = 'IX_Appointments_Patient' AND i.object_id = OBJECT_ID('Appointments')
+      AND ic.column_id = COLUMNPROPERTY(OBJECT_ID('Appointments'), 'Slot', 'ColumnId')
+)
+BEGIN
+    EXEC ('CREATE INDEX IX_Appointments_Patient ON Appointments (p_name, ID) INCLUDE (Time, Slot, c_name, v_name) WITH (DROP_EXISTING = ON);');
+END;
+
+IF NOT EXISTS (
+    SELECT * FROM sys.index_columns ic
+    JOIN sys.indexes i ON i.object_id = ic.object_id AND i.index_id = ic.index_id
+    WHERE i.name = 'IX_Appointments_Caregiver' AND i.object_id = OBJECT_ID('Appointments')
+      AND ic.column_id = COLUMNPROPERTY(OBJECT_ID('Appointments'), 'Slot', 'ColumnId')
+)
+BEGIN
+    EXEC ('CREATE INDEX IX_Appointments_Caregiver ON Appointments (c_name, ID) INCLUDE (Time, Slot, p_name, v_name) WITH (DROP_EXISTING = ON);');
+END;
@@ -0,0 +1,20 @@
+-- Adds the Waitlist table from create.sql to an existing database.
+-- Safe to run more than once.
+
+IF OBJECT_ID('Waitlist') IS NULL
+BEGIN
+    CREATE TABLE Waitlist (
+        ID int IDENTITY(1, 1),
+        p_name varchar(255) REFERENCES Patient(Username),
+        v_name varchar(255) REFERENCES Vaccines(Name),
+        FirstDay date,
+        LastDay date,
+        PRIMARY KEY (ID),
+        UNIQUE (p_name, v_name)
+    );
+END;
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Waitlist_Vaccine' AND object_id = OBJECT_ID('Waitlist'))
+BEGIN
+    CREATE INDEX IX_Waitlist_Vaccine ON Waitlist (v_name, ID) INCLUDE (p_name, FirstDay, LastDay);
+END;
@@ -0,0 +1,49 @@
+-- Adds the dose ledger and lots from create.sql to an existing database and
+-- opens them with today's stock: each vaccine's current Doses become an
+-- unlotted ('') lot and one 'opening' ledger entry. Safe to run more than once.
+
+SET XACT_ABORT ON;
+BEGIN TRANSACTION;
+
+IF OBJECT_ID('DoseLots') IS NULL
+BEGIN
+    CREATE TABLE DoseLots (
+        v_name varchar(255) REFERENCES Vaccines(Name),
+        Lot varchar(64),
+        Expires date,
+        Doses int,
+        PRIMARY KEY (v_name, Lot)
+    );
+END;
+
+IF OBJECT_ID('DoseLedger') IS NULL
+BEGIN
+    CREATE TABLE DoseLedger (
+        ID bigint IDENTITY(1, 1),
+        v_name varchar(255) REFERENCES Vaccines(Name),
+        Lot varchar(64),
+        Kind varchar(16),
+        Doses int,
+        AppointmentID int,
+        Recorded datetime2 DEFAULT SYSUTCDATETIME(),
+        PRIMARY KEY (ID)
+    );
+    CREATE INDEX IX_DoseLedger_Vaccine ON DoseLedger (v_name, ID);
+END;
+
+IF COL_LENGTH('Appointments', 'Lot') IS NULL
+BEGIN
+    ALTER TABLE Appointments ADD Lot varchar(64);
+END;
+
+-- hold Vaccines so no dose changes while the opening balances are taken
+EXEC ('
+    INSERT INTO DoseLots (v_name, Lot, Expires, Doses)
+        SELECT Name, '''', NULL, Doses FROM Vaccines v WITH (TABLOCKX, HOLDLOCK)
+        WHERE NOT EXISTS (SELECT * FROM DoseLots l WHERE l.v_name = v.Name);
+    INSERT INTO DoseLedger (v_name, Lot, Kind, Doses)
+        SELECT Name, '''', ''opening'', Doses FROM Vaccines v
+        WHERE NOT EXISTS (SELECT * FROM DoseLedger g WHERE g.v_name = v.Name);
+');
+
+COMMIT TRANSACTION;
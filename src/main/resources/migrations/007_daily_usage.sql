@@ -0,0 +1,45 @@
+-- Adds the daily summary tables from create.sql to an existing database and
+-- fills them from the appointments and availability already there. Safe to
+-- run more than once.
+
+SET XACT_ABORT ON;
+BEGIN TRANSACTION;
+
+IF OBJECT_ID('DailyVaccineUsage') IS NULL
+BEGIN
+    CREATE TABLE DailyVaccineUsage (
+        Time date,
+        v_name varchar(255) REFERENCES Vaccines(Name),
+        Appointments int NOT NULL DEFAULT 0,
+        PRIMARY KEY (Time, v_name)
+    );
+END;
+
+IF OBJECT_ID('DailyCaregiverUsage') IS NULL
+BEGIN
+    CREATE TABLE DailyCaregiverUsage (
+        Time date,
+        c_name varchar(255) REFERENCES Caregivers(Username),
+        Appointments int NOT NULL DEFAULT 0,
+        OpenSlots int NOT NULL DEFAULT 0,
+        PRIMARY KEY (Time, c_name)
+    );
+END;
+
+-- hold Appointments and Availabilities so nothing is booked or uploaded while they are summed
+EXEC ('
+    DELETE FROM DailyVaccineUsage;
+    DELETE FROM DailyCaregiverUsage;
+    INSERT INTO DailyVaccineUsage (Time, v_name, Appointments)
+        SELECT Time, v_name, COUNT(*) FROM Appointments WITH (TABLOCKX, HOLDLOCK)
+        GROUP BY Time, v_name;
+    INSERT INTO DailyCaregiverUsage (Time, c_name, Appointments, OpenSlots)
+        SELECT Time, c_name, SUM(Appointments), SUM(OpenSlots) FROM (
+            SELECT Time, c_name, 1 AS Appointments, 0 AS OpenSlots FROM Appointments
+            UNION ALL
+            SELECT Time, Username, 0, 1 FROM Availabilities WITH (TABLOCKX, HOLDLOCK)
+        ) u
+        GROUP BY Time, c_name;
+');
+
+COMMIT TRANSACTION;
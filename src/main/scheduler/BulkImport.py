@@ -0,0 +1,188 @@
+"""
+Bulk import of patients, caregivers and vaccine stock, e.g. to onboard a clinic.
+
+    python BulkImport.py accounts.csv stock.jsonl ...
+
+CSV files need a header row naming the columns type, username, password,
+vaccine and doses; JSONL files hold one object per line with the same keys.
+type is "patient" or "caregiver" (with username and password) or "vaccine"
+(with vaccine and doses). Doses are added to any stock already in the database.
+
+Accounts that already exist, appear twice or have a weak password are skipped
+and reported. Everything else is loaded in one transaction.
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+from util.Util import Util
+from util.HashService import get_hash_service
+from db.ConnectionManager import ConnectionManager, DatabaseError
+from model.Vaccine import vaccine_catalog
+from model.DoseLedger import DoseLedger
+
+
+# rows per multi-row INSERT and names per IN (...) list; SQL Server accepts at most 1000 rows
+BATCH_SIZE = 500
+
+ACCOUNT_TABLES = {"patient": "Patient", "caregiver": "Caregivers"}
+
+
+def read_records(path):
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def batches(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def existing_usernames(cursor, table, usernames):
+    # one set-based lookup per batch of names; usernames compare case-insensitively
+    found = set()
+    for batch in batches(usernames):
+        select_usernames = "SELECT Username FROM " + table + " WHERE Username IN (" + ", ".join(["%s"] * len(batch)) + ")"
+        cursor.execute(select_usernames, tuple(batch))
+        found.update(row[0].lower() for row in cursor.fetchall())
+    return found
+
+
+def insert_accounts(cursor, table, rows):
+    for batch in batches(rows):
+        add_accounts = "INSERT INTO " + table + " VALUES " + ", ".join(["(%s, %s, %s)"] * len(batch))
+        cursor.execute(add_accounts, tuple(value for row in batch for value in row))
+
+
+def add_stock(backend, cursor, stock):
+    names = list(stock)
+    cursor.execute("SELECT Name FROM Vaccines WHERE Name IN (" + ", ".join(["%s"] * len(names)) + ")", tuple(names))
+    existing = {row[0].lower() for row in cursor.fetchall()}
+    new_rows = []
+    for name in names:
+        if name.lower() in existing:
+            cursor.execute("UPDATE Vaccines SET Doses = Doses + %d WHERE Name = %s", (stock[name], name))
+        else:
+            new_rows.append((name, stock[name]))
+    for batch in batches(new_rows):
+        add_vaccines = "INSERT INTO Vaccines VALUES " + ", ".join(["(%s, %d)"] * len(batch))
+        cursor.execute(add_vaccines, tuple(value for row in batch for value in row))
+    # imported stock is unlotted
+    for name in names:
+        DoseLedger.add(backend, cursor, name, DoseLedger.UNLOTTED, None, stock[name], "receipt")
+
+
+def run_import(paths):
+    accounts = {"patient": [], "caregiver": []}
+    stock = {}
+    skipped = []
+
+    started = time.perf_counter()
+    seen = {"patient": set(), "caregiver": set()}
+    for path in paths:
+        for number, record in enumerate(read_records(path), 1):
+            kind = (record.get("type") or "").strip().lower()
+            where = "%s:%d" % (path, number)
+            if kind in accounts:
+                username = (record.get("username") or "").strip()
+                password = record.get("password") or ""
+                problem = Util.check_password(password)
+                if username == "":
+                    skipped.append((where, "missing username"))
+                elif username.lower() in seen[kind]:
+                    skipped.append((where, "duplicate " + kind + " " + username))
+                elif problem is not None:
+                    skipped.append((where, username + ": " + problem))
+                else:
+                    seen[kind].add(username.lower())
+                    accounts[kind].append((username, password, where))
+            elif kind == "vaccine":
+                name = (record.get("vaccine") or "").strip()
+                try:
+                    doses = int(record.get("doses"))
+                except (TypeError, ValueError):
+                    doses = 0
+                if name == "" or doses <= 0:
+                    skipped.append((where, "vaccine needs a name and a positive number of doses"))
+                else:
+                    stock[name] = stock.get(name, 0) + doses
+            else:
+                skipped.append((where, "unknown type " + repr(kind)))
+    parsed = time.perf_counter()
+
+    # drop accounts that already exist before spending time hashing them
+    cm = ConnectionManager()
+    conn = cm.create_connection()
+    cursor = conn.cursor()
+    try:
+        for kind, table in ACCOUNT_TABLES.items():
+            existing = existing_usernames(cursor, table, [username for username, _, _ in accounts[kind]])
+            for username, _, where in accounts[kind]:
+                if username.lower() in existing:
+                    skipped.append((where, "username taken: " + username))
+            accounts[kind] = [(u, p, w) for u, p, w in accounts[kind] if u.lower() not in existing]
+    except DatabaseError as e:
+        print("Bulk import failed, nothing was loaded")
+        print("Db-Error:", e)
+        return 1
+    finally:
+        cm.close_connection()
+    checked = time.perf_counter()
+
+    # hash on every core without holding a connection
+    pending = [(kind, username, password, Util.generate_salt()) for kind in accounts for username, password, _ in accounts[kind]]
+    hashes = get_hash_service().generate_hashes((password, salt) for _, _, password, salt in pending)
+    hashed = time.perf_counter()
+
+    cm = ConnectionManager()
+    conn = cm.create_connection()
+    cursor = conn.cursor()
+    loaded = 0
+    try:
+        for kind, table in ACCOUNT_TABLES.items():
+            rows = [(username, salt, hash) for (k, username, _, salt), hash in zip(pending, hashes) if k == kind]
+            insert_accounts(cursor, table, rows)
+            loaded += len(rows)
+        if len(stock) != 0:
+            add_stock(cm.backend, cursor, stock)
+            loaded += len(stock)
+        # you must call commit() to persist your data if you don't set autocommit to True
+        conn.commit()
+        vaccine_catalog.invalidate()
+    except DatabaseError as e:
+        print("Bulk import failed, nothing was loaded")
+        print("Db-Error:", e)
+        return 1
+    finally:
+        cm.close_connection()
+    finished = time.perf_counter()
+
+    for where, reason in skipped:
+        print("Skipped", where + ":", reason)
+    print("Imported %d patients, %d caregivers and %d vaccines"
+          % (len(accounts["patient"]), len(accounts["caregiver"]), len(stock)))
+    print("  parse       %8.3fs" % (parsed - started))
+    print("  existence   %8.3fs" % (checked - parsed))
+    print("  hashing     %8.3fs  (%.0f passwords/s)" % (hashed - checked, len(pending) / max(hashed - checked, 1e-9)))
+    print("  insert      %8.3fs" % (finished - hashed))
+    print("  total       %8.3fs  (%.0f rows/s)" % (finished - started, loaded / max(finished - started, 1e-9)))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import patients, caregivers and vaccine stock")
+    parser.add_argument("paths", nargs="+", help="CSV or JSONL files")
+    args = parser.parse_args(argv)
+    return run_import(args.paths)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""
+Nightly upkeep of the dose ledger, e.g. from cron shortly after midnight.
+
+    python Maintenance.py [--today mm-dd-yyyy] [--keep-days 90]
+
+Writes off the doses of lots that expired before today, rolls ledger entries
+older than --keep-days up into one entry per vaccine and lot, and checks that
+every vaccine's balance still matches its lots and its ledger. Exits 1 if a
+step fails or a vaccine doesn't reconcile.
+"""
+import argparse
+import datetime
+import sys
+import time
+
+from util.Util import Util
+from db.ConnectionManager import DatabaseError
+from model.DoseLedger import DoseLedger
+
+
+def run_maintenance(today, keep_days):
+    started = time.perf_counter()
+    try:
+        expired = DoseLedger.expire(today)
+        for vaccine, lot, doses in expired:
+            print("Expired %d doses of %s from lot %s" % (doses, vaccine, lot or "-"))
+        # Recorded is UTC; entries from the last keep_days days stay as they are
+        rolled_up = DoseLedger.compact(datetime.datetime.utcnow() - datetime.timedelta(days=keep_days))
+        print("Rolled up %d ledger entries" % rolled_up)
+        mismatches = DoseLedger.reconcile()
+    except DatabaseError as e:
+        print("Maintenance failed")
+        print("Db-Error:", e)
+        return 1
+    for vaccine, balance, lots, ledger in mismatches:
+        print("%s does not reconcile: balance %d, lots %d, ledger %d" % (vaccine, balance, lots, ledger))
+    print("Done in %.3fs" % (time.perf_counter() - started))
+    return 1 if mismatches else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expire lots, compact and reconcile the dose ledger")
+    parser.add_argument("--today", type=Util.parse_date, default=None, help="mm-dd-yyyy (default: today)")
+    parser.add_argument("--keep-days", type=int, default=90, help="days of ledger entries kept as recorded")
+    args = parser.parse_args(argv)
+    return run_maintenance(args.today, args.keep_days)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,815 +1,550 @@
-import re
+import argparse
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import sys
+import threading
+import time
 
-from model.Vaccine import Vaccine
-from model.Caregiver import Caregiver
-from model.Patient import Patient
 from util.Util import Util
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.ConnectionManager import ConnectionManager, DatabaseError
+from db.Instrumentation import get_instrumentation
+from service.SchedulerService import SchedulerService, Result
+from model.Report import Report
+from service.Session import Session
 import datetime
 
 
-'''
-objects to keep track of the currently logged-in user
-Note: it is always true that at most one of currentCaregiver and currentPatient is not null
-        since only one user can be logged-in at a time
-'''
-current_patient = None
+# the CLI is a thin client over the service; it serves one user, so the
+# service runs inline on an event loop per calling thread. Who is logged in
+# lives in the Session every handler is given.
+service = SchedulerService(workers=0)
 
-current_caregiver = None
+loops = threading.local()
 
 
-def create_patient(tokens):
-    if len(tokens)!=3:
-        print("Error creating patient")
-        start()
-        return
-    username=tokens[1]
-    password=tokens[2]
-    if username_exists_patient(username):
-        print("Username taken, try again")
-        start()
-        return
+def run(coro):
+    loop = getattr(loops, "loop", None)
+    if loop is None:
+        loop = loops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
 
-    if len(password)<8:
-        print("Please enter a password of at least 8 characters")
-        start()
-        return
-    if not re.search(r'[A-Z]', password):
-        print("Password must contain at least one uppercase letter!")
-        start()
-        return
 
-    if not re.search(r'[a-z]', password):
-        print("Password must contain at least one lowercase letter!")
-        start()
-        return
+def show(result):
+    # prints what the user should see for a service result and hands it back
+    if result.message is not None:
+        print(result.message)
+    if result.error is not None:
+        print("Error:", result.error)
+    return show_promoted(result)
 
-    if not re.search(r'[0-9]',password):
-        print("Please enter a password of at least one number!")
-        start()
-        return
-    if not re.search(r'[!@#?]',password):
-        print("Please enter a password of at least one special character!")
-        start()
-        return
 
-    salt=Util.generate_salt()
-    hash=Util.generate_hash(password,salt)
-    patient=Patient(username=username,salt=salt,hash=hash)
-    try:
-        patient.save_to_db()
-    except pymssql.Error as e:
-        print("Create patient failed")
-        print("Error:", e)
-        quit()
-    except Exception as e:
-        print("Create patient failed")
-        print("Error:", e)
-        quit()
-    print("Created user", username)
-    start()
-
-
-def username_exists_patient(username):
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-
-    select_username = "SELECT * FROM Patient WHERE Username = %s"
-    try:
-        cursor = conn.cursor(as_dict=True)
-        cursor.execute(select_username, username)
-        #  returns false if the cursor is not before the first record or if there are no rows in the ResultSet.
-        for row in cursor:
-            return row['Username'] is not None
-    except pymssql.Error as e:
-        print("Error occurred when checking username")
-        print("Db-Error:", e)
-        quit()
-    except Exception as e:
-        print("Error occurred when checking username")
-        print("Error:", e)
-    finally:
-        cm.close_connection()
-    return False
+def show_promoted(result):
+    # prints the waitlisted patients a result booked, for handlers that print the rest themselves
+    for appointment in result.promoted:
+        print("Booked from the waitlist: Appointment ID", appointment.appointment_id, "for", appointment.patient,
+              "on", appointment.time.strftime("%m-%d-%Y"), Util.format_time(appointment.slot), "with", appointment.caregiver)
+    return result
 
 
+def create_patient(session, tokens):
+    if len(tokens)!=3:
+        return show(Result(False, "Error creating patient"))
+    return show(run(service.create_patient(session, tokens[1], tokens[2])))
 
-def create_caregiver(tokens):
+
+def create_caregiver(session, tokens):
     # create_caregiver <username> <password>
     # check 1: the length for tokens need to be exactly 3 to include all information (with the operation name)
     if len(tokens) != 3:
-        print("Failed to create user.")
-        return
-
-    username = tokens[1]
-    password = tokens[2]
-    # check 2: check if the username has been taken already
-    if username_exists_caregiver(username):
-        print("Username taken, try again!")
-        return
-    if len(password)<8:
-        print("Please enter a password of at least 8 characters")
-        start()
-        return
-    if not re.search(r'[A-Z]', password):
-        print("Password must contain at least one uppercase letter!")
-        start()
-        return
-
-    if not re.search(r'[a-z]', password):
-        print("Password must contain at least one lowercase letter!")
-        start()
-        return
-
-    if not re.search(r'[0-9]',password):
-        print("Please enter a password of at least one number!")
-        start()
-        return
-    if not re.search(r'[!@#?]',password):
-        print("Please enter a password of at least one special character!")
-        start()
-        return
-
-    salt = Util.generate_salt()
-    hash = Util.generate_hash(password, salt)
+        return show(Result(False, "Failed to create user."))
+    return show(run(service.create_caregiver(session, tokens[1], tokens[2])))
 
-    # create the caregiver
-    caregiver = Caregiver(username, salt=salt, hash=hash)
 
-    # save to caregiver information to our database
-    try:
-        caregiver.save_to_db()
-    except pymssql.Error as e:
-        print("Failed to create user.")
-        print("Db-Error:", e)
-        quit()
-    except Exception as e:
-        print("Failed to create user.")
-        print(e)
-        return
-    print("Created user ", username)
-
-
-def username_exists_caregiver(username):
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-
-    select_username = "SELECT * FROM Caregivers WHERE Username = %s"
-    try:
-        cursor = conn.cursor(as_dict=True)
-        cursor.execute(select_username, username)
-        #  returns false if the cursor is not before the first record or if there are no rows in the ResultSet.
-        for row in cursor:
-            return row['Username'] is not None
-    except pymssql.Error as e:
-        print("Error occurred when checking username")
-        print("Db-Error:", e)
-        quit()
-    except Exception as e:
-        print("Error occurred when checking username")
-        print("Error:", e)
-    finally:
-        cm.close_connection()
-    return False
-
-
-def login_patient(tokens):
+def login_patient(session, tokens):
     """
     TODO: Part 1
     """
-    global current_patient
-    if current_caregiver is not None or current_patient is not None:
-        print("User already logged in, try again")
-        return
-
     # check 2: the length for tokens need to be exactly 3 to include all information (with the operation name)
     if len(tokens) != 3:
-        print("Login failed.")
-        return
+        return show(Result(False, "Login failed."))
 
-    username = tokens[1]
-    password = tokens[2]
-
-    patient = None
-    try:
-        patient = Patient(username, password=password).get()
-    except pymssql.Error as e:
-        print("Login patient failed")
-        print("Db-Error:", e)
-        quit()
-    except Exception as e:
-        print("Login patient failed")
-        print("Error:", e)
-        return
-
-    # check if the login was successful
-    if patient is None:
-        print("Login patient failed")
-    else:
-        print("Logged in as: " + username)
-        current_patient = patient
+    return show(run(service.login_patient(session, tokens[1], tokens[2])))
 
 
-def login_caregiver(tokens):
+def login_caregiver(session, tokens):
     # login_caregiver <username> <password>
     # check 1: if someone's already logged-in, they need to log out first
-    global current_caregiver
-    if current_caregiver is not None or current_patient is not None:
-        print("User already logged in.")
-        return
-
     # check 2: the length for tokens need to be exactly 3 to include all information (with the operation name)
     if len(tokens) != 3:
-        print("Login failed.")
-        return
+        return show(Result(False, "Login failed."))
 
-    username = tokens[1]
-    password = tokens[2]
-
-    caregiver = None
-    try:
-        caregiver = Caregiver(username, password=password).get()
-    except pymssql.Error as e:
-        print("Login failed.")
-        print("Db-Error:", e)
-        quit()
-    except Exception as e:
-        print("Login failed.")
-        print("Error:", e)
-        return
-
-    # check if the login was successful
-    if caregiver is None:
-        print("Login failed.")
-    else:
-        print("Logged in as: " + username)
-        current_caregiver = caregiver
+    return show(run(service.login_caregiver(session, tokens[1], tokens[2])))
 
 
-def search_caregiver_schedule(tokens):
+def search_caregiver_schedule(session, tokens):
     """
     TODO: Part 2
+    search_caregiver_schedule <date>          the caregivers free in each slot of the day
+    search_caregiver_schedule <from> <to>     the caregivers free on each day
     """
-    if len(tokens) != 2:
-        print("Please try again!")
-        start()
-        return
-    split_date=tokens[1].split("-")
-    if len(split_date) != 3:
-        print("Please try again!")
-        start()
-        return
-    if len(split_date[0]) != 2:
-        print("Please try again!")
-        start()
-        return
-    if len(split_date[1]) != 2:
-        print("Please try again!")
-        start()
-        return
-    if len(split_date[2]) != 4:
-        print("Please try again!")
-        start()
-        return
+    if len(tokens) not in (2, 3):
+        return show(Result(False, "Please try again!"))
+    try:
+        first=Util.parse_date(tokens[1])
+        last=Util.parse_date(tokens[-1])
+    except ValueError:
+        return show(Result(False, "Please try again!"))
+    if last<first:
+        return show(Result(False, "Please try again!"))
 
-    month=int(split_date[0])
-    day=int(split_date[1])
-    year=int(split_date[2])
+    async def search():
+        #find available caregivers, printing each day as it streams in
+        found=False
+        try:
+            async for d,slots in service.stream_availability(session,first,last):
+                found=True
+                if len(tokens) == 2:
+                    for slot,caregivers in slots:
+                        print(Util.format_time(slot)," ".join(caregivers)+" ")
+                else:
+                    # one line per day, flushed so long ranges render as they are read
+                    caregivers=sorted({caregiver for _,names in slots for caregiver in names})
+                    print(d.strftime("%m-%d-%Y"),str(len(caregivers))+":"," ".join(caregivers),flush=True)
+            if not found:
+                print("Please try again!")
+        except DatabaseError:
+            print("Please try again!")
 
-    if month==00 or day==00 or year==0000:
-        print("Please try again!")
-        start()
-        return
-    if day>31 or month>12:
-        print("Please try again!")
-        start()
-        return
-    if current_patient is None and current_caregiver is None:
-        print("Please login first!")
-        start()
-        return
-
-    #find available caregiver
-    res_str=""
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor(as_dict=True)
-    find_caregiver_for_date="select Username from Availabilities where Time=%s order by Username asc"
-    try:
-        d=datetime.datetime(year,month,day)
-        cursor.execute(find_caregiver_for_date,d)
-        result=cursor.fetchall()
-        if len(result) != 0:
-            for row in result:
-                res_str=res_str+row['Username']+" "
-            print(res_str)
-        else:
+        #find available vaccines; display only, so the cached catalog is good enough
+        try:
+            vaccines=await service.vaccines(session)
+            if len(vaccines) != 0:
+                for name,doses in vaccines:
+                    print(name,doses)
+            else:
+                print("Please try again!")
+        except DatabaseError:
             print("Please try again!")
-        cm.close_connection()
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-
-    #find available vaccines
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor(as_dict=True)
-    find_vaccine="select * from Vaccines"
+        return Result(found)
+
     try:
-        cursor.execute(find_vaccine)
-        v_result=cursor.fetchall()
-        if len(v_result) != 0:
-            for row in v_result:
-                print(row['Name'],row['Doses'])
-        else:
-            print("Please try again!")
-        cm.close_connection()
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-    start()
+        return run(search())
+    except PermissionError as e:
+        return show(Result(False, str(e)))
 
 
 
-def reserve(tokens):
+def reserve(session, tokens):
     """
     TODO: Part 2
+    reserve <date> <vaccine> [<hh:mm>]   books that slot, or else the earliest free slot of the day
     """
-    global current_caregiver
-    global current_patient
-    if current_caregiver is not None:
-        print("Please login as a patient!")
-        start()
-        return
-    if current_patient is None:
-        print("Please login first!")
-        start()
-        return
-    if len(tokens) != 3:
-        print("Please try again! len(tokens) != 3")
-        start()
-        return
-    date=tokens[1]
-    vaccine=tokens[2]
-    split_date=date.split("-")
-
-    if len(split_date) != 3:
-        print("Please try again!")
-        start()
-        return
+    if len(tokens) not in (3, 4):
+        return show(Result(False, "Please try again! len(tokens) != 3"))
+    try:
+        d=Util.parse_date(tokens[1])
+        slot=Util.parse_time(tokens[3]) if len(tokens) == 4 else None
+    except ValueError:
+        return show(Result(False, "Please try again!"))
 
-    if len(split_date[0]) != 2:
-        print("Please try again!")
-        start()
-        return
-    if len(split_date[1]) != 2:
-        print("Please try again!")
-        start()
-        return
-    if len(split_date[2]) != 4:
-        print("Please try again!")
-        start()
-        return
+    result=run(service.reserve(session,d,tokens[2],slot=slot))
+    if result.ok:
+        print("Updated available doses!")
+    return show(result)
 
-    month = int(split_date[0])
-    day = int(split_date[1])
-    year = int(split_date[2])
 
-    if month == 00 or day == 00 or year == 0000:
-        print("Please try again!")
-        start()
-        return
-    if day > 31 or month > 12:
-        print("Please try again!")
-        start()
-        return
 
-    #check available caregivers
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor(as_dict=True)
-    find_caregiver_for_date="select Username from Availabilities where Time=%s order by Username asc"
+def join_waitlist(session, tokens):
+    #  join_waitlist <date> <vaccine> | <from> <to> <vaccine>
+    #  waits for a dose and a slot on any of those days; the first one to free up is booked automatically
+    if len(tokens) not in (3, 4):
+        return show(Result(False, "Please try again!"))
     try:
-        d=datetime.datetime(year,month,day)
-        cursor.execute(find_caregiver_for_date,d)
-        result=cursor.fetchall()
-        if len(result) != 0:
-            caregiver=[row['Username'] for row in result]
-            book_caregiver=caregiver[0]
-        else:
-            print("No caregiver is available!")
-            cm.close_connection()
-            start()
-            return
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-        start()
-        return
-    cm.close_connection()
-
-    #check if vaccine is available
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor()
-    find_vaccine="select Name,Doses from Vaccines where Name=%s"
-    try:
-        cursor.execute(find_vaccine,vaccine)
-        v_result=cursor.fetchall()
-        if len(v_result)==0:
-            print("Not enough available doses!")
-            cm.close_connection()
-            start()
-            return
-        for row in v_result:
-            available_doses=row[1]
-            if available_doses>0:
-                available_doses-=1
-                update_doses="update Vaccines set Doses=%d where Name=%s"
-                cursor.execute(update_doses,(available_doses,vaccine))
-                conn.commit()
-                print("Updated available doses!")
-            else:
-                print("No available doses!")
-                cm.close_connection()
-                start()
-                return
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-        start()
-        return
-    cm.close_connection()
-
-    #remove caregiver's availability
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor()
-    remove_caregiver="delete from Availabilities where Time=%s and Username=%s"
-    try:
-        cursor.execute(remove_caregiver,(d,book_caregiver))
-        conn.commit()
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-        start()
-        return
-    cm.close_connection()
-
-    #add appointment
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor()
-    appoint_id="select max(ID) from Appointments"
-    try:
-        cursor.execute(appoint_id)
-        result=cursor.fetchall()
-        if result[0][0] is None:
-            id=1
+        first=Util.parse_date(tokens[1])
+        last=Util.parse_date(tokens[-2])
+    except ValueError as e:
+        return show(Result(False, str(e)))
+    if last<first:
+        return show(Result(False, "Please enter a valid date range!"))
+    return show(run(service.join_waitlist(session,first,last,tokens[-1])))
+
+
+def leave_waitlist(session, tokens):
+    #  leave_waitlist <vaccine>
+    if len(tokens) != 2:
+        return show(Result(False, "Please try again!"))
+    return show(run(service.leave_waitlist(session,tokens[1])))
+
+
+def availability_slots(tokens):
+    # [--hours <hh:mm>-<hh:mm>] [--slot <minutes>] after the dates: which slots to open each day
+    # (default: AvailabilityHours and SlotMinutes); returns the remaining tokens and the slots
+    hours, length = None, None
+    while len(tokens) >= 3 and tokens[-2] in ("--hours", "--slot"):
+        if tokens[-2] == "--hours":
+            hours = tokens[-1]
+        elif tokens[-1].isdigit() and int(tokens[-1]) > 0:
+            length = int(tokens[-1])
         else:
-            id=int(result[0][0])+1
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-        start()
-        return
-    add_appoint="insert into Appointments values(%d,%s,%s,%s,%s)"
-    try:
-        cursor.execute(add_appoint, (id,d,current_patient.username,book_caregiver,vaccine))
-        print("Appointment ID "+str(id)+", Caregiver username "+str(book_caregiver))
-        conn.commit()
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-    cm.close_connection()
-    start()
+            raise ValueError("Please enter a slot length in minutes!")
+        tokens = tokens[:-2]
+    return tokens, Util.day_slots(hours, length)
+
+
+def availability_dates(tokens):
+    # upload_availability <date>
+    # upload_availability <from> <to> [<weekdays>]   e.g. 03-01-2022 05-31-2022 mon,wed,fri
+    # upload_availability --file <csv>               one mm-dd-yyyy date in the first column of each row
+    if len(tokens) == 3 and tokens[1] == "--file":
+        dates = []
+        with open(tokens[2], newline="") as f:
+            for row in csv.reader(f):
+                if len(row) == 0 or row[0].strip() == "" or row[0].strip().lower() == "date":
+                    continue
+                dates.append(Util.parse_date(row[0].strip()))
+        return dates
+
+    if len(tokens) == 2:
+        return [Util.parse_date(tokens[1])]
 
+    if len(tokens) in (3, 4):
+        return Util.date_range(Util.parse_date(tokens[1]), Util.parse_date(tokens[2]), tokens[3] if len(tokens) == 4 else None)
 
+    raise ValueError("Please try again!")
 
-def upload_availability(tokens):
-    #  upload_availability <date>
+
+def upload_availability(session, tokens):
+    #  upload_availability <date> | <from> <to> [<weekdays>] | --file <csv>  [--hours <hh:mm>-<hh:mm>] [--slot <minutes>]
     #  check 1: check if the current logged-in user is a caregiver
-    global current_caregiver
-    if current_caregiver is None:
-        print("Please login as a caregiver first!")
-        return
+    if session.caregiver is None:
+        return show(Result(False, "Please login as a caregiver first!"))
 
-    # check 2: the length for tokens need to be exactly 2 to include all information (with the operation name)
-    if len(tokens) != 2:
-        print("Please try again!")
-        return
-
-    date = tokens[1]
-    # assume input is hyphenated in the format mm-dd-yyyy
-    date_tokens = date.split("-")
-    month = int(date_tokens[0])
-    day = int(date_tokens[1])
-    year = int(date_tokens[2])
+    # check 2: the dates and slots must parse
     try:
-        d = datetime.datetime(year, month, day)
-        current_caregiver.upload_availability(d)
-    except pymssql.Error as e:
-        print("Upload Availability Failed")
-        print("Db-Error:", e)
-        quit()
-    except ValueError:
-        print("Please enter a valid date!")
-        return
-    except Exception as e:
-        print("Error occurred when uploading availability")
-        print("Error:", e)
-        return
-    print("Availability uploaded!")
+        tokens, slots = availability_slots(tokens)
+        dates = availability_dates(tokens)
+    except ValueError as e:
+        return show(Result(False, str(e)))
+    except OSError as e:
+        return show(Result(False, "Could not read availability file", error=e))
+
+    result = run(service.upload_availability(session, dates, slots))
+    if not result.ok:
+        return show(result)
+    duplicates = result.data["duplicates"]
+    if len(duplicates) != 0:
+        print("Availability already uploaded for:", " ".join(d.strftime("%m-%d-%Y") for d in duplicates))
+    if result.data["uploaded"] != 0:
+        if len(tokens) == 2:
+            print("Availability uploaded!")
+        else:
+            print("Availability uploaded for", result.data["uploaded"], "days!")
+    return show_promoted(result)
 
 
-def cancel(tokens):
+def cancel(session, tokens):
     """
     TODO: Extra Credit
     """
-    global current_caregiver
-    global current_patient
-    if len(tokens) != 2:
-        print("Please try again!")
-        start()
-        return
-    if current_caregiver is None and current_patient is None:
-        print("Log in first!")
-        start()
-        return
-
-    appoint_id=tokens[1]
-    cm=ConnectionManager()
-    conn = cm.create_connection()
-    cursor=conn.cursor()
-    find_appoint="select * from Appointments where ID=%s"
-    try:
-        cursor.execute(find_appoint,appoint_id)
-        result=cursor.fetchall()
-        if len(result) != 0:
-            for row in result:
-                app_date=row[1]
-                app_patient=row[2]
-                app_caregiver=row[3]
-                app_vaccine=row[4]
-                delete_appoint="delete from Appointments where ID=%s"
-                try:
-                    cursor.execute(delete_appoint,appoint_id)
-                    conn.commit()
-                except pymssql.Error:
-                    print("Please try again!")
-                    cm.close_connection()
-                    start()
-                    return
-                cm.close_connection()
-
-                #return the vaccine into available vaccine
-                cm=ConnectionManager()
-                conn = cm.create_connection()
-                cursor=conn.cursor()
-                return_vac="update Vaccines set Doses=Doses+1 where Name=%s"
-                try:
-                    cursor.execute(return_vac,app_vaccine)
-                    conn.commit()
-                except pymssql.Error:
-                    print("Please try again!")
-                    cm.close_connection()
-                    start()
-                    return
-                cm.close_connection()
-
-                #return caregiver's availability
-                cm=ConnectionManager()
-                conn = cm.create_connection()
-                cursor=conn.cursor()
-                return_avai="insert into Availabilities values (%s,%s)"
-                try:
-                    cursor.execute(return_avai,(str(app_date), str(app_caregiver)))
-                    conn.commit()
-                    print("Availability canceled!")
-                except pymssql.Error:
-                    print("Please try again!")
-                    cm.close_connection()
-                    start()
-                    return
-                cm.close_connection()
-        else:
-            print("Please try again!")
-            cm.close_connection()
-            start()
-            return
-    except pymssql.Error:
-        print("Please try again!")
-        cm.close_connection()
-        start()
-        return
-    start()
-
+    if len(tokens) != 2 or not tokens[1].isdigit():
+        return show(Result(False, "Please try again!"))
+    return show(run(service.cancel(session,int(tokens[1]))))
 
 
+def cancel_day(session, tokens):
+    #  cancel_day <date>
+    #  cancels all of the logged-in caregiver's appointments on a day
+    if session.caregiver is None:
+        return show(Result(False, "Please login as a caregiver first!"))
+    if len(tokens) != 2:
+        return show(Result(False, "Please try again!"))
+    try:
+        d=Util.parse_date(tokens[1])
+    except ValueError as e:
+        return show(Result(False, str(e)))
 
+    result=run(service.cancel_day(session,d))
+    if not result.ok:
+        return show(result)
+    for appointment in result.data:
+        print("Canceled appointment",appointment.appointment_id,"for",appointment.patient)
+    print("Canceled",len(result.data),"appointments for",session.username,"on",tokens[1])
+    return show_promoted(result)
 
 
-def add_doses(tokens):
-    #  add_doses <vaccine> <number>
+def add_doses(session, tokens):
+    #  add_doses <vaccine> <number> [<lot> [<expires>]]
     #  check 1: check if the current logged-in user is a caregiver
-    global current_caregiver
-    if current_caregiver is None:
-        print("Please login as a caregiver first!")
-        return
+    if session.caregiver is None:
+        return show(Result(False, "Please login as a caregiver first!"))
+
+    #  check 2: the vaccine and the number, optionally the lot and its expiry date
+    if len(tokens) not in (3, 4, 5) or not tokens[2].isdigit():
+        return show(Result(False, "Please try again!"))
+    lot=tokens[3] if len(tokens) >= 4 else None
+    expires=None
+    if len(tokens) == 5:
+        try:
+            expires=Util.parse_date(tokens[4])
+        except ValueError as e:
+            return show(Result(False, str(e)))
+    return show(run(service.add_doses(session, tokens[1], int(tokens[2]), lot, expires)))
 
-    #  check 2: the length for tokens need to be exactly 3 to include all information (with the operation name)
-    if len(tokens) != 3:
-        print("Please try again!")
-        return
 
-    vaccine_name = tokens[1]
-    doses = int(tokens[2])
-    vaccine = None
+def show_doses(session, tokens):
+    #  show_doses <vaccine>: the vaccine's lots and its latest ledger entries
+    if len(tokens) != 2:
+        return show(Result(False, "Please try again!"))
+    result=run(service.dose_history(session, tokens[1]))
+    if not result.ok:
+        return show(result)
+    lots,entries=result.data
+    for lot,expires,doses in lots:
+        print("Lot",lot or "-",expires.strftime("%m-%d-%Y") if expires else "-",doses)
+    for entry_id,lot,kind,doses,appointment_id,recorded in entries:
+        print(entry_id,lot or "-",kind,"%+d" % doses,appointment_id or "-",recorded)
+    return result
+
+
+def percent(appointments, open_slots):
+    share=Report.utilization(appointments, open_slots)
+    return "-" if share is None else "%.1f%%" % (share * 100)
+
+
+def report(session, tokens):
+    #  report <date> | <from> <to>: appointments and open slots per day, vaccine and caregiver
+    if len(tokens) not in (2, 3):
+        return show(Result(False, "Please try again!"))
     try:
-        vaccine = Vaccine(vaccine_name, doses).get()
-    except pymssql.Error as e:
-        print("Error occurred when adding doses")
-        print("Db-Error:", e)
-        quit()
-    except Exception as e:
-        print("Error occurred when adding doses")
-        print("Error:", e)
-        return
-
-    # if the vaccine is not found in the database, add a new (vaccine, doses) entry.
-    # else, update the existing entry by adding the new doses
-    if vaccine is None:
-        vaccine = Vaccine(vaccine_name, doses)
-        try:
-            vaccine.save_to_db()
-        except pymssql.Error as e:
-            print("Error occurred when adding doses")
-            print("Db-Error:", e)
-            quit()
-        except Exception as e:
-            print("Error occurred when adding doses")
-            print("Error:", e)
-            return
-    else:
-        # if the vaccine is not null, meaning that the vaccine already exists in our table
-        try:
-            vaccine.increase_available_doses(doses)
-        except pymssql.Error as e:
-            print("Error occurred when adding doses")
-            print("Db-Error:", e)
-            quit()
-        except Exception as e:
-            print("Error occurred when adding doses")
-            print("Error:", e)
-            return
-    print("Doses updated!")
-
-
-def show_appointments(tokens):
+        first=Util.parse_date(tokens[1])
+        last=Util.parse_date(tokens[-1])
+    except ValueError as e:
+        return show(Result(False, str(e)))
+    if last<first:
+        return show(Result(False, "Please try again!"))
+    result=run(service.report(session, first, last))
+    if not result.ok:
+        return show(result)
+    summary=result.data
+    booked,free=summary.get_appointments(),summary.get_open_slots()
+    print("Booked",booked,"open",free,"utilization",percent(booked,free))
+    for d,appointments,open_slots in summary.days:
+        print(d.strftime("%m-%d-%Y"),"booked",appointments,"open",open_slots,percent(appointments,open_slots))
+    for vaccine,appointments in summary.vaccines:
+        print("Vaccine",vaccine,appointments)
+    for caregiver,appointments,open_slots in summary.caregivers:
+        print("Caregiver",caregiver,"booked",appointments,"open",open_slots,percent(appointments,open_slots))
+    return result
+
+
+def appointment_filters(tokens):
+    # show_appointments [--after <id>] [--limit <n>] [--from <date>] [--to <date>] [--upcoming]
+    filters={}
+    options=tokens[1:]
+    i=0
+    while i < len(options):
+        option=options[i]
+        if option == "--upcoming":
+            filters["from"]=max(filters.get("from",datetime.date.min),datetime.date.today())
+            i+=1
+            continue
+        if i+1 >= len(options):
+            raise ValueError("Please try again!")
+        value=options[i+1]
+        if option in ("--after","--limit"):
+            if not value.isdigit() or (option == "--limit" and int(value) == 0):
+                raise ValueError("Please try again!")
+            filters[option[2:]]=int(value)
+        elif option == "--from":
+            filters["from"]=max(filters.get("from",datetime.date.min),Util.parse_date(value))
+        elif option == "--to":
+            filters["to"]=Util.parse_date(value)
+        else:
+            raise ValueError("Please try again!")
+        i+=2
+    return filters
+
+
+def show_appointments(session, tokens):
     '''
     TODO: Part 2
+    show_appointments [--after <id>] [--limit <n>] [--from <date>] [--to <date>] [--upcoming]
     '''
-    global current_caregiver
-    global current_patient
-    if current_caregiver is None and current_patient is None:
-        print("Please login first!")
-        start()
-        return
-
-    #if now is patient logging
-    if current_patient is not None:
-        cm=ConnectionManager()
-        conn=cm.create_connection()
-        cursor=conn.cursor(as_dict=True)
-        show_appoint="select * from Appointments where p_name=%s order by ID asc"
-        try:
-            cursor.execute(show_appoint,current_patient.username)
-            result=cursor.fetchall()
-            if len(result) == 0:
-                print("Please try again!")
-                cm.close_connection()
-                start()
-                return
-            else:
-                for row in result:
-                    print(row['ID'],row['v_name'],row['Time'],row['c_name'])
-        except pymssql.Error:
-            print("Please try again!")
-            cm.close_connection()
-            start()
-            return
-        cm.close_connection()
-
-    #if now is caregiver logging
-    if current_caregiver is not None:
-        cm=ConnectionManager()
-        conn=cm.create_connection()
-        cursor=conn.cursor(as_dict=True)
-        c_appoint="select * from Appointments where c_name=%s order by ID asc"
+    if session.user is None:
+        return show(Result(False, "Please login first!"))
+    try:
+        filters=appointment_filters(tokens)
+    except ValueError as e:
+        return show(Result(False, str(e)))
+    empty="Please try again!" if session.patient is not None else "Please try again! no appointments"
+
+    async def page():
+        shown=0
+        last_id=None
         try:
-            cursor.execute(c_appoint,current_caregiver.username)
-            c_result=cursor.fetchall()
-            if len(c_result) == 0:
-                print("Please try again! no appointments")
-                cm.close_connection()
-                start()
-                return
-            else:
-                for row in c_result:
-                    print(row['ID'],row['v_name'],row['Time'],row['p_name'])
-        except pymssql.Error:
+            async for row in service.stream_appointments(session,filters):
+                print(row[0],row[1],row[2],Util.format_time(row[3]),row[4])
+                shown+=1
+                last_id=row[0]
+        except DatabaseError:
             print("Please try again!")
-            cm.close_connection()
-            start()
-            return
-        cm.close_connection()
-    start()
+            return Result(False)
+        if shown == 0:
+            print(empty)
+        elif shown == filters.get("limit"):
+            print("More: show_appointments --after "+str(last_id))
+        return Result(True)
+
+    return run(page())
 
-def logout(tokens):
+
+def logout(session, tokens):
     """
     TODO: Part 2
     """
-    global current_caregiver
-    global current_patient
+    return show(run(service.logout(session)))
+
+
+def metrics(session, tokens):
+    #  metrics: the database and pool counters in the Prometheus text format
+    if len(tokens) != 1:
+        return show(Result(False, "Please try again!"))
+    print(ConnectionManager.metrics(), end="")
+    return Result(True)
+
+
+
+# command name -> handler; every handler takes the session and the whitespace-split command line
+COMMANDS = {
+    "create_patient": create_patient,
+    "create_caregiver": create_caregiver,
+    "login_patient": login_patient,
+    "login_caregiver": login_caregiver,
+    "search_caregiver_schedule": search_caregiver_schedule,
+    "reserve": reserve,
+    "upload_availability": upload_availability,
+    "join_waitlist": join_waitlist,
+    "leave_waitlist": leave_waitlist,
+    "cancel": cancel,
+    "cancel_day": cancel_day,
+    "add_doses": add_doses,
+    "show_doses": show_doses,
+    "report": report,
+    "show_appointments": show_appointments,
+    "logout": logout,
+    "metrics": metrics,
+}
+
+
+def run_command(session, tokens):
+    # runs one command and returns its Result to the caller; returns None once the user has asked to quit
+    operation = tokens[0]
+    if operation == "quit":
+        print("Bye!")
+        return None
+    handler = COMMANDS.get(operation)
+    if handler is None:
+        return show(Result(False, "Invalid operation name!"))
+    # with DBInstrumentation=1, totals the command's statements, rows and time
+    with get_instrumentation().scope(operation):
+        return handler(session, tokens)
+
+
+def run_script(lines, report):
+    """
+    Batch mode: runs each command in lines without the menu or prompt, and
+    writes one JSON object per command to report with its line number,
+    operation, status ("ok", "failed" or "error"), elapsed milliseconds and
+    printed output. All commands run in one session on one pooled database
+    connection.
+    """
+    session = Session(keep_connection=True)
     try:
-        if current_caregiver is None and current_patient is None:
-            print("Please login first")
-            return
-        else:
-            current_patient=None
-            current_caregiver=None
-            print("Successfully logged out")
-            start()
-            return
-    except pymssql.Error as e:
-        print("Logout failed")
-        start()
-        return
-    start()
-
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            tokens = line.split()
+            output = io.StringIO()
+            error = None
+            keep_going = True
+            started = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(output):
+                    result = run_command(session, tokens)
+                keep_going = result is not None
+                status = "ok" if result is None or result.ok else "failed"
+            except Exception as e:
+                status = "error"
+                error = repr(e)
+            elapsed = (time.perf_counter() - started) * 1000
+            sys.stdout.write(output.getvalue())
+            record = {"line": number, "command": tokens[0], "status": status,
+                      "elapsed_ms": round(elapsed, 3), "output": output.getvalue().splitlines()}
+            if error is not None:
+                record["error"] = error
+            report.write(json.dumps(record) + "\n")
+            report.flush()
+            if not keep_going:
+                break
+    finally:
+        session.close()
 
 
-def start():
-    stop = False
+def print_menu():
     print()
     print(" *** Please enter one of the following commands *** ")
     print("> create_patient <username> <password>")  # //TODO: implement create_patient (Part 1)
     print("> create_caregiver <username> <password>")
     print("> login_patient <username> <password>")  # // TODO: implement login_patient (Part 1)
     print("> login_caregiver <username> <password>")
-    print("> search_caregiver_schedule <date>")  # // TODO: implement search_caregiver_schedule (Part 2)
-    print("> reserve <date> <vaccine>")  # // TODO: implement reserve (Part 2)
-    print("> upload_availability <date>")
+    print("> search_caregiver_schedule <date> [<to date>]")  # // TODO: implement search_caregiver_schedule (Part 2)
+    print("> reserve <date> <vaccine> [<hh:mm>]")  # // TODO: implement reserve (Part 2)
+    print("> upload_availability <date> | <from> <to> [<weekdays>] | --file <csv> [--hours <hh:mm>-<hh:mm>] [--slot <minutes>]")
+    print("> join_waitlist <date> <vaccine> | <from> <to> <vaccine>")
+    print("> leave_waitlist <vaccine>")
     print("> cancel <appointment_id>")  # // TODO: implement cancel (extra credit)
-    print("> add_doses <vaccine> <number>")
-    print("> show_appointments")  # // TODO: implement show_appointments (Part 2)
+    print("> cancel_day <date>")
+    print("> add_doses <vaccine> <number> [<lot> [<expires>]]")
+    print("> show_doses <vaccine>")
+    print("> report <date> | <from> <to>")
+    print("> show_appointments [--after <id>] [--limit <n>] [--from <date>] [--to <date>] [--upcoming]")  # // TODO: implement show_appointments (Part 2)
     print("> logout")  # // TODO: implement logout (Part 2)
+    print("> help")
+    print("> metrics")
     print("> Quit")
     print()
-    while not stop:
-        response = ""
-        print("> ", end='')
 
+
+def start():
+    # the read-eval-print loop; handlers always return here, so a session of
+    # any length runs in constant stack depth
+    print_menu()
+    session = Session()
+    while True:
+        print("> ", end='')
         try:
             response = str(input())
         except ValueError:
             print("Please try again!")
             break
+        except (EOFError, KeyboardInterrupt):
+            print()
+            print("Bye!")
+            break
 
-
-        tokens = response.split(" ")
+        tokens = response.split()
         if len(tokens) == 0:
-            ValueError("Please try again!")
             continue
-        operation = tokens[0]
-        if operation == "create_patient":
-            create_patient(tokens)
-        elif operation == "create_caregiver":
-            create_caregiver(tokens)
-        elif operation == "login_patient":
-            login_patient(tokens)
-        elif operation == "login_caregiver":
-            login_caregiver(tokens)
-        elif operation == "search_caregiver_schedule":
-            search_caregiver_schedule(tokens)
-        elif operation == "reserve":
-            reserve(tokens)
-        elif operation == "upload_availability":
-            upload_availability(tokens)
-        elif operation == "cancel":
-            cancel(tokens)
-        elif operation == "add_doses":
-            add_doses(tokens)
-        elif operation == "show_appointments":
-            show_appointments(tokens)
-        elif operation == "logout":
-            logout(tokens)
-        elif operation == "quit":
-            print("Bye!")
-            stop = True
-        else:
-            print("Invalid operation name!")
+        if tokens[0] == "help":
+            print_menu()
+            continue
+        if run_command(session, tokens) is None:
+            break
+    session.close()
 
 
 if __name__ == "__main__":
@@ -819,8 +554,24 @@ if __name__ == "__main__":
     // for the simplicity of this assignment
     // and then construct a map of vaccineName -> vaccineObject
     '''
-    # start command line
-    print()
-    print("Welcome to the COVID-19 Vaccine Reservation Scheduling Application!")
+    parser = argparse.ArgumentParser(description="COVID-19 Vaccine Reservation Scheduling Application")
+    parser.add_argument("--script", help="run the commands in this file (- for stdin) instead of prompting")
+    parser.add_argument("--report", help="write the per-command JSON report here instead of stderr")
+    args = parser.parse_args()
+
+    if args.script is not None:
+        script = sys.stdin if args.script == "-" else open(args.script)
+        report_file = sys.stderr if args.report is None else open(args.report, "w")
+        try:
+            run_script(script, report_file)
+        finally:
+            if script is not sys.stdin:
+                script.close()
+            if report_file is not sys.stderr:
+                report_file.close()
+    else:
+        # start command line
+        print()
+        print("Welcome to the COVID-19 Vaccine Reservation Scheduling Application!")
 
-    start()
+        start()
@@ -0,0 +1,426 @@
+"""
+HTTP/JSON API for the scheduler, for front desks that script it.
+
+    python Server.py [--host 127.0.0.1] [--port 8080] [--workers 10]
+
+Each Scheduler.py command is an endpoint that takes its arguments as a JSON
+object (POST) or a query string (GET) and answers {"ok", "message", "data"}.
+Dates are mm-dd-yyyy on the way in and yyyy-mm-dd on the way out; times of
+day are hh:mm both ways.
+
+    POST /create_patient             {"username", "password"}
+    POST /create_caregiver           {"username", "password"}
+    POST /login_patient              {"username", "password"}  -> data.token
+    POST /login_caregiver            {"username", "password"}  -> data.token
+    POST /logout
+    GET  /search_caregiver_schedule  ?date= or ?from=&to=
+    POST /reserve                    {"date", "vaccine", "time"}
+    POST /upload_availability        {"dates": [...]} or {"from", "to", "weekdays"}, and "hours", "slot"
+    POST /join_waitlist              {"date", "vaccine"} or {"from", "to", "vaccine"}
+    POST /leave_waitlist             {"vaccine"}
+    POST /cancel                     {"id"}
+    POST /cancel_day                 {"date"}
+    POST /add_doses                  {"vaccine", "doses", "lot", "expires"}
+    GET  /show_doses                 ?vaccine=
+    GET  /report                     ?date= or ?from=&to=
+    GET  /show_appointments          ?after=&limit=&from=&to=&upcoming=1
+
+Calls that free up doses or slots book waitlisted patients into them; those
+bookings come back as "promoted", a list of appointments.
+
+Logging in opens a session; later calls send its token as
+"Authorization: Bearer <token>" until /logout or SessionTTL idle seconds.
+Connections are kept alive. Requests are parsed on one event loop and their
+database and hashing work runs on a pool of --workers threads. When no
+database connection can be had the call answers 503 and can be retried.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import traceback
+from urllib.parse import urlsplit, parse_qsl
+
+from util.Util import Util
+from util.HashService import get_hash_service
+from db.ConnectionManager import ConnectionUnavailable
+from service.SchedulerService import SchedulerService, Result
+from service.Session import Session, get_session_registry
+
+
+# seconds an idle keep-alive connection is held open
+KEEP_ALIVE_TIMEOUT = 15
+
+MAX_BODY = 1 << 20
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class MissingParameter(Exception):
+    """
+    A request left out a parameter its endpoint needs; dispatch answers 400.
+    """
+
+
+def param(params, name):
+    if name not in params:
+        raise MissingParameter(name)
+    return params[name]
+
+
+def date_param(params, name):
+    return Util.parse_date(str(param(params, name)))
+
+
+# a whole number >= 0, sent as a JSON number or a string of digits
+def int_param(params, name):
+    value = param(params, name)
+    if isinstance(value, str):
+        if not value.isdigit():
+            raise ValueError("Please try again!")
+        return int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError("Please try again!")
+    return value
+
+
+def iso(d):
+    return d.isoformat()
+
+
+async def create_patient(service, session, params):
+    return await service.create_patient(session, param(params, "username"), param(params, "password"))
+
+
+async def create_caregiver(service, session, params):
+    return await service.create_caregiver(session, param(params, "username"), param(params, "password"))
+
+
+async def login_patient(service, session, params):
+    return await service.login_patient(session, param(params, "username"), param(params, "password"))
+
+
+async def login_caregiver(service, session, params):
+    return await service.login_caregiver(session, param(params, "username"), param(params, "password"))
+
+
+async def logout(service, session, params):
+    return await service.logout(session)
+
+
+async def search_caregiver_schedule(service, session, params):
+    first = date_param(params, "date" if "date" in params else "from")
+    last = date_param(params, "date" if "date" in params else "to")
+    if last < first:
+        return Result(False, "Please try again!")
+    result = await service.search_caregiver_schedule(session, first, last)
+    if result.ok:
+        result.data = {
+            "days": [{"date": iso(d),
+                      "slots": [{"time": Util.format_time(slot), "caregivers": caregivers} for slot, caregivers in slots]}
+                     for d, slots in result.data["days"]],
+            "vaccines": [{"name": name, "doses": doses} for name, doses in result.data["vaccines"]],
+        }
+    return result
+
+
+async def reserve(service, session, params):
+    slot = Util.parse_time(str(params["time"])) if "time" in params else None
+    result = await service.reserve(session, date_param(params, "date"), param(params, "vaccine"), slot=slot)
+    if result.ok:
+        result.data = appointment_data(result.data)
+    return result
+
+
+async def upload_availability(service, session, params):
+    if "dates" in params:
+        dates = [Util.parse_date(str(d)) for d in params["dates"]]
+    else:
+        dates = Util.date_range(date_param(params, "from"), date_param(params, "to"), params.get("weekdays"))
+    slots = Util.day_slots(params.get("hours"), int_param(params, "slot") if "slot" in params else None)
+    result = await service.upload_availability(session, dates, slots)
+    if result.ok:
+        result.data["duplicates"] = [iso(d) for d in result.data["duplicates"]]
+    return result
+
+
+async def join_waitlist(service, session, params):
+    first = date_param(params, "date" if "date" in params else "from")
+    last = date_param(params, "date" if "date" in params else "to")
+    if last < first:
+        return Result(False, "Please enter a valid date range!")
+    result = await service.join_waitlist(session, first, last, param(params, "vaccine"))
+    if result.ok:
+        result.data = {"id": result.data.waitlist_id, "position": result.data.position}
+    return result
+
+
+async def leave_waitlist(service, session, params):
+    return await service.leave_waitlist(session, param(params, "vaccine"))
+
+
+async def cancel(service, session, params):
+    result = await service.cancel(session, int_param(params, "id"))
+    if result.ok:
+        result.data = appointment_data(result.data)
+    return result
+
+
+async def cancel_day(service, session, params):
+    result = await service.cancel_day(session, date_param(params, "date"))
+    if result.ok:
+        result.data = [appointment_data(appointment) for appointment in result.data]
+    return result
+
+
+async def add_doses(service, session, params):
+    expires = date_param(params, "expires") if params.get("expires") else None
+    return await service.add_doses(session, param(params, "vaccine"), int_param(params, "doses"), params.get("lot") or None, expires)
+
+
+async def show_doses(service, session, params):
+    result = await service.dose_history(session, param(params, "vaccine"))
+    if result.ok:
+        lots, entries = result.data
+        result.data = {
+            "lots": [{"lot": lot, "expires": None if expires is None else iso(expires), "doses": doses}
+                     for lot, expires, doses in lots],
+            "ledger": [{"id": entry_id, "lot": lot, "kind": kind, "doses": doses, "appointment": appointment_id,
+                        "recorded": str(recorded)}
+                       for entry_id, lot, kind, doses, appointment_id, recorded in entries],
+        }
+    return result
+
+
+async def show_appointments(service, session, params):
+    filters = {}
+    for name in ("after", "limit"):
+        if name in params:
+            filters[name] = int_param(params, name)
+    for name in ("from", "to"):
+        if name in params:
+            filters[name] = date_param(params, name)
+    if params.get("upcoming") not in (None, "", "0", False):
+        filters["from"] = max(filters.get("from", datetime.date.min), datetime.date.today())
+    result = await service.show_appointments(session, filters)
+    if result.ok:
+        result.data = [{"id": row[0], "vaccine": row[1], "date": iso(row[2]), "time": Util.format_time(row[3]), "with": row[4]}
+                       for row in result.data]
+    return result
+
+
+async def report(service, session, params):
+    first = date_param(params, "date" if "date" in params else "from")
+    last = date_param(params, "date" if "date" in params else "to")
+    result = await service.report(session, first, last)
+    if result.ok:
+        summary = result.data
+        result.data = {
+            "appointments": summary.get_appointments(),
+            "open_slots": summary.get_open_slots(),
+            "days": [{"date": iso(d), "appointments": appointments, "open_slots": open_slots}
+                     for d, appointments, open_slots in summary.days],
+            "vaccines": [{"vaccine": vaccine, "appointments": appointments} for vaccine, appointments in summary.vaccines],
+            "caregivers": [{"caregiver": caregiver, "appointments": appointments, "open_slots": open_slots}
+                           for caregiver, appointments, open_slots in summary.caregivers],
+        }
+    return result
+
+
+def appointment_data(appointment):
+    return {"id": appointment.appointment_id, "date": None if appointment.time is None else iso(appointment.time),
+            "time": None if appointment.slot is None else Util.format_time(appointment.slot),
+            "patient": appointment.patient, "caregiver": appointment.caregiver, "vaccine": appointment.vaccine}
+
+
+# endpoint -> (handler, whether it needs a logged-in session)
+ENDPOINTS = {
+    "create_patient": (create_patient, False),
+    "create_caregiver": (create_caregiver, False),
+    "login_patient": (login_patient, False),
+    "login_caregiver": (login_caregiver, False),
+    "logout": (logout, True),
+    "search_caregiver_schedule": (search_caregiver_schedule, True),
+    "reserve": (reserve, True),
+    "upload_availability": (upload_availability, True),
+    "join_waitlist": (join_waitlist, True),
+    "leave_waitlist": (leave_waitlist, True),
+    "cancel": (cancel, True),
+    "cancel_day": (cancel_day, True),
+    "add_doses": (add_doses, True),
+    "show_doses": (show_doses, True),
+    "show_appointments": (show_appointments, True),
+    "report": (report, True),
+}
+
+LOGINS = ("login_patient", "login_caregiver")
+
+
+class SchedulerServer:
+    """
+    Serves ENDPOINTS over HTTP/1.1 from a single asyncio event loop.
+    """
+
+    def __init__(self, service=None, registry=None):
+        self.service = SchedulerService() if service is None else service
+        self.registry = get_session_registry() if registry is None else registry
+        self.requests = 0
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        sweeper = asyncio.ensure_future(self.sweep_sessions())
+        print("Serving on", ", ".join("http://%s:%d" % sock.getsockname()[:2] for sock in server.sockets), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+
+    async def sweep_sessions(self):
+        while True:
+            await asyncio.sleep(max(1.0, min(60.0, self.registry.ttl / 2)))
+            self.registry.sweep()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers = await self.read_headers(reader)
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    await self.respond(writer, 400, Result(False, "Malformed request"), False)
+                    break
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, Result(False, "Request body too large"), False)
+                    break
+                body = await reader.readexactly(length)
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                status, result = await self.dispatch(method, target, headers, body)
+                await self.respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_headers(reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, separator, value = line.decode("latin-1").partition(":")
+            if not separator:
+                raise ValueError("malformed header")
+            headers[name.strip().lower()] = value.strip()
+
+    async def dispatch(self, method, target, headers, body):
+        self.requests += 1
+        url = urlsplit(target)
+        endpoint = ENDPOINTS.get(url.path.strip("/"))
+        if endpoint is None:
+            return 404, Result(False, "Invalid operation name!")
+        if method not in ("GET", "POST"):
+            return 405, Result(False, "Use GET or POST")
+        handler, needs_login = endpoint
+
+        params = dict(parse_qsl(url.query))
+        if body:
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                return 400, Result(False, "Request body must be JSON")
+            if not isinstance(payload, dict):
+                return 400, Result(False, "Request body must be a JSON object")
+            params.update(payload)
+
+        token = headers.get("authorization", "")
+        token = token[len("Bearer "):] if token.startswith("Bearer ") else None
+        session = None if token is None else self.registry.get(token)
+        if needs_login and session is None:
+            return 401, Result(False, "Please login first!")
+
+        new_session = None
+        if session is None:
+            if url.path.strip("/") in LOGINS:
+                session = new_session = self.registry.create()
+            else:
+                session = Session()
+
+        try:
+            result = await handler(self.service, session, params)
+        except MissingParameter as e:
+            result = Result(False, "Missing parameter: " + str(e))
+        except (ValueError, TypeError) as e:
+            result = Result(False, str(e) or "Please try again!")
+        except Exception as e:
+            result = Result(False, "Please try again!", error=e)
+            return (503 if isinstance(e, ConnectionUnavailable) else 500), result
+        finally:
+            if new_session is not None and new_session.user is None:
+                self.registry.remove(new_session.token)
+
+        if result.ok and url.path.strip("/") in LOGINS:
+            result.data = {"token": session.token, "username": session.username, "role": session.role}
+        elif result.ok and url.path.strip("/") == "logout":
+            self.registry.remove(session.token)
+        elif isinstance(result.error, ConnectionUnavailable):
+            return 503, result
+        return (200 if result.ok else 400), result
+
+    @staticmethod
+    async def respond(writer, status, result, keep_alive):
+        payload = {"ok": result.ok, "message": result.message, "data": result.data}
+        if len(result.promoted) != 0:
+            payload["promoted"] = [appointment_data(appointment) for appointment in result.promoted]
+        if result.error is not None:
+            # driver and database errors can name tables or servers, so they stay in the server's log
+            error = result.error
+            print("%d error:" % status, file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        body = json.dumps(payload).encode("utf-8")
+        head = ("HTTP/1.1 %d %s\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: %s\r\n"
+                "\r\n") % (status, REASONS[status], len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP/JSON API for the vaccine scheduler")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PoolMaxSize", "10")),
+                        help="threads running database and hashing work (default: PoolMaxSize)")
+    args = parser.parse_args(argv)
+
+    server = SchedulerServer(SchedulerService(workers=args.workers))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.service.shutdown()
+        server.registry.close()
+        get_hash_service().shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Shows query plans and latencies for the show_appointments and availability
+lookups without and then with the secondary indexes as create.sql defines
+them (migrations 002 and 004 on an existing database).
+
+Run from src/main/scheduler with the usual Server/DBName/UserID/Password set:
+
+    python -m benchmark.IndexBenchmark [--appointments 1000000] [--runs 20] [--no-seed] [--cleanup]
+
+Seeded rows use a "bench_" prefix so they can be told apart (and removed with
+--cleanup) from real data.
+"""
+import argparse
+import sys
+import time
+
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager
+from model.Report import Report
+
+
+# the same definitions as create.sql; 002 alone would leave them without Slot
+CREATE_INDEXES = """
+    CREATE INDEX IX_Appointments_Patient ON Appointments (p_name, ID) INCLUDE (Time, Slot, c_name, v_name);
+    CREATE INDEX IX_Appointments_Caregiver ON Appointments (c_name, ID) INCLUDE (Time, Slot, p_name, v_name);
+"""
+
+# the statements show_appointments runs
+QUERIES = [
+    ("patient appointments", "SELECT ID, v_name, Time, Slot, c_name FROM Appointments WHERE p_name = %s ORDER BY ID", "bench_p7"),
+    ("caregiver appointments", "SELECT ID, v_name, Time, Slot, p_name FROM Appointments WHERE c_name = %s ORDER BY ID", "bench_c7"),
+    ("caregivers for a day", "select Slot, Username from Availabilities where Time=%s order by Slot, Username asc", "2022-03-01"),
+]
+
+SEED = """
+    SET NOCOUNT ON;
+    DECLARE @appointments int = %d, @patients int = %d, @caregivers int = %d;
+
+    INSERT INTO Vaccines (Name, Doses)
+        SELECT 'bench_vaccine', 0 WHERE NOT EXISTS (SELECT * FROM Vaccines WHERE Name = 'bench_vaccine');
+
+    WITH numbers AS (
+        SELECT TOP (@patients) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS n
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b
+    )
+    INSERT INTO Patient (Username, Salt, Hash)
+        SELECT 'bench_p' + CAST(n AS varchar(11)), 0x00, 0x00 FROM numbers
+        WHERE NOT EXISTS (SELECT * FROM Patient WHERE Username = 'bench_p' + CAST(n AS varchar(11)));
+
+    WITH numbers AS (
+        SELECT TOP (@caregivers) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS n
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b
+    )
+    INSERT INTO Caregivers (Username, Salt, Hash)
+        SELECT 'bench_c' + CAST(n AS varchar(11)), 0x00, 0x00 FROM numbers
+        WHERE NOT EXISTS (SELECT * FROM Caregivers WHERE Username = 'bench_c' + CAST(n AS varchar(11)));
+
+    WITH numbers AS (
+        SELECT TOP (@caregivers * 365) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS n
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b
+    )
+    INSERT INTO Availabilities (Time, Username)
+        SELECT DATEADD(day, n / @caregivers, '2022-01-01'), 'bench_c' + CAST(n %% @caregivers AS varchar(11))
+        FROM numbers
+        WHERE NOT EXISTS (SELECT * FROM Availabilities WHERE Username LIKE 'bench_c%%');
+
+    WITH numbers AS (
+        SELECT TOP (@appointments) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS n
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b CROSS JOIN sys.all_objects c
+    )
+    INSERT INTO Appointments (Time, p_name, c_name, v_name)
+        SELECT DATEADD(day, n %% 365, '2022-01-01'),
+               'bench_p' + CAST(n %% @patients AS varchar(11)),
+               'bench_c' + CAST(n %% @caregivers AS varchar(11)),
+               'bench_vaccine'
+        FROM numbers;
+"""
+
+CLEANUP = """
+    SET NOCOUNT ON;
+    DELETE FROM DailyVaccineUsage WHERE v_name = 'bench_vaccine';
+    DELETE FROM DailyCaregiverUsage WHERE c_name LIKE 'bench_c%';
+    DELETE FROM Appointments WHERE v_name = 'bench_vaccine';
+    DELETE FROM Availabilities WHERE Username LIKE 'bench_c%';
+    DELETE FROM Caregivers WHERE Username LIKE 'bench_c%';
+    DELETE FROM Patient WHERE Username LIKE 'bench_p%';
+    DELETE FROM Vaccines WHERE Name = 'bench_vaccine';
+"""
+
+DROP_INDEXES = """
+    DROP INDEX IF EXISTS IX_Appointments_Patient ON Appointments;
+    DROP INDEX IF EXISTS IX_Appointments_Caregiver ON Appointments;
+"""
+
+
+def show_plans(cursor):
+    for name, query, param in QUERIES:
+        cursor.execute("SET SHOWPLAN_TEXT ON")
+        cursor.execute(query, param)
+        cursor.fetchall()  # the first result set echoes the statement
+        cursor.nextset()
+        print("--", name)
+        for row in cursor.fetchall():
+            print("  ", row[0].strip())
+        cursor.execute("SET SHOWPLAN_TEXT OFF")
+
+
+def time_queries(cursor, runs):
+    results = {}
+    for name, query, param in QUERIES:
+        cursor.execute(query, param)
+        cursor.fetchall()  # warm the plan and buffer caches
+        started = time.perf_counter()
+        for _ in range(runs):
+            cursor.execute(query, param)
+            rows = len(cursor.fetchall())
+        elapsed = (time.perf_counter() - started) / runs
+        results[name] = elapsed
+        print("%-24s %8.2f ms  (%d rows)" % (name, elapsed * 1000, rows))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Appointments/Availabilities indexes")
+    parser.add_argument("--appointments", type=int, default=1000000)
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--caregivers", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--no-seed", action="store_true", help="reuse previously seeded bench_ rows")
+    parser.add_argument("--cleanup", action="store_true", help="remove the bench_ rows and exit")
+    args = parser.parse_args(argv)
+
+    # a dedicated connection: SHOWPLAN and autocommit must not leak into the pool
+    conn = ConnectionManager().connect()
+    conn.autocommit(True)
+    cursor = conn.cursor()
+    try:
+        if args.cleanup:
+            cursor.execute(CLEANUP)
+            print("Removed benchmark rows")
+            return
+
+        if not args.no_seed:
+            print("Seeding %d appointments..." % args.appointments)
+            cursor.execute(SEED % (args.appointments, args.patients, args.caregivers))
+            # the seed bypasses the model methods, so the report summaries are recomputed
+            Report.rebuild()
+
+        print()
+        print("=== without secondary indexes ===")
+        cursor.execute(DROP_INDEXES)
+        show_plans(cursor)
+        before = time_queries(cursor, args.runs)
+
+        print()
+        print("=== with secondary indexes ===")
+        cursor.execute(CREATE_INDEXES)
+        show_plans(cursor)
+        after = time_queries(cursor, args.runs)
+
+        print()
+        for name, _, _ in QUERIES:
+            print("%-24s %6.1fx faster" % (name, before[name] / after[name] if after[name] else float("inf")))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Replays a front-desk mix of reserve, search_caregiver_schedule and
+show_appointments calls against the HTTP API (Server.py) and reports latency
+percentiles and throughput.
+
+Run from src/main/scheduler:
+
+    python -m benchmark.LoadTest [--clients 16] [--duration 20] [--mix reserve=1,search=5,show=4]
+
+Without --url it starts its own server on a fresh SQLite database file, seeds
+--caregivers caregivers free on each of --days days, --patients patients and
+enough doses for every slot, then lets --clients keep-alive clients (each
+logged in as a patient) send requests back to back for --duration seconds.
+With --url it seeds and loads that server instead; seeded accounts use a
+"load_" prefix.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+PASSWORD = "Load-test1!"
+
+FIRST_DAY = datetime.date(2022, 3, 1)
+
+VACCINE = "load_vaccine"
+
+
+class Client:
+    """
+    One keep-alive connection to the API, with the session token once logged in.
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.token = None
+
+    def call(self, method, endpoint, params=None):
+        headers = {}
+        if self.token is not None:
+            headers["Authorization"] = "Bearer " + self.token
+        body = None
+        if method == "GET" and params:
+            endpoint += "?" + "&".join("%s=%s" % item for item in params.items())
+        elif params is not None:
+            body = json.dumps(params)
+            headers["Content-Type"] = "application/json"
+        self.conn.request(method, "/" + endpoint, body=body, headers=headers)
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def login(self, kind, username):
+        status, payload = self.call("POST", "login_" + kind, {"username": username, "password": PASSWORD})
+        if status != 200:
+            raise RuntimeError("could not log in as %s: %s" % (username, payload["message"]))
+        self.token = payload["data"]["token"]
+
+    def close(self):
+        self.conn.close()
+
+
+def day(n):
+    return (FIRST_DAY + datetime.timedelta(days=n)).strftime("%m-%d-%Y")
+
+
+def seed(url, caregivers, patients, days):
+    client = Client(url)
+    try:
+        for i in range(caregivers):
+            client.call("POST", "create_caregiver", {"username": "load_c%d" % i, "password": PASSWORD})
+            client.login("caregiver", "load_c%d" % i)
+            client.call("POST", "upload_availability", {"from": day(0), "to": day(days - 1)})
+            if i == 0:
+                client.call("POST", "add_doses", {"vaccine": VACCINE, "doses": caregivers * days})
+            client.call("POST", "logout")
+            client.token = None
+        for i in range(patients):
+            client.call("POST", "create_patient", {"username": "load_p%d" % i, "password": PASSWORD})
+    finally:
+        client.close()
+
+
+def run_client(url, patient, days, mix, deadline, latencies, outcomes, lock):
+    operations = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    client = Client(url)
+    try:
+        client.login("patient", patient)
+        while time.perf_counter() < deadline:
+            operation = random.choices(operations, weights)[0]
+            if operation == "reserve":
+                request = ("POST", "reserve", {"date": day(random.randrange(days)), "vaccine": VACCINE})
+            elif operation == "search":
+                first = random.randrange(days)
+                request = ("GET", "search_caregiver_schedule", {"from": day(first), "to": day(min(days - 1, first + 6))})
+            else:
+                request = ("GET", "show_appointments", {"limit": 20})
+            started = time.perf_counter()
+            try:
+                status, _ = client.call(*request)
+                outcome = "ok" if status == 200 else "failed" if status < 500 else "error"
+            except (OSError, http.client.HTTPException, ValueError):
+                outcome = "error"
+                client.close()
+                client = Client(url)
+                client.login("patient", patient)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[operation].append(elapsed)
+                outcomes[operation][outcome] += 1
+    finally:
+        client.close()
+
+
+def percentile(samples, q):
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def report(latencies, outcomes, elapsed):
+    print("%-8s %8s %6s %6s %6s %9s %9s %9s %9s" % ("op", "requests", "ok", "failed", "error", "p50 ms", "p99 ms", "max ms", "req/s"))
+    everything = []
+    for operation, samples in latencies.items():
+        everything.extend(samples)
+        counts = outcomes[operation]
+        print("%-8s %8d %6d %6d %6d %9.2f %9.2f %9.2f %9.1f" % (
+            operation, len(samples), counts["ok"], counts["failed"], counts["error"],
+            percentile(samples, 0.50) * 1000, percentile(samples, 0.99) * 1000,
+            max(samples, default=0.0) * 1000, len(samples) / elapsed))
+    print("%-8s %8d %6s %6s %6s %9.2f %9.2f %9.2f %9.1f" % (
+        "total", len(everything), "", "", "",
+        percentile(everything, 0.50) * 1000, percentile(everything, 0.99) * 1000,
+        max(everything, default=0.0) * 1000, len(everything) / elapsed))
+    print("  (failed = the API said no, e.g. no caregiver left that day; error = HTTP 5xx or a dropped connection)")
+
+
+def start_server(workers):
+    # a fresh SQLite database file, so each run starts from the same state
+    directory = tempfile.mkdtemp(prefix="scheduler-load-")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, DBBackend="sqlite", SQLiteDatabase=os.path.join(directory, "scheduler.db"))
+    command = [sys.executable, "Server.py", "--port", str(port)]
+    if workers is not None:
+        command += ["--workers", str(workers)]
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, "http://127.0.0.1:%d" % port
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("the server did not start")
+            time.sleep(0.1)
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ("reserve", "search", "show"):
+            raise argparse.ArgumentTypeError("unknown operation " + repr(name))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the scheduler's HTTP API")
+    parser.add_argument("--url", help="API to load (default: start a local server on SQLite)")
+    parser.add_argument("--workers", type=int, help="--workers for the local server")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("reserve=1,search=5,show=4"))
+    parser.add_argument("--caregivers", type=int, default=10)
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--no-seed", action="store_true", help="the accounts and doses already exist")
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_server(args.workers)
+    try:
+        if not args.no_seed:
+            started = time.perf_counter()
+            seed(url, args.caregivers, args.patients, args.days)
+            print("Seeded %d caregivers, %d patients and %d days in %.1fs"
+                  % (args.caregivers, args.patients, args.days, time.perf_counter() - started))
+
+        latencies = {name: [] for name, _ in args.mix}
+        outcomes = {name: {"ok": 0, "failed": 0, "error": 0} for name, _ in args.mix}
+        lock = threading.Lock()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        clients = [threading.Thread(target=run_client,
+                                    args=(url, "load_p%d" % (i % args.patients), args.days, args.mix,
+                                          deadline, latencies, outcomes, lock))
+                   for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        print("%d clients for %.1fs against %s" % (args.clients, args.duration, url))
+        report(latencies, outcomes, time.perf_counter() - started)
+    finally:
+        if server is not None:
+            # SIGINT lets the server shut its worker pools down
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
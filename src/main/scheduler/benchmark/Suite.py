@@ -0,0 +1,453 @@
+"""
+End-to-end benchmarks for every Scheduler command and the model methods
+behind them, at increasing concurrency.
+
+Run from src/main/scheduler:
+
+    python -m benchmark.Suite [--concurrency 1,4,16] [--iterations 200] [--cases reserve,Vaccine.]
+                              [--caregivers 20] [--patients 50] [--days 60] [--vaccines 3]
+                              [--appointments 1000] [--output benchmark.json]
+    python -m benchmark.Suite --compare before.json after.json
+
+It runs against DBBackend, which defaults to a fresh in-memory SQLite database
+here. It seeds the dataset and logs a patient and a caregiver session in for
+each worker thread. Then, at every concurrency level, it runs each case
+--iterations times, spread over that many threads. For each (case, concurrency)
+the JSON report records a latency histogram and percentiles, throughput,
+database round trips per call (statements, commits and rollbacks, from the
+ConnectionManager instrumentation) and rows read per call, so two runs can be
+diffed with --compare.
+
+Cases that use up data clean up after themselves outside the timed part: each
+reserve is cancelled and each join_waitlist entry is removed. Cases that create
+data (accounts, vaccines, availability, cancel_day's booked day) use fresh names
+or dates every call.
+"""
+import os
+
+# a local database unless told otherwise; must be set before the db modules load
+os.environ.setdefault("DBBackend", "sqlite")
+
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+import Scheduler
+from model.Vaccine import Vaccine, vaccine_catalog
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Appointment import Appointment
+from model.Waitlist import Waitlist
+from model.Report import Report
+from service.Session import Session
+from util.Util import Util
+from db.Backend import get_backend
+from db.ConnectionManager import ConnectionManager
+from db.Instrumentation import get_instrumentation
+
+
+PASSWORD = "Bench-mark1!"
+
+FIRST_DAY = datetime.date(2022, 3, 1)
+
+# upper bounds of the latency histogram buckets, in milliseconds; the last bucket is unbounded
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+# fresh names and dates for cases that create rows
+serial = itertools.count()
+
+
+class Worker:
+    """
+    What one benchmark thread works as: a logged-in patient and caregiver.
+    """
+
+    def __init__(self, index, dataset):
+        self.index = index
+        self.dataset = dataset
+        self.random = random.Random(index)
+        self.patient = Patient("bench_p%d" % (index % dataset["patients"]), password=PASSWORD).get()
+        self.caregiver = Caregiver("bench_c%d" % (index % dataset["caregivers"]), password=PASSWORD).get()
+        self.patient_session = Session()
+        self.patient_session.login(self.patient)
+        self.caregiver_session = Session()
+        self.caregiver_session.login(self.caregiver)
+
+    def day(self):
+        return FIRST_DAY + datetime.timedelta(days=self.random.randrange(self.dataset["days"]))
+
+    def vaccine(self):
+        return "bench_v%d" % self.random.randrange(self.dataset["vaccines"])
+
+    def book(self):
+        return Appointment(self.day(), self.patient.username, self.vaccine()).reserve()
+
+
+def fresh_day():
+    # a day after the seeded range that no caregiver has uploaded yet
+    return FIRST_DAY + datetime.timedelta(days=1000 + next(serial))
+
+
+def mmddyyyy(d):
+    return d.strftime("%m-%d-%Y")
+
+
+def command(session, *tokens):
+    return Scheduler.run_command(session, list(tokens))
+
+
+def cancel_booking(worker, args, result):
+    appointment = result if isinstance(result, Appointment) else None
+    if appointment is None and result is not None and result.ok and isinstance(result.data, Appointment):
+        appointment = result.data
+    if appointment is not None:
+        Appointment(None, None, None, appointment_id=appointment.appointment_id).cancel()
+
+
+def leave_waitlist(worker, args, result):
+    Waitlist(worker.patient.username, args[1]).leave()
+
+
+def logged_in(user):
+    session = Session()
+    session.login(user)
+    return session
+
+
+def booked(worker):
+    appointment = worker.book()
+    return (appointment.appointment_id,)
+
+
+def booked_day(worker):
+    # opens a fresh day for this worker's caregiver alone and books one appointment
+    # in it the way reserve does, dose and all, so cancel_day has something to cancel
+    d = fresh_day()
+    worker.caregiver.upload_availabilities([d])
+    Appointment(d, worker.patient.username, worker.vaccine()).reserve()
+    return (d,)
+
+
+class Case:
+
+    def __init__(self, name, kind, run, prepare=None, cleanup=None):
+        self.name = name
+        self.kind = kind
+        self.run = run
+        self.prepare = prepare if prepare is not None else lambda worker: ()
+        self.cleanup = cleanup
+
+
+CASES = [
+    # Scheduler commands, through the same handlers the CLI uses
+    Case("create_patient", "command",
+         lambda w, name: command(Session(), "create_patient", name, PASSWORD),
+         prepare=lambda w: ("bench_new_p%d" % next(serial),)),
+    Case("create_caregiver", "command",
+         lambda w, name: command(Session(), "create_caregiver", name, PASSWORD),
+         prepare=lambda w: ("bench_new_c%d" % next(serial),)),
+    Case("login_patient", "command",
+         lambda w: command(Session(), "login_patient", w.patient.username, PASSWORD)),
+    Case("login_caregiver", "command",
+         lambda w: command(Session(), "login_caregiver", w.caregiver.username, PASSWORD)),
+    Case("logout", "command",
+         lambda w, session: command(session, "logout"),
+         prepare=lambda w: (logged_in(w.patient),)),
+    Case("search_caregiver_schedule", "command",
+         lambda w, d: command(w.patient_session, "search_caregiver_schedule", mmddyyyy(d)),
+         prepare=lambda w: (w.day(),)),
+    Case("search_caregiver_schedule (7 days)", "command",
+         lambda w, d: command(w.patient_session, "search_caregiver_schedule", mmddyyyy(d), mmddyyyy(d + datetime.timedelta(days=6))),
+         prepare=lambda w: (w.day(),)),
+    Case("reserve", "command",
+         lambda w, d, vaccine: command(w.patient_session, "reserve", mmddyyyy(d), vaccine),
+         prepare=lambda w: (w.day(), w.vaccine()), cleanup=cancel_booking),
+    Case("upload_availability", "command",
+         lambda w, d: command(w.caregiver_session, "upload_availability", mmddyyyy(d)),
+         prepare=lambda w: (fresh_day(),)),
+    Case("join_waitlist", "command",
+         lambda w, d, vaccine: command(w.patient_session, "join_waitlist", mmddyyyy(d), vaccine),
+         prepare=lambda w: (fresh_day(), w.vaccine()), cleanup=leave_waitlist),
+    Case("cancel", "command",
+         lambda w, appointment_id: command(w.patient_session, "cancel", str(appointment_id)),
+         prepare=booked),
+    Case("cancel_day", "command",
+         lambda w, d: command(w.caregiver_session, "cancel_day", mmddyyyy(d)),
+         prepare=booked_day),
+    Case("add_doses", "command",
+         lambda w, vaccine: command(w.caregiver_session, "add_doses", vaccine, "1"),
+         prepare=lambda w: (w.vaccine(),)),
+    Case("show_appointments", "command",
+         lambda w: command(w.patient_session, "show_appointments", "--limit", "20")),
+    Case("report (30 days)", "command",
+         lambda w, d: command(w.caregiver_session, "report", mmddyyyy(d), mmddyyyy(d + datetime.timedelta(days=29))),
+         prepare=lambda w: (w.day(),)),
+
+    # model methods
+    Case("Patient.get", "model", lambda w: Patient(w.patient.username, password=PASSWORD).get()),
+    Case("Caregiver.get", "model", lambda w: Caregiver(w.caregiver.username, password=PASSWORD).get()),
+    Case("Patient.save_to_db", "model",
+         lambda w, name: Patient(name, salt=w.patient.salt, hash=w.patient.hash).save_to_db(),
+         prepare=lambda w: ("bench_new_p%d" % next(serial),)),
+    Case("Caregiver.save_to_db", "model",
+         lambda w, name: Caregiver(name, salt=w.caregiver.salt, hash=w.caregiver.hash).save_to_db(),
+         prepare=lambda w: ("bench_new_c%d" % next(serial),)),
+    Case("Caregiver.upload_availabilities", "model",
+         lambda w, d: w.caregiver.upload_availabilities([d]),
+         prepare=lambda w: (fresh_day(),)),
+    Case("Vaccine.get", "model", lambda w, vaccine: Vaccine(vaccine, 0).get(), prepare=lambda w: (w.vaccine(),)),
+    Case("Vaccine.save_to_db", "model",
+         lambda w, name: Vaccine(name, 1).save_to_db(),
+         prepare=lambda w: ("bench_new_v%d" % next(serial),)),
+    Case("Vaccine.increase_available_doses", "model",
+         lambda w, vaccine: vaccine.increase_available_doses(1),
+         prepare=lambda w: (Vaccine(w.vaccine(), 0).get(),)),
+    Case("Vaccine.decrease_available_doses", "model",
+         lambda w, vaccine: vaccine.decrease_available_doses(1),
+         prepare=lambda w: (Vaccine(w.vaccine(), 0).get(),)),
+    Case("Vaccine.add_doses", "model", lambda w, vaccine: Vaccine(vaccine, 0).add_doses(1), prepare=lambda w: (w.vaccine(),)),
+    Case("vaccine_catalog.get_all", "model", lambda w: vaccine_catalog.get_all()),
+    Case("Appointment.reserve", "model",
+         lambda w, d, vaccine: Appointment(d, w.patient.username, vaccine).reserve(),
+         prepare=lambda w: (w.day(), w.vaccine()), cleanup=cancel_booking),
+    Case("Report.load", "model", lambda w, d: Report(d, d + datetime.timedelta(days=29)).load(), prepare=lambda w: (w.day(),)),
+    Case("Waitlist.promote", "model", lambda w, vaccine: Waitlist.promote([vaccine]), prepare=lambda w: (w.vaccine(),)),
+    Case("Appointment.cancel", "model",
+         lambda w, appointment_id: Appointment(None, None, None, appointment_id=appointment_id).cancel(),
+         prepare=booked),
+    Case("Appointment.cancel_day", "model",
+         lambda w, d: Appointment.cancel_day(d, w.caregiver.username),
+         prepare=booked_day),
+]
+
+
+def seed(dataset):
+    salt = Util.generate_salt()
+    hash = Util.generate_hash(PASSWORD, salt)
+    days = [FIRST_DAY + datetime.timedelta(days=n) for n in range(dataset["days"])]
+    caregivers = ["bench_c%d" % i for i in range(dataset["caregivers"])]
+    slots = [(d, caregiver) for d in days for caregiver in caregivers]
+    if dataset["appointments"] > len(slots) // 2:
+        raise ValueError("--appointments can be at most half of --caregivers x --days")
+    # seeded appointments take every other slot, spread over days and caregivers
+    taken = set(random.Random(0).sample(range(len(slots)), dataset["appointments"]))
+
+    cm = ConnectionManager()
+    conn = cm.create_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("INSERT INTO Caregivers VALUES (%s, %s, %s)", [(c, salt, hash) for c in caregivers])
+        cursor.executemany("INSERT INTO Patient VALUES (%s, %s, %s)",
+                           [("bench_p%d" % i, salt, hash) for i in range(dataset["patients"])])
+        vaccines = [("bench_v%d" % i, 10 ** 9) for i in range(dataset["vaccines"])]
+        cursor.executemany("INSERT INTO Vaccines VALUES (%s, %d)", vaccines)
+        # the stock sits in one unlotted lot, opened in the ledger like migration 006 does
+        cursor.executemany("INSERT INTO DoseLots (v_name, Lot, Doses) VALUES (%s, '', %d)", vaccines)
+        cursor.executemany("INSERT INTO DoseLedger (v_name, Lot, Kind, Doses) VALUES (%s, '', 'opening', %d)", vaccines)
+        cursor.executemany("INSERT INTO Availabilities (Time, Username) VALUES (%s, %s)",
+                           [slot for n, slot in enumerate(slots) if n not in taken])
+        cursor.executemany("INSERT INTO Appointments (Time, p_name, c_name, v_name) VALUES (%s, %s, %s, %s)",
+                           [(slots[n][0], "bench_p%d" % (k % dataset["patients"]), slots[n][1],
+                             "bench_v%d" % (k % dataset["vaccines"])) for k, n in enumerate(sorted(taken))])
+        conn.commit()
+    finally:
+        cm.close_connection()
+    # the rows above went in directly, so summarize them once
+    Report.rebuild()
+    vaccine_catalog.invalidate()
+
+
+def measure(case, workers, iterations):
+    concurrency = len(workers)
+    instrumentation = get_instrumentation()
+    latencies = []
+    round_trips = [0, 0, 0, 0]
+    errors = []
+    lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+
+    def work(worker, count):
+        mine = []
+        trips = [0, 0, 0, 0]
+        failures = []
+        start.wait()
+        for _ in range(count):
+            args = case.prepare(worker)
+            result = None
+            with instrumentation.scope() as scope:
+                started = time.perf_counter()
+                try:
+                    result = case.run(worker, *args)
+                except Exception as e:
+                    failures.append(repr(e))
+                elapsed = time.perf_counter() - started
+            mine.append(elapsed)
+            trips[0] += scope.statements
+            trips[1] += scope.commits
+            trips[2] += scope.rollbacks
+            trips[3] += scope.rows
+            if case.cleanup is not None:
+                case.cleanup(worker, args, result)
+        with lock:
+            latencies.extend(mine)
+            errors.extend(failures)
+            for i in range(4):
+                round_trips[i] += trips[i]
+
+    counts = [iterations // concurrency + (1 if i < iterations % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=work, args=(worker, count)) for worker, count in zip(workers, counts)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    calls = max(len(latencies), 1)
+    return {
+        "case": case.name,
+        "kind": case.kind,
+        "concurrency": concurrency,
+        "calls": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "seconds": round(wall, 6),
+        "throughput": round(len(latencies) / wall, 3) if wall > 0 else None,
+        "latency_ms": summarize(latencies),
+        "histogram_ms": histogram(latencies),
+        "round_trips_per_call": {
+            "statements": round(round_trips[0] / calls, 3),
+            "commits": round(round_trips[1] / calls, 3),
+            "rollbacks": round(round_trips[2] / calls, 3),
+        },
+        "rows_per_call": round(round_trips[3] / calls, 3),
+    }
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(latencies):
+    if len(latencies) == 0:
+        return None
+    ordered = sorted(latency * 1000 for latency in latencies)
+    return {
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": round(percentile(ordered, 0.50), 4),
+        "p90": round(percentile(ordered, 0.90), 4),
+        "p99": round(percentile(ordered, 0.99), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def histogram(latencies):
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        counts[next((i for i, bound in enumerate(BUCKETS) if ms <= bound), len(BUCKETS))] += 1
+    return {"le": BUCKETS + ["inf"], "counts": counts}
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {(r["case"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+
+    def change(old, new):
+        if not old or new is None:
+            return "      -"
+        return "%+6.1f%%" % ((new - old) / old * 100)
+
+    print("%-40s %4s %10s %8s %10s %8s %10s %8s %9s" % (
+        "case", "conc", "p50 ms", "", "p99 ms", "", "calls/s", "", "stmts"))
+    for result in after:
+        old = before.get((result["case"], result["concurrency"]))
+        if old is None or result["latency_ms"] is None or old["latency_ms"] is None:
+            continue
+        print("%-40s %4d %10.3f %8s %10.3f %8s %10.1f %8s %4.1f>%4.1f" % (
+            result["case"], result["concurrency"],
+            result["latency_ms"]["p50"], change(old["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            result["latency_ms"]["p99"], change(old["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+            result["throughput"], change(old["throughput"], result["throughput"]),
+            old["round_trips_per_call"]["statements"], result["round_trips_per_call"]["statements"]))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every scheduler command and model method")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated thread counts")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per case and concurrency level")
+    parser.add_argument("--cases", help="comma-separated substrings; run only the cases whose name contains one")
+    parser.add_argument("--caregivers", type=int, default=20)
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--vaccines", type=int, default=3)
+    parser.add_argument("--appointments", type=int, default=200)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="diff two reports and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    cases = CASES
+    if args.cases:
+        patterns = args.cases.split(",")
+        cases = [case for case in CASES if any(pattern in case.name for pattern in patterns)]
+    dataset = {"caregivers": args.caregivers, "patients": args.patients, "days": args.days,
+               "vaccines": args.vaccines, "appointments": args.appointments}
+
+    backend = get_backend()
+    # round trips are counted on connections opened from here on
+    get_instrumentation().enabled = True
+    seed(dataset)
+    workers = [Worker(i, dataset) for i in range(max(levels))]
+
+    results = []
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        for case in cases:
+            for level in levels:
+                # commands print as they would in the CLI; keep that off the report
+                sys.stdout = devnull
+                try:
+                    result = measure(case, workers[:level], args.iterations)
+                finally:
+                    sys.stdout = stdout
+                results.append(result)
+                latency = result["latency_ms"] or {"p50": 0, "p99": 0}
+                print("%-40s x%-3d %8.3f ms p50 %8.3f ms p99 %9.1f calls/s %5.1f stmts %s" % (
+                    case.name, level, latency["p50"], latency["p99"], result["throughput"] or 0,
+                    result["round_trips_per_call"]["statements"],
+                    "" if result["errors"] == 0 else "(%d errors)" % result["errors"]), flush=True)
+
+    report = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "backend": backend.name,
+        "python": platform.python_version(),
+        "dataset": dataset,
+        "iterations": args.iterations,
+        "results": results,
+        "statements": get_instrumentation().stats()["statements"],
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Wrote", args.output)
+    for worker in workers:
+        worker.patient_session.close()
+        worker.caregiver_session.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
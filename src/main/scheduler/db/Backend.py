@@ -0,0 +1,47 @@
+import os
+import threading
+
+
+class Backend:
+    """
+    Where database connections come from.
+
+    A backend opens DB-API connections that follow the conventions the rest of
+    the scheduler is written against (pymssql's %s/%d parameters and
+    cursor(as_dict=True)), and names the exception class its driver raises.
+    """
+    name = None
+    Error = Exception
+
+    def connect(self):
+        raise NotImplementedError
+
+    # returns query, which must start with SELECT, limited to its first n rows
+    def limit(self, query, n):
+        raise NotImplementedError
+
+    # whether error only means the statement lost a race for locks (a deadlock
+    # or lock timeout), so running it again may well succeed
+    def retryable(self, error):
+        return False
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+# Returns the process-wide backend named by the DBBackend environment variable
+# ("mssql" by default, or "sqlite")
+def get_backend(name=None):
+    name = (name or os.getenv("DBBackend", "mssql")).lower()
+    with _backends_lock:
+        if name not in _backends:
+            if name == "mssql":
+                from db.MSSQLBackend import MSSQLBackend
+                _backends[name] = MSSQLBackend()
+            elif name == "sqlite":
+                from db.SQLiteBackend import SQLiteBackend
+                _backends[name] = SQLiteBackend(os.getenv("SQLiteDatabase", ":memory:"))
+            else:
+                raise ValueError("Unknown database backend: " + name)
+        return _backends[name]
@@ -1,29 +1,278 @@
-import pymssql
+import atexit
 import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from db.Backend import get_backend
+from db.Instrumentation import get_instrumentation
+
+
+# exception raised by the configured backend's driver
+DatabaseError = get_backend().Error
+
+
+class ConnectionUnavailable(DatabaseError):
+    """
+    No connection could be had: the database refused the connect, or the pool
+    timed out waiting for a free connection. It is a DatabaseError, so callers
+    that already handle the driver's errors handle it too.
+    """
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of open database connections.
+
+    Connections are handed out by acquire() and given back by release(). Idle
+    connections older than idle_timeout are closed (down to min_size), and a
+    connection that has been idle longer than health_check_interval is pinged
+    before it is handed out again.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300.0,
+                 health_check_interval=30.0, timeout=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size!")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self._idle = deque()  # (connection, last time it was released)
+        self._size = 0  # idle + checked out
+        self._cond = threading.Condition()
+
+        # counters used to size the pool
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.health_check_failures = 0
+        self.expired = 0
+
+        for _ in range(min_size):
+            self._idle.append((self.connect(), time.monotonic()))
+            self._size += 1
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = None
+        with self._cond:
+            while True:
+                self._expire_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    self.hits += 1
+                    break
+                if self._size < self.max_size:
+                    # reserve the slot, then connect outside of the lock
+                    self._size += 1
+                    self.misses += 1
+                    conn, last_used = None, None
+                    break
+                if waited is None:
+                    waited = time.monotonic()
+                    self.waits += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.wait_time += time.monotonic() - waited
+                    raise ConnectionUnavailable("Timed out waiting for a database connection!")
+                self._cond.wait(remaining)
+            if waited is not None:
+                self.wait_time += time.monotonic() - waited
+
+        if conn is not None and time.monotonic() - last_used > self.health_check_interval:
+            if not self._is_healthy(conn):
+                with self._cond:
+                    self.health_check_failures += 1
+                self._discard(conn, keep_slot=True)
+                conn = None
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn):
+        try:
+            # drop whatever the caller left uncommitted before anyone else sees it
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        self._discard(conn)
+
+    def close(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "health_check_failures": self.health_check_failures,
+                "expired": self.expired,
+            }
+
+    def _expire_idle(self):
+        # called with the lock held; the oldest idle connections sit on the left
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self.expired += 1
+            self._close_quietly(conn)
+
+    def _discard(self, conn, keep_slot=False):
+        self._close_quietly(conn)
+        if not keep_slot:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 
 class ConnectionManager:
 
+    _pool = None
+    _pool_lock = threading.Lock()
+    _pinned = threading.local()
+
     def __init__(self):
-        self.server_name = os.getenv("Server") + ".database.windows.net"
-        self.db_name = os.getenv("DBName")
-        self.user = os.getenv("UserID")
-        self.password = os.getenv("Password")
+        self.backend = get_backend()
         self.conn = None
 
-    def create_connection(self):
+    def connect(self):
+        try:
+            conn = self.backend.connect()
+        except DatabaseError as db_err:
+            raise ConnectionUnavailable(str(db_err)) from db_err
+        instrumentation = get_instrumentation()
+        if instrumentation.enabled:
+            conn = instrumentation.wrap(conn)
+        return conn
+
+    @classmethod
+    def get_pool(cls):
+        # one pool per process, created on first use and sized from the environment
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = ConnectionPool(
+                        cls().connect,
+                        min_size=int(os.getenv("PoolMinSize", "1")),
+                        max_size=int(os.getenv("PoolMaxSize", "10")),
+                        idle_timeout=float(os.getenv("PoolIdleTimeout", "300")),
+                        health_check_interval=float(os.getenv("PoolHealthCheckInterval", "30")),
+                        timeout=float(os.getenv("PoolTimeout", "30")),
+                    )
+                    # DBMetricsFile gets the Prometheus text when the process exits
+                    metrics_file = os.getenv("DBMetricsFile")
+                    if metrics_file:
+                        atexit.register(cls.write_metrics, metrics_file)
+        return cls._pool
+
+    @classmethod
+    def metrics(cls):
+        # the instrumentation and pool counters in the Prometheus text format
+        pool = cls._pool
+        return get_instrumentation().prometheus(None if pool is None else pool.stats())
+
+    @classmethod
+    def write_metrics(cls, path):
+        with open(path, "w") as f:
+            f.write(cls.metrics())
+
+    @classmethod
+    def close_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is not None:
+                cls._pool.close()
+                cls._pool = None
+
+    @classmethod
+    @contextmanager
+    def pinned(cls, conn=None):
+        """
+        Hands the same pooled connection to every ConnectionManager created on
+        this thread inside the with block, e.g. for a whole batch run. Without
+        conn one is taken from the pool for the block; a given conn stays with
+        its owner.
+        """
+        pool = cls.get_pool()
+        owned = conn is None
+        if owned:
+            conn = pool.acquire()
+        previous = getattr(cls._pinned, "conn", None)
+        cls._pinned.conn = conn
         try:
-            self.conn = pymssql.connect(server=self.server_name, user=self.user, password=self.password, database=self.db_name)
-        except pymssql.Error as db_err:
-            print("Database Programming Error in SQL connection processing! ")
-            print(db_err)
-            quit()
+            yield conn
+        finally:
+            cls._pinned.conn = previous
+            if owned:
+                pool.release(conn)
+
+    def create_connection(self):
+        if self.conn is not None:
+            return self.conn
+        pinned = getattr(self._pinned, "conn", None)
+        if pinned is not None:
+            self.conn = pinned
+            return self.conn
+        self.conn = self.get_pool().acquire()
         return self.conn
 
     def close_connection(self):
-        try:
-            self.conn.close()
-        except pymssql.Error as db_err:
-            print("Database Programming Error in SQL connection processing! ")
-            print(db_err)
-            quit()
+        # hands the connection back to the pool; safe to call more than once
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if conn is getattr(self._pinned, "conn", None):
+            # the pinned() block gives it back
+            return
+        self.get_pool().release(conn)
+
+    def __enter__(self):
+        return self.create_connection()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
+        return False
@@ -0,0 +1,319 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class Scope:
+    """
+    What the database did on one thread between entering and leaving a scope,
+    e.g. for one command.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.statements = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.rows = 0
+        self.db_time = 0.0
+
+
+class Instrumentation:
+    """
+    Counts what the scheduler asks of the database: connections opened and
+    closed, every statement with its time and the rows read from it, commits
+    and rollbacks. scope(name) also totals these per command. Each command and
+    each statement slower than slow_query_ms is written to log as one JSON
+    object per line; without a log, slow statements still go to stderr.
+
+    Connections are wrapped when they are opened, so only connections opened
+    while enabled are counted. Totals are available from stats() or, in the
+    Prometheus text format, from prometheus(). Other modules can register()
+    counters of their own to be reported alongside.
+    """
+
+    def __init__(self, enabled=False, slow_query_ms=100.0, log=None):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.log = log
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.counters = {}  # name -> function returning {counter: value}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.opened = 0
+            self.closed = 0
+            self.commits = 0
+            self.rollbacks = 0
+            self.slow_queries = 0
+            self.statements = {}  # statement -> [calls, seconds, max seconds, rows]
+            self.commands = {}  # command -> [calls, seconds, statements, db seconds, rows, commits]
+
+    # reports the counters stats() returns as scheduler_<name>_<counter>_total, whether or not enabled
+    def register(self, name, stats):
+        with self._lock:
+            self.counters[name] = stats
+
+    def wrap(self, conn):
+        with self._lock:
+            self.opened += 1
+        return InstrumentedConnection(conn, self)
+
+    @contextmanager
+    def scope(self, name=None):
+        # totals this thread's database work in the block; named scopes are kept per command
+        scope = Scope(name)
+        stack = self._scopes()
+        stack.append(scope)
+        started = time.perf_counter()
+        try:
+            yield scope
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.remove(scope)
+            if name is not None and self.enabled:
+                with self._lock:
+                    totals = self.commands.setdefault(name, [0, 0.0, 0, 0.0, 0, 0])
+                    totals[0] += 1
+                    totals[1] += elapsed
+                    totals[2] += scope.statements
+                    totals[3] += scope.db_time
+                    totals[4] += scope.rows
+                    totals[5] += scope.commits
+                self.write({"event": "command", "command": name, "ms": round(elapsed * 1000, 3),
+                            "statements": scope.statements, "db_ms": round(scope.db_time * 1000, 3),
+                            "rows": scope.rows, "commits": scope.commits, "rollbacks": scope.rollbacks})
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            stats = {
+                "connections_opened": self.opened,
+                "connections_closed": self.closed,
+                "commits": self.commits,
+                "rollbacks": self.rollbacks,
+                "slow_queries": self.slow_queries,
+                "statements": {sql: {"calls": t[0], "seconds": t[1], "max_seconds": t[2], "rows": t[3]}
+                               for sql, t in self.statements.items()},
+                "commands": {name: {"calls": t[0], "seconds": t[1], "statements": t[2], "db_seconds": t[3],
+                                    "rows": t[4], "commits": t[5]}
+                             for name, t in self.commands.items()},
+            }
+        # outside the lock: the registered functions may take locks of their own
+        stats["counters"] = {name: counter_stats() for name, counter_stats in sorted(counters.items())}
+        return stats
+
+    # The totals in the Prometheus text exposition format; pool_stats adds the pool's counters
+    def prometheus(self, pool_stats=None):
+        stats = self.stats()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (k, escape(v)) for k, v in labels)
+                lines.append("%s%s %s" % (name, "{" + label_text + "}" if label_text else "", repr(float(value)) if isinstance(value, float) else value))
+
+        metric("scheduler_db_connections_opened_total", "counter", "Database connections opened.", [((), stats["connections_opened"])])
+        metric("scheduler_db_connections_closed_total", "counter", "Database connections closed.", [((), stats["connections_closed"])])
+        metric("scheduler_db_commits_total", "counter", "Transactions committed.", [((), stats["commits"])])
+        metric("scheduler_db_rollbacks_total", "counter", "Transactions rolled back.", [((), stats["rollbacks"])])
+        metric("scheduler_db_slow_queries_total", "counter", "Statements slower than the slow query threshold.", [((), stats["slow_queries"])])
+
+        statements = sorted(stats["statements"].items())
+        metric("scheduler_db_statement_calls_total", "counter", "Executions per statement.",
+               [((("statement", sql),), t["calls"]) for sql, t in statements])
+        metric("scheduler_db_statement_seconds_total", "counter", "Time spent executing each statement.",
+               [((("statement", sql),), t["seconds"]) for sql, t in statements])
+        metric("scheduler_db_statement_rows_total", "counter", "Rows read from each statement.",
+               [((("statement", sql),), t["rows"]) for sql, t in statements])
+
+        commands = sorted(stats["commands"].items())
+        metric("scheduler_command_calls_total", "counter", "Commands run.",
+               [((("command", name),), t["calls"]) for name, t in commands])
+        metric("scheduler_command_seconds_total", "counter", "Time spent running each command.",
+               [((("command", name),), t["seconds"]) for name, t in commands])
+        metric("scheduler_command_statements_total", "counter", "Statements executed by each command.",
+               [((("command", name),), t["statements"]) for name, t in commands])
+        metric("scheduler_command_db_seconds_total", "counter", "Time each command spent in statements.",
+               [((("command", name),), t["db_seconds"]) for name, t in commands])
+        metric("scheduler_command_rows_total", "counter", "Rows read by each command.",
+               [((("command", name),), t["rows"]) for name, t in commands])
+        metric("scheduler_command_commits_total", "counter", "Transactions committed by each command.",
+               [((("command", name),), t["commits"]) for name, t in commands])
+
+        for source, counters in stats["counters"].items():
+            for key, value in counters.items():
+                metric("scheduler_%s_%s_total" % (source, key), "counter", source.replace("_", " ").capitalize() + ": " + key.replace("_", " ") + ".",
+                       [((), value)])
+
+        if pool_stats is not None:
+            for key in ("size", "idle", "in_use"):
+                metric("scheduler_db_pool_" + key, "gauge", "Connection pool " + key.replace("_", " ") + ".", [((), pool_stats[key])])
+            for key in ("hits", "misses", "waits", "health_check_failures", "expired"):
+                metric("scheduler_db_pool_" + key + "_total", "counter", "Connection pool " + key.replace("_", " ") + ".", [((), pool_stats[key])])
+            metric("scheduler_db_pool_wait_seconds_total", "counter", "Time spent waiting for a pooled connection.", [((), pool_stats["wait_time"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, record):
+        log = self.log
+        if log is None:
+            if record["event"] != "slow_query":
+                return
+            log = sys.stderr
+        record["time"] = round(time.time(), 3)
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            log.write(line)
+            log.flush()
+
+    def _scopes(self):
+        stack = getattr(self._local, "scopes", None)
+        if stack is None:
+            stack = self._local.scopes = []
+        return stack
+
+    def _statement(self, operation, elapsed):
+        sql = WHITESPACE.sub(" ", operation).strip()[:200]
+        with self._lock:
+            totals = self.statements.setdefault(sql, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] = max(totals[2], elapsed)
+        for scope in self._scopes():
+            scope.statements += 1
+            scope.db_time += elapsed
+        if elapsed * 1000 >= self.slow_query_ms:
+            with self._lock:
+                self.slow_queries += 1
+            self.write({"event": "slow_query", "ms": round(elapsed * 1000, 3), "statement": sql})
+        return sql
+
+    def _rows(self, sql, n):
+        if n == 0:
+            return
+        with self._lock:
+            self.statements[sql][3] += n
+        for scope in self._scopes():
+            scope.rows += n
+
+    def _transaction(self, kind):
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+        for scope in self._scopes():
+            setattr(scope, kind, getattr(scope, kind) + 1)
+
+    def _closed(self):
+        with self._lock:
+            self.closed += 1
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class InstrumentedCursor:
+
+    def __init__(self, cursor, instrumentation):
+        self.cursor = cursor
+        self.instrumentation = instrumentation
+        self.sql = None
+
+    def execute(self, operation, *args):
+        started = time.perf_counter()
+        try:
+            return self.cursor.execute(operation, *args)
+        finally:
+            self.sql = self.instrumentation._statement(operation, time.perf_counter() - started)
+
+    def executemany(self, operation, *args):
+        started = time.perf_counter()
+        try:
+            return self.cursor.executemany(operation, *args)
+        finally:
+            self.sql = self.instrumentation._statement(operation, time.perf_counter() - started)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.instrumentation._rows(self.sql, 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.instrumentation._rows(self.sql, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.instrumentation._rows(self.sql, len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.instrumentation._rows(self.sql, 1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedConnection:
+
+    def __init__(self, conn, instrumentation):
+        self.conn = conn
+        self.instrumentation = instrumentation
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.conn.cursor(*args, **kwargs), self.instrumentation)
+
+    def commit(self):
+        self.conn.commit()
+        self.instrumentation._transaction("commits")
+
+    def rollback(self):
+        self.conn.rollback()
+        self.instrumentation._transaction("rollbacks")
+
+    def close(self):
+        self.conn.close()
+        self.instrumentation._closed()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+_instrumentation = None
+_instrumentation_lock = threading.Lock()
+
+
+# Returns the process-wide Instrumentation. DBInstrumentation=1 turns it on,
+# DBSlowQueryMs sets the slow query threshold (default 100) and
+# DBInstrumentationLog names a file ("-" for stderr) for the JSON log.
+def get_instrumentation():
+    global _instrumentation
+    if _instrumentation is None:
+        with _instrumentation_lock:
+            if _instrumentation is None:
+                log_path = os.getenv("DBInstrumentationLog")
+                log = None
+                if log_path == "-":
+                    log = sys.stderr
+                elif log_path:
+                    log = open(log_path, "a")
+                _instrumentation = Instrumentation(
+                    enabled=os.getenv("DBInstrumentation", "0") not in ("", "0"),
+                    slow_query_ms=float(os.getenv("DBSlowQueryMs", "100")),
+                    log=log,
+                )
+    return _instrumentation
@@ -0,0 +1,24 @@
+import pymssql
+import os
+from db.Backend import Backend
+
+
+class MSSQLBackend(Backend):
+    name = "mssql"
+    Error = pymssql.Error
+
+    def __init__(self):
+        self.server_name = os.getenv("Server") + ".database.windows.net"
+        self.db_name = os.getenv("DBName")
+        self.user = os.getenv("UserID")
+        self.password = os.getenv("Password")
+
+    def connect(self):
+        return pymssql.connect(server=self.server_name, user=self.user, password=self.password, database=self.db_name)
+
+    def limit(self, query, n):
+        return "SELECT TOP (%d)" % n + query.lstrip()[len("SELECT"):]
+
+    def retryable(self, error):
+        # 1205: chosen as deadlock victim, 1222: lock request timed out
+        return isinstance(error, pymssql.OperationalError) and len(error.args) > 0 and error.args[0] in (1205, 1222)
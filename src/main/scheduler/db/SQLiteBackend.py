@@ -0,0 +1,153 @@
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from db.Backend import Backend
+
+
+SCHEMA = os.path.join(os.path.dirname(__file__), "..", "..", "resources", "create_sqlite.sql")
+
+# pymssql-style placeholders; "%%" is an escaped literal percent sign
+PLACEHOLDER = re.compile(r"%([sd%])")
+
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" "))
+sqlite3.register_converter("date", lambda b: datetime.date.fromisoformat(b.decode()))
+sqlite3.register_converter("datetime", lambda b: datetime.datetime.fromisoformat(b.decode()))
+
+
+class SQLiteCursor:
+    """
+    Wraps a sqlite3 cursor so it takes the same arguments as a pymssql one.
+    """
+
+    def __init__(self, cursor, as_dict=False):
+        self.cursor = cursor
+        self.as_dict = as_dict
+
+    def execute(self, operation, params=None):
+        if params is None:
+            self.cursor.execute(operation)
+        else:
+            self.cursor.execute(self._translate(operation), self._params(params))
+        return self
+
+    def executemany(self, operation, seq_of_params):
+        self.cursor.executemany(self._translate(operation), [self._params(p) for p in seq_of_params])
+        return self
+
+    def fetchone(self):
+        return self._row(self.cursor.fetchone())
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany(self.cursor.arraysize if size is None else size)
+        return [self._row(row) for row in rows]
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self.cursor:
+            yield self._row(row)
+
+    def close(self):
+        self.cursor.close()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @staticmethod
+    def _translate(operation):
+        return PLACEHOLDER.sub(lambda m: "%" if m.group(1) == "%" else "?", operation)
+
+    @staticmethod
+    def _params(params):
+        # pymssql accepts a bare value for a single parameter
+        if isinstance(params, (tuple, list, dict)):
+            return params
+        return (params,)
+
+    def _row(self, row):
+        if row is None or not self.as_dict:
+            return row
+        return {column[0]: value for column, value in zip(self.cursor.description, row)}
+
+
+class SQLiteConnection:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, as_dict=False):
+        return SQLiteCursor(self.conn.cursor(), as_dict=as_dict)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteBackend(Backend):
+    """
+    An embedded SQLite database for local runs, profiling and load tests.
+
+    database is a file path or ":memory:". In-memory databases are shared by
+    every connection of the process and live as long as the backend does.
+    """
+    name = "sqlite"
+    Error = sqlite3.Error
+
+    def __init__(self, database=":memory:"):
+        if database == ":memory:":
+            # memdb rather than shared-cache so connections lock like a file database
+            self.database = "file:/scheduler-%s?vfs=memdb" % uuid.uuid4().hex
+            self.uri = True
+        else:
+            self.database = database
+            self.uri = False
+        self._keeper = None
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.database, uri=self.uri, timeout=30, isolation_level="IMMEDIATE",
+                               detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        conn.execute("PRAGMA foreign_keys = ON")
+        if not self._schema_ready:
+            self._create_schema(conn)
+        return SQLiteConnection(conn)
+
+    def limit(self, query, n):
+        return query + " LIMIT %d" % n
+
+    def retryable(self, error):
+        # the busy timeout ran out while another connection held the write lock
+        return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
+
+    def _create_schema(self, conn):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            if not self.uri:
+                conn.execute("PRAGMA journal_mode = WAL")
+            with open(SCHEMA) as f:
+                conn.executescript(f.read())
+            if self.uri:
+                # an in-memory database disappears with its last connection
+                self._keeper = sqlite3.connect(self.database, uri=True, check_same_thread=False)
+            self._schema_ready = True
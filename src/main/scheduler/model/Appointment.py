@@ -0,0 +1,334 @@
+import sys
+import os
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager, DatabaseError
+from model.Vaccine import vaccine_catalog
+from model.DoseLedger import DoseLedger
+from model.Report import Report
+
+
+class Appointment:
+    # How reserve picks among the caregivers free that day: the ORDER BY used to
+    # claim a slot, per backend. Chosen with the AssignmentStrategy environment
+    # variable; ties are broken randomly so concurrent bookings spread out.
+    #   first         alphabetically first caregiver
+    #   least_loaded  caregiver with the fewest appointments that day
+    #   round_robin   caregiver after the one booked most recently that day
+    #   random        any free caregiver
+    assignment_orders = {
+        "first": {
+            "mssql": "Username",
+            "sqlite": "Username",
+        },
+        "least_loaded": {
+            "mssql": "(SELECT COUNT(*) FROM Appointments ap WHERE ap.Time = a.Time AND ap.c_name = a.Username), NEWID()",
+            "sqlite": "(SELECT COUNT(*) FROM Appointments ap WHERE ap.Time = a.Time AND ap.c_name = a.Username), RANDOM()",
+        },
+        "round_robin": {
+            "mssql": "CASE WHEN a.Username > COALESCE((SELECT TOP (1) c_name FROM Appointments ap WHERE ap.Time = a.Time ORDER BY ap.ID DESC), '') THEN 0 ELSE 1 END, a.Username",
+            "sqlite": "a.Username <= COALESCE((SELECT c_name FROM Appointments ap WHERE ap.Time = a.Time ORDER BY ap.ID DESC LIMIT 1), ''), a.Username",
+        },
+        "random": {
+            "mssql": "NEWID()",
+            "sqlite": "RANDOM()",
+        },
+    }
+
+    # Claims a free caregiver for the day's earliest free slot (or the slot
+    # {slot} asks for), takes one dose from the first lot still good that day
+    # ({claim_lot}, see DoseLedger), books the appointment and counts it in
+    # the daily summaries ({usage}, see Report), all in a single
+    # transaction and a single round trip. READPAST lets concurrent reservations
+    # skip slots another transaction is already claiming, so a taken slot never
+    # needs a retry. {order} comes from assignment_orders and breaks ties
+    # between the caregivers free in the same slot.
+    reserve_mssql = """
+        SET NOCOUNT ON;
+        SET XACT_ABORT ON;
+        DECLARE @time date = %s, @patient varchar(255) = %s, @vaccine varchar(255) = %s;
+        DECLARE @claimed TABLE (Username varchar(255), Slot smallint);
+        DECLARE @booked TABLE (ID int);
+        DECLARE @lot TABLE (Lot varchar(64));
+        DECLARE @usage TABLE (Time date, v_name varchar(255), c_name varchar(255), Appointments int, OpenSlots int);
+
+        BEGIN TRANSACTION;
+
+        WITH slot AS (
+            SELECT TOP (1) Username, Slot FROM Availabilities a WITH (UPDLOCK, ROWLOCK, READPAST)
+            WHERE Time = @time {slot}
+            ORDER BY Slot, {order}
+        )
+        DELETE FROM slot OUTPUT deleted.Username, deleted.Slot INTO @claimed;
+        IF NOT EXISTS (SELECT * FROM @claimed)
+        BEGIN
+            ROLLBACK TRANSACTION;
+            SELECT 'NO_CAREGIVER' AS Status, NULL AS ID, NULL AS Caregiver, NULL AS Slot;
+            RETURN;
+        END
+
+        UPDATE Vaccines SET Doses = Doses - 1 WHERE Name = @vaccine AND Doses > 0;
+        IF @@ROWCOUNT = 0
+        BEGIN
+            ROLLBACK TRANSACTION;
+            SELECT CASE WHEN EXISTS (SELECT * FROM Vaccines WHERE Name = @vaccine)
+                        THEN 'NO_DOSES' ELSE 'NO_VACCINE' END AS Status, NULL AS ID, NULL AS Caregiver, NULL AS Slot;
+            RETURN;
+        END
+
+        {claim_lot}
+        IF NOT EXISTS (SELECT * FROM @lot)
+        BEGIN
+            ROLLBACK TRANSACTION;
+            SELECT 'NO_DOSES' AS Status, NULL AS ID, NULL AS Caregiver, NULL AS Slot;
+            RETURN;
+        END
+
+        -- the ID comes from the AppointmentIDs sequence default (see create.sql)
+        INSERT INTO Appointments (Time, p_name, c_name, v_name, Slot, Lot)
+            OUTPUT inserted.ID INTO @booked
+            SELECT @time, @patient, Username, @vaccine, Slot, (SELECT Lot FROM @lot) FROM @claimed;
+        INSERT INTO DoseLedger (v_name, Lot, Kind, Doses, AppointmentID)
+            SELECT @vaccine, l.Lot, 'reservation', -1, b.ID FROM @booked b CROSS JOIN @lot l;
+        INSERT INTO @usage SELECT @time, @vaccine, Username, 1, -1 FROM @claimed;
+        {usage}
+
+        COMMIT TRANSACTION;
+        SELECT 'OK' AS Status, b.ID AS ID, c.Username AS Caregiver, c.Slot AS Slot FROM @booked b CROSS JOIN @claimed c;
+    """
+
+    # SQLite has no batches; the same steps run as separate statements inside one
+    # BEGIN IMMEDIATE transaction, which already serializes writers
+    claim_slot_sqlite = """
+        DELETE FROM Availabilities
+        WHERE rowid = (SELECT rowid FROM Availabilities a WHERE Time = %s {slot} ORDER BY Slot, {order} LIMIT 1)
+        RETURNING Username, Slot
+    """
+
+    # Deletes the matching appointments and, in the same transaction, gives
+    # their doses back, to the lots they came from, and re-opens (or, for
+    # cancel_day, closes) the caregivers' slots. {where} selects the
+    # appointments and {slots} updates Availabilities, noting what it changed
+    # in @usage for the daily summaries.
+    cancel_mssql = """
+        SET NOCOUNT ON;
+        SET XACT_ABORT ON;
+        DECLARE @cancelled TABLE (ID int, Time date, p_name varchar(255), c_name varchar(255), v_name varchar(255), Slot smallint,
+                                   Lot varchar(64));
+        DECLARE @usage TABLE (Time date, v_name varchar(255), c_name varchar(255), Appointments int, OpenSlots int);
+
+        BEGIN TRANSACTION;
+
+        DELETE FROM Appointments
+            OUTPUT deleted.ID, deleted.Time, deleted.p_name, deleted.c_name, deleted.v_name, deleted.Slot, COALESCE(deleted.Lot, '')
+            INTO @cancelled
+            WHERE {where};
+        INSERT INTO @usage SELECT Time, v_name, c_name, -1, 0 FROM @cancelled;
+
+        UPDATE v SET Doses = v.Doses + c.Doses
+            FROM Vaccines v
+            JOIN (SELECT v_name, COUNT(*) AS Doses FROM @cancelled GROUP BY v_name) c ON v.Name = c.v_name;
+        {lots}
+
+        {slots}
+        {usage}
+
+        COMMIT TRANSACTION;
+        SELECT ID, Time, p_name, c_name, v_name, Slot FROM @cancelled ORDER BY ID;
+    """
+
+    reopen_slots_mssql = """
+        INSERT INTO Availabilities (Time, Username, Slot)
+            OUTPUT inserted.Time, NULL, inserted.Username, 0, 1 INTO @usage
+            SELECT DISTINCT c.Time, c.c_name, c.Slot FROM @cancelled c
+            WHERE NOT EXISTS (SELECT * FROM Availabilities a WHERE a.Time = c.Time AND a.Slot = c.Slot AND a.Username = c.c_name);
+    """
+
+    reserve_errors = {
+        "NO_CAREGIVER": "No caregiver is available!",
+        "NO_VACCINE": "Not enough available doses!",
+        "NO_DOSES": "No available doses!",
+    }
+
+    default_strategy = os.getenv("AssignmentStrategy", "least_loaded")
+
+    # slot is the start of the appointment in minutes after midnight; left None,
+    # reserve books the earliest free slot of the day and fills it in
+    def __init__(self, time, patient, vaccine, caregiver=None, appointment_id=None, slot=None):
+        self.time = time
+        self.patient = patient
+        self.vaccine = vaccine
+        self.caregiver = caregiver
+        self.appointment_id = appointment_id
+        self.slot = slot
+
+    # getters
+    def get_appointment_id(self):
+        return self.appointment_id
+
+    def get_time(self):
+        return self.time
+
+    def get_patient(self):
+        return self.patient
+
+    def get_caregiver(self):
+        return self.caregiver
+
+    def get_vaccine(self):
+        return self.vaccine
+
+    def get_slot(self):
+        return self.slot
+
+    # Book the appointment, filling in the caregiver, the slot and the new
+    # appointment id; strategy names one of assignment_orders (default:
+    # AssignmentStrategy)
+    def reserve(self, strategy=None):
+        orders = self.assignment_orders.get(strategy or self.default_strategy)
+        if orders is None:
+            raise ValueError("Unknown assignment strategy: " + str(strategy or self.default_strategy))
+
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor(as_dict=True)
+
+        try:
+            if cm.backend.name == "sqlite":
+                row = self._reserve_sqlite(cursor, orders["sqlite"])
+            else:
+                row = self._reserve_mssql(cursor, orders["mssql"])
+            if row['Status'] == 'OK':
+                conn.commit()
+                vaccine_catalog.invalidate()
+            else:
+                conn.rollback()
+        except DatabaseError:
+            # print("Error occurred when reserving appointment")
+            raise
+        finally:
+            cm.close_connection()
+
+        if row['Status'] != 'OK':
+            raise ValueError(self.reserve_errors[row['Status']])
+        self.appointment_id = row['ID']
+        self.caregiver = row['Caregiver']
+        self.slot = row['Slot']
+        return self
+
+    def _reserve_mssql(self, cursor, order):
+        params = (self.time, self.patient, self.vaccine)
+        if self.slot is None:
+            slot = ""
+        else:
+            slot = "AND Slot = %d"
+            params = params + (self.slot,)
+        cursor.execute(self.reserve_mssql.format(order=order, slot=slot, claim_lot=DoseLedger.claim_lot_mssql,
+                                                 usage=Report.apply_usage_mssql), params)
+        return cursor.fetchone()
+
+    def _reserve_sqlite(self, cursor, order):
+        if self.slot is None:
+            cursor.execute(self.claim_slot_sqlite.format(order=order, slot=""), self.time)
+        else:
+            cursor.execute(self.claim_slot_sqlite.format(order=order, slot="AND Slot = %d"), (self.time, self.slot))
+        claimed = cursor.fetchone()
+        if claimed is None:
+            return {'Status': 'NO_CAREGIVER'}
+
+        cursor.execute("UPDATE Vaccines SET Doses = Doses - 1 WHERE Name = %s AND Doses > 0", self.vaccine)
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT Name FROM Vaccines WHERE Name = %s", self.vaccine)
+            return {'Status': 'NO_DOSES' if cursor.fetchone() else 'NO_VACCINE'}
+        lot = DoseLedger.claim_sqlite(cursor, self.vaccine, self.time)
+        if lot is None:
+            return {'Status': 'NO_DOSES'}
+
+        cursor.execute("INSERT INTO Appointments (Time, p_name, c_name, v_name, Slot, Lot) VALUES (%s, %s, %s, %s, %d, %s) RETURNING ID",
+                       (self.time, self.patient, claimed['Username'], self.vaccine, claimed['Slot'], lot))
+        appointment_id = cursor.fetchone()['ID']
+        DoseLedger.record(cursor, self.vaccine, lot, "reservation", -1, appointment_id)
+        Report.record_sqlite(cursor, [(self.time, self.vaccine, claimed['Username'], 1, -1)])
+        return {'Status': 'OK', 'ID': appointment_id, 'Caregiver': claimed['Username'], 'Slot': claimed['Slot']}
+
+    # Cancel this appointment (by id), returning its dose and re-opening the
+    # caregiver's slot. If patient or caregiver is set, only an appointment of
+    # theirs is cancelled. Returns None if there is no such appointment.
+    def cancel(self):
+        where = "ID = %d"
+        params = (self.appointment_id,)
+        if self.patient is not None:
+            where += " AND p_name = %s"
+            params += (self.patient,)
+        if self.caregiver is not None:
+            where += " AND c_name = %s"
+            params += (self.caregiver,)
+        cancelled = self._cancel(where, params)
+        if len(cancelled) == 0:
+            return None
+        return cancelled[0]
+
+    # Cancel every appointment caregiver has on time, e.g. when they call in sick.
+    # Doses are returned and all of the caregiver's slots that day are closed
+    # rather than re-opened. Returns the cancelled appointments.
+    @staticmethod
+    def cancel_day(time, caregiver):
+        return Appointment._cancel("Time = %s AND c_name = %s", (time, caregiver), close_day=(time, caregiver))
+
+    @staticmethod
+    def _cancel(where, params, close_day=None):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor(as_dict=True)
+
+        try:
+            if cm.backend.name == "sqlite":
+                rows = Appointment._cancel_sqlite(cursor, where, params, close_day)
+            else:
+                rows = Appointment._cancel_mssql(cursor, where, params, close_day)
+            conn.commit()
+            vaccine_catalog.invalidate()
+        except DatabaseError:
+            # print("Error occurred when cancelling appointments")
+            raise
+        finally:
+            cm.close_connection()
+        return [Appointment(row['Time'], row['p_name'], row['v_name'], caregiver=row['c_name'], appointment_id=row['ID'],
+                            slot=row['Slot'])
+                for row in rows]
+
+    @staticmethod
+    def _cancel_mssql(cursor, where, params, close_day):
+        if close_day is None:
+            slots = Appointment.reopen_slots_mssql
+        else:
+            slots = "DELETE FROM Availabilities OUTPUT deleted.Time, NULL, deleted.Username, 0, -1 INTO @usage WHERE Time = %s AND Username = %s;"
+            params = params + close_day
+        cursor.execute(Appointment.cancel_mssql.format(where=where, lots=DoseLedger.return_lots_mssql, slots=slots,
+                                                          usage=Report.apply_usage_mssql), params)
+        return cursor.fetchall()
+
+    @staticmethod
+    def _cancel_sqlite(cursor, where, params, close_day):
+        cursor.execute("DELETE FROM Appointments WHERE " + where + " RETURNING ID, Time, p_name, c_name, v_name, Slot, Lot", params)
+        rows = sorted(cursor.fetchall(), key=lambda row: row['ID'])
+
+        doses = {}
+        for row in rows:
+            doses[row['v_name']] = doses.get(row['v_name'], 0) + 1
+        cursor.executemany("UPDATE Vaccines SET Doses = Doses + %d WHERE Name = %s",
+                           [(count, name) for name, count in doses.items()])
+        DoseLedger.return_sqlite(cursor, rows)
+
+        usage = [(row['Time'], row['v_name'], row['c_name'], -1, 0) for row in rows]
+        if close_day is None:
+            for d, caregiver, slot in sorted({(row['Time'], row['c_name'], row['Slot']) for row in rows}):
+                cursor.execute("INSERT OR IGNORE INTO Availabilities (Time, Username, Slot) VALUES (%s, %s, %d)", (d, caregiver, slot))
+                usage.append((d, None, caregiver, 0, cursor.rowcount))
+        else:
+            cursor.execute("DELETE FROM Availabilities WHERE Time = %s AND Username = %s", close_day)
+            usage.append((close_day[0], None, close_day[1], 0, -cursor.rowcount))
+        Report.record_sqlite(cursor, usage)
+        return rows
+
+    def __str__(self):
+        return f"(Appointment ID: {self.appointment_id}, Caregiver username: {self.caregiver})"
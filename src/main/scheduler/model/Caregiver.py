@@ -1,12 +1,16 @@
 import sys
 sys.path.append("../util/*")
 sys.path.append("../db/*")
+from util.HashService import get_hash_service
 from util.Util import Util
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.ConnectionManager import ConnectionManager, DatabaseError
+from model.Report import Report
 
 
 class Caregiver:
+    # rows per multi-row INSERT; SQL Server accepts at most 1000 (and 2100 parameters)
+    upload_batch_size = 500
+
     def __init__(self, username, password=None, salt=None, hash=None):
         self.username = username
         self.password = password
@@ -22,24 +26,21 @@ class Caregiver:
         get_caregiver_details = "SELECT Salt, Hash FROM Caregivers WHERE Username = %s"
         try:
             cursor.execute(get_caregiver_details, self.username)
-            for row in cursor:
-                curr_salt = row['Salt']
-                curr_hash = row['Hash']
-                calculated_hash = Util.generate_hash(self.password, curr_salt)
-                if not curr_hash == calculated_hash:
-                    # print("Incorrect password")
-                    cm.close_connection()
-                    return None
-                else:
-                    self.salt = curr_salt
-                    self.hash = calculated_hash
-                    cm.close_connection()
-                    return self
-        except pymssql.Error as e:
+            row = cursor.fetchone()
+        except DatabaseError as e:
             raise e
         finally:
             cm.close_connection()
-        return None
+        if row is None:
+            return None
+
+        # the key derivation runs after the connection is back in the pool
+        if not get_hash_service().verify(self.username, self.password, row['Salt'], row['Hash']):
+            # print("Incorrect password")
+            return None
+        self.salt = row['Salt']
+        self.hash = row['Hash']
+        return self
 
     def get_username(self):
         return self.username
@@ -60,24 +61,71 @@ class Caregiver:
             cursor.execute(add_caregivers, (self.username, self.salt, self.hash))
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+        except DatabaseError:
             raise
         finally:
             cm.close_connection()
 
-    # Insert availability with parameter date d
-    def upload_availability(self, d):
+    # Insert availability with parameter date d, as one slot starting at slot
+    # minutes after midnight (by default the first of Util.day_slots())
+    def upload_availability(self, d, slot=None):
+        if slot is None:
+            slot = Util.day_slots()[0]
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        add_availability = "INSERT INTO Availabilities (Time, Username, Slot) VALUES (%s , %s, %d)"
+        try:
+            cursor.execute(add_availability, (d, self.username, slot))
+            Report.record(cm.backend, cursor, [(d, None, self.username, 0, 1)])
+            # you must call commit() to persist your data if you don't set autocommit to True
+            conn.commit()
+        except DatabaseError:
+            print("Error adding availability")
+            raise
+        finally:
+            cm.close_connection()
+
+    # Insert availability for every slot (minutes after midnight, by default
+    # Util.day_slots()) of every date in dates in one transaction, with one
+    # lookup and one multi-row INSERT per batch; returns the dates whose slots
+    # were all already uploaded (and so were skipped)
+    def upload_availabilities(self, dates, slots=None):
+        dates = sorted(set(dates))
+        if len(dates) == 0:
+            return []
+        slots = sorted(set(Util.day_slots() if slots is None else slots))
+
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        add_availability = "INSERT INTO Availabilities VALUES (%s , %s)"
+        # The check and the INSERTs must be one locked unit, or two uploads of the same
+        # days both pass the check and one fails on the key. SQLite would only start
+        # the write transaction at the first INSERT, so it is started here; on SQL
+        # Server UPDLOCK and HOLDLOCK keep the range locked until commit.
+        if cm.backend.name == "sqlite":
+            cursor.execute("BEGIN IMMEDIATE")
+            find_existing = "SELECT Time, Slot FROM Availabilities WHERE Username = %s AND Time BETWEEN %s AND %s"
+        else:
+            find_existing = "SELECT Time, Slot FROM Availabilities WITH (UPDLOCK, HOLDLOCK)" \
+                            " WHERE Username = %s AND Time BETWEEN %s AND %s"
         try:
-            cursor.execute(add_availability, (d, self.username))
+            cursor.execute(find_existing, (self.username, dates[0], dates[-1]))
+            existing = {(row[0], row[1]) for row in cursor.fetchall()}
+            new_slots = [(d, slot) for d in dates for slot in slots if (d, slot) not in existing]
+            for i in range(0, len(new_slots), self.upload_batch_size):
+                batch = new_slots[i:i + self.upload_batch_size]
+                add_availabilities = "INSERT INTO Availabilities (Time, Username, Slot) VALUES " \
+                    + ", ".join(["(%s, %s, %d)"] * len(batch))
+                cursor.execute(add_availabilities, tuple(value for d, slot in batch for value in (d, self.username, slot)))
+            Report.record(cm.backend, cursor, [(d, None, self.username, 0, 1) for d, slot in new_slots])
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+        except DatabaseError:
             print("Error adding availability")
             raise
         finally:
             cm.close_connection()
+        return [d for d in dates if all((d, slot) in existing for slot in slots)]
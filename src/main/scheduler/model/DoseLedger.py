@@ -0,0 +1,213 @@
+import sys
+import datetime
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager, DatabaseError
+
+
+class DoseLedger:
+    """
+    Where doses come from and go to. Every change to a vaccine's stock is
+    appended to DoseLedger in the same transaction that changes the vaccine's
+    balance (Vaccines.Doses) and the lot's remaining doses (DoseLots), so all
+    three always agree and balance reads stay a single-row lookup.
+
+    The helpers that take a cursor run inside their caller's transaction; the
+    jobs (expire, compact, reconcile) and history open their own connection.
+    """
+
+    # doses received without a lot number
+    UNLOTTED = ""
+
+    # first expiry first out; lots without an expiry date go last
+    lot_order = "CASE WHEN Expires IS NULL THEN 1 ELSE 0 END, Expires, Lot"
+
+    # Takes one dose for an appointment on @time from the first lot of @vaccine
+    # still good on that day, into @lot. Part of the reserve and waitlist batches.
+    claim_lot_mssql = """
+        UPDATE DoseLots SET Doses = Doses - 1 OUTPUT inserted.Lot INTO @lot
+        WHERE v_name = @vaccine AND Doses > 0 AND Lot = (
+            SELECT TOP (1) Lot FROM DoseLots WITH (UPDLOCK, ROWLOCK)
+            WHERE v_name = @vaccine AND Doses > 0 AND (Expires IS NULL OR Expires >= @time)
+            ORDER BY """ + lot_order + """
+        );
+    """
+
+    claim_lot_sqlite = """
+        UPDATE DoseLots SET Doses = Doses - 1
+        WHERE rowid = (SELECT rowid FROM DoseLots WHERE v_name = %s AND Doses > 0 AND (Expires IS NULL OR Expires >= %s)
+                       ORDER BY """ + lot_order + """ LIMIT 1)
+        RETURNING Lot
+    """
+
+    # Gives the doses of the appointments in @cancelled back to their lots.
+    # Part of the cancel batch.
+    return_lots_mssql = """
+        UPDATE l SET Doses = l.Doses + c.Doses
+            FROM DoseLots l
+            JOIN (SELECT v_name, Lot, COUNT(*) AS Doses FROM @cancelled GROUP BY v_name, Lot) c
+                ON l.v_name = c.v_name AND l.Lot = c.Lot;
+        INSERT INTO DoseLots (v_name, Lot, Expires, Doses)
+            SELECT v_name, Lot, NULL, COUNT(*) FROM @cancelled c
+            WHERE NOT EXISTS (SELECT * FROM DoseLots l WHERE l.v_name = c.v_name AND l.Lot = c.Lot)
+            GROUP BY v_name, Lot;
+        INSERT INTO DoseLedger (v_name, Lot, Kind, Doses, AppointmentID)
+            SELECT v_name, Lot, 'cancellation', 1, ID FROM @cancelled;
+    """
+
+    # adds to a lot, creating it on its first delivery
+    add_to_lot_sqlite = """
+        INSERT INTO DoseLots (v_name, Lot, Expires, Doses) VALUES (%s, %s, %s, %d)
+        ON CONFLICT (v_name, Lot) DO UPDATE SET Doses = Doses + excluded.Doses, Expires = COALESCE(excluded.Expires, Expires)
+    """
+
+    @staticmethod
+    def record(cursor, vaccine, lot, kind, doses, appointment_id=None):
+        cursor.execute("INSERT INTO DoseLedger (v_name, Lot, Kind, Doses, AppointmentID) VALUES (%s, %s, %s, %d, %s)",
+                       (vaccine, lot, kind, doses, appointment_id))
+
+    # Adds doses to the vaccine's lot (setting its expiry if given) and records them as kind
+    @staticmethod
+    def add(backend, cursor, vaccine, lot, expires, doses, kind):
+        if backend.name == "sqlite":
+            cursor.execute(DoseLedger.add_to_lot_sqlite, (vaccine, lot, expires, doses))
+        else:
+            # UPDLOCK and SERIALIZABLE hold the key until commit, so two first deliveries can't both insert
+            cursor.execute("UPDATE DoseLots WITH (UPDLOCK, SERIALIZABLE) SET Doses = Doses + %d, Expires = COALESCE(%s, Expires)"
+                           " WHERE v_name = %s AND Lot = %s", (doses, expires, vaccine, lot))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO DoseLots (v_name, Lot, Expires, Doses) VALUES (%s, %s, %s, %d)",
+                               (vaccine, lot, expires, doses))
+        DoseLedger.record(cursor, vaccine, lot, kind, doses)
+
+    # Takes doses from the vaccine's lots, first expiry first, and records them as kind.
+    # The caller has already taken them off the balance, which the lots add up to.
+    @staticmethod
+    def take(backend, cursor, vaccine, doses, kind):
+        lock = "" if backend.name == "sqlite" else " WITH (UPDLOCK)"
+        cursor.execute("SELECT Lot, Doses FROM DoseLots" + lock + " WHERE v_name = %s AND Doses > 0 ORDER BY "
+                       + DoseLedger.lot_order, vaccine)
+        taken = []
+        for lot, left in cursor.fetchall():
+            if doses == 0:
+                break
+            n = min(doses, left)
+            taken.append((n, vaccine, lot))
+            doses -= n
+        cursor.executemany("UPDATE DoseLots SET Doses = Doses - %d WHERE v_name = %s AND Lot = %s", taken)
+        for n, _, lot in taken:
+            DoseLedger.record(cursor, vaccine, lot, kind, -n)
+
+    # Takes one dose of vaccine still good on day d for an appointment; returns its lot, or None
+    @staticmethod
+    def claim_sqlite(cursor, vaccine, d):
+        cursor.execute(DoseLedger.claim_lot_sqlite, (vaccine, d))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row['Lot'] if isinstance(row, dict) else row[0]
+
+    # Gives the doses of the cancelled appointment rows (ID, v_name, Lot) back to their lots
+    @staticmethod
+    def return_sqlite(cursor, rows):
+        lots = {}
+        for row in rows:
+            key = (row['v_name'], row['Lot'] or DoseLedger.UNLOTTED)
+            lots[key] = lots.get(key, 0) + 1
+        cursor.executemany(DoseLedger.add_to_lot_sqlite, [(vaccine, lot, None, n) for (vaccine, lot), n in lots.items()])
+        cursor.executemany("INSERT INTO DoseLedger (v_name, Lot, Kind, Doses, AppointmentID) VALUES (%s, %s, 'cancellation', 1, %d)",
+                           [(row['v_name'], row['Lot'] or DoseLedger.UNLOTTED, row['ID']) for row in rows])
+
+    # Writes off every dose in a lot that expired before today; returns (vaccine, lot, doses) per lot
+    @staticmethod
+    def expire(today=None):
+        today = today or datetime.date.today()
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        lock = "" if cm.backend.name == "sqlite" else " WITH (UPDLOCK)"
+        try:
+            cursor.execute("SELECT v_name, Lot, Doses FROM DoseLots" + lock + " WHERE Expires < %s AND Doses > 0 ORDER BY v_name, Lot",
+                           today)
+            expired = [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+            cursor.executemany("UPDATE DoseLots SET Doses = Doses - %d WHERE v_name = %s AND Lot = %s",
+                               [(doses, vaccine, lot) for vaccine, lot, doses in expired])
+            cursor.executemany("UPDATE Vaccines SET Doses = Doses - %d WHERE Name = %s",
+                               [(doses, vaccine) for vaccine, lot, doses in expired])
+            for vaccine, lot, doses in expired:
+                DoseLedger.record(cursor, vaccine, lot, "expiry", -doses)
+            conn.commit()
+        except DatabaseError:
+            # print("Error occurred when expiring doses")
+            raise
+        finally:
+            cm.close_connection()
+        if len(expired) != 0:
+            # imported here: Vaccine itself records its changes through DoseLedger
+            from model.Vaccine import vaccine_catalog
+            vaccine_catalog.invalidate()
+        return expired
+
+    # Replaces the entries recorded before `before` (a UTC datetime) with one
+    # 'rollup' entry per vaccine and lot holding their sum, dropping lots that
+    # sum to zero; returns how many entries were rolled up
+    @staticmethod
+    def compact(before):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        try:
+            # the rollups are stamped `before`, so the DELETE leaves them alone
+            cursor.execute("INSERT INTO DoseLedger (v_name, Lot, Kind, Doses, Recorded)"
+                           " SELECT v_name, Lot, 'rollup', SUM(Doses), %s FROM DoseLedger WHERE Recorded < %s"
+                           " GROUP BY v_name, Lot HAVING SUM(Doses) <> 0", (before, before))
+            cursor.execute("DELETE FROM DoseLedger WHERE Recorded < %s", before)
+            rolled_up = cursor.rowcount
+            conn.commit()
+        except DatabaseError:
+            # print("Error occurred when compacting the dose ledger")
+            raise
+        finally:
+            cm.close_connection()
+        return rolled_up
+
+    # Returns (vaccine, balance, lots, ledger) for every vaccine whose balance
+    # doesn't match the sum of its lots or of its ledger entries
+    @staticmethod
+    def reconcile():
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        find_mismatches = """
+            SELECT v.Name, v.Doses, COALESCE(l.Doses, 0), COALESCE(g.Doses, 0)
+            FROM Vaccines v
+            LEFT JOIN (SELECT v_name, SUM(Doses) AS Doses FROM DoseLots GROUP BY v_name) l ON l.v_name = v.Name
+            LEFT JOIN (SELECT v_name, SUM(Doses) AS Doses FROM DoseLedger GROUP BY v_name) g ON g.v_name = v.Name
+            WHERE v.Doses <> COALESCE(l.Doses, 0) OR v.Doses <> COALESCE(g.Doses, 0)
+            ORDER BY v.Name
+        """
+        try:
+            cursor.execute(find_mismatches)
+            return [tuple(row) for row in cursor.fetchall()]
+        finally:
+            cm.close_connection()
+
+    # Returns the vaccine's lots as (lot, expires, doses) and its latest `limit`
+    # ledger entries as (id, lot, kind, doses, appointment id, recorded), newest first
+    @staticmethod
+    def history(vaccine, limit=20):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        get_entries = cm.backend.limit("SELECT ID, Lot, Kind, Doses, AppointmentID, Recorded FROM DoseLedger"
+                                       " WHERE v_name = %s ORDER BY ID DESC", limit)
+        try:
+            cursor.execute("SELECT Lot, Expires, Doses FROM DoseLots WHERE v_name = %s ORDER BY " + DoseLedger.lot_order, vaccine)
+            lots = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute(get_entries, vaccine)
+            return lots, [tuple(row) for row in cursor.fetchall()]
+        finally:
+            cm.close_connection()
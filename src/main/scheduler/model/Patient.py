@@ -1,9 +1,8 @@
 import sys
 sys.path.append("../util/*")
 sys.path.append("../db/*")
-from util.Util import Util
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from util.HashService import get_hash_service
+from db.ConnectionManager import ConnectionManager, DatabaseError
 
 class Patient:
     def __init__(self, username, password=None, salt=None, hash=None):
@@ -20,24 +19,21 @@ class Patient:
         get_patient_details = "SELECT Salt, Hash FROM Patient WHERE Username = %s"
         try:
             cursor.execute(get_patient_details, self.username)
-            for row in cursor:
-                curr_salt = row['Salt']
-                curr_hash = row['Hash']
-                calculated_hash = Util.generate_hash(self.password, curr_salt)
-                if not curr_hash == calculated_hash:
-                    print("Incorrect password")
-                    cm.close_connection()
-                    return None
-                else:
-                    self.salt = curr_salt
-                    self.hash = calculated_hash
-                    cm.close_connection()
-                    return self
-        except pymssql.Error as e:
+            row = cursor.fetchone()
+        except DatabaseError as e:
             raise e
         finally:
             cm.close_connection()
-        return None
+        if row is None:
+            return None
+
+        # the key derivation runs after the connection is back in the pool
+        if not get_hash_service().verify(self.username, self.password, row['Salt'], row['Hash']):
+            print("Incorrect password")
+            return None
+        self.salt = row['Salt']
+        self.hash = row['Hash']
+        return self
 
     def get_username(self):
         return self.username
@@ -58,7 +54,7 @@ class Patient:
             cursor.execute(add_patients, (self.username, self.salt, self.hash))
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+        except DatabaseError:
             print("Error adding patient")
             raise
         finally:
@@ -0,0 +1,159 @@
+import sys
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager, DatabaseError
+
+
+class Report:
+    """
+    Utilization over a date range: appointments booked per day, vaccine and
+    caregiver, and the slots still open beside them. It is read from the
+    daily summary tables (DailyVaccineUsage, DailyCaregiverUsage), one row
+    per day and vaccine or caregiver, never from Appointments.
+
+    Every call that books, cancels or uploads availability changes the
+    summaries in the same transaction. A change is a tuple
+    (day, vaccine, caregiver, appointments, open slots) of deltas; vaccine is
+    None when only a caregiver's open slots change.
+    """
+
+    # Applies the changes a batch collected in @usage (Time, v_name, c_name,
+    # Appointments, OpenSlots). Part of the reserve, cancel and waitlist batches.
+    apply_usage_mssql = """
+        MERGE DailyVaccineUsage WITH (HOLDLOCK) AS d
+        USING (SELECT Time, v_name, SUM(Appointments) AS Appointments FROM @usage
+               WHERE v_name IS NOT NULL GROUP BY Time, v_name) AS u
+            ON d.Time = u.Time AND d.v_name = u.v_name
+        WHEN MATCHED THEN UPDATE SET Appointments = d.Appointments + u.Appointments
+        WHEN NOT MATCHED THEN INSERT (Time, v_name, Appointments) VALUES (u.Time, u.v_name, u.Appointments);
+        MERGE DailyCaregiverUsage WITH (HOLDLOCK) AS d
+        USING (SELECT Time, c_name, SUM(Appointments) AS Appointments, SUM(OpenSlots) AS OpenSlots FROM @usage
+               GROUP BY Time, c_name) AS u
+            ON d.Time = u.Time AND d.c_name = u.c_name
+        WHEN MATCHED THEN UPDATE SET Appointments = d.Appointments + u.Appointments, OpenSlots = d.OpenSlots + u.OpenSlots
+        WHEN NOT MATCHED THEN INSERT (Time, c_name, Appointments, OpenSlots) VALUES (u.Time, u.c_name, u.Appointments, u.OpenSlots);
+    """
+
+    add_vaccine_usage_sqlite = """
+        INSERT INTO DailyVaccineUsage (Time, v_name, Appointments) VALUES (%s, %s, %d)
+        ON CONFLICT (Time, v_name) DO UPDATE SET Appointments = Appointments + excluded.Appointments
+    """
+
+    add_caregiver_usage_sqlite = """
+        INSERT INTO DailyCaregiverUsage (Time, c_name, Appointments, OpenSlots) VALUES (%s, %s, %d, %d)
+        ON CONFLICT (Time, c_name) DO UPDATE SET Appointments = Appointments + excluded.Appointments,
+                                                 OpenSlots = OpenSlots + excluded.OpenSlots
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.days = []  # (day, appointments, open slots)
+        self.vaccines = []  # (vaccine, appointments)
+        self.caregivers = []  # (caregiver, appointments, open slots)
+
+    # getters
+    def get_appointments(self):
+        return sum(appointments for _, appointments, _ in self.days)
+
+    def get_open_slots(self):
+        return sum(open_slots for _, _, open_slots in self.days)
+
+    # share of the range's slots that are booked, or None if there were none
+    @staticmethod
+    def utilization(appointments, open_slots):
+        if appointments + open_slots <= 0:
+            return None
+        return appointments / (appointments + open_slots)
+
+    # Reads the range's totals per day, vaccine and caregiver; days, vaccines
+    # and caregivers with nothing booked or open are left out
+    def load(self):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        get_days = "SELECT Time, SUM(Appointments), SUM(OpenSlots) FROM DailyCaregiverUsage WHERE Time BETWEEN %s AND %s" \
+                   " GROUP BY Time HAVING SUM(Appointments) <> 0 OR SUM(OpenSlots) <> 0 ORDER BY Time"
+        get_vaccines = "SELECT v_name, SUM(Appointments) FROM DailyVaccineUsage WHERE Time BETWEEN %s AND %s" \
+                       " GROUP BY v_name HAVING SUM(Appointments) <> 0 ORDER BY v_name"
+        get_caregivers = "SELECT c_name, SUM(Appointments), SUM(OpenSlots) FROM DailyCaregiverUsage WHERE Time BETWEEN %s AND %s" \
+                         " GROUP BY c_name HAVING SUM(Appointments) <> 0 OR SUM(OpenSlots) <> 0 ORDER BY c_name"
+        try:
+            cursor.execute(get_days, (self.first, self.last))
+            self.days = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute(get_vaccines, (self.first, self.last))
+            self.vaccines = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute(get_caregivers, (self.first, self.last))
+            self.caregivers = [tuple(row) for row in cursor.fetchall()]
+        except DatabaseError:
+            # print("Error occurred when reading the report")
+            raise
+        finally:
+            cm.close_connection()
+        return self
+
+    # Adds changes to the summaries inside the caller's transaction
+    @staticmethod
+    def record(backend, cursor, changes):
+        if backend.name == "sqlite":
+            Report.record_sqlite(cursor, changes)
+            return
+        vaccines, caregivers = Report._totals(changes)
+        # UPDLOCK and SERIALIZABLE hold the key until commit, so two first changes to a day can't both insert
+        for (d, vaccine), appointments in vaccines:
+            cursor.execute("UPDATE DailyVaccineUsage WITH (UPDLOCK, SERIALIZABLE) SET Appointments = Appointments + %d"
+                           " WHERE Time = %s AND v_name = %s", (appointments, d, vaccine))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO DailyVaccineUsage (Time, v_name, Appointments) VALUES (%s, %s, %d)",
+                               (d, vaccine, appointments))
+        for (d, caregiver), (appointments, open_slots) in caregivers:
+            cursor.execute("UPDATE DailyCaregiverUsage WITH (UPDLOCK, SERIALIZABLE)"
+                           " SET Appointments = Appointments + %d, OpenSlots = OpenSlots + %d WHERE Time = %s AND c_name = %s",
+                           (appointments, open_slots, d, caregiver))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO DailyCaregiverUsage (Time, c_name, Appointments, OpenSlots) VALUES (%s, %s, %d, %d)",
+                               (d, caregiver, appointments, open_slots))
+
+    @staticmethod
+    def record_sqlite(cursor, changes):
+        vaccines, caregivers = Report._totals(changes)
+        cursor.executemany(Report.add_vaccine_usage_sqlite,
+                           [(d, vaccine, appointments) for (d, vaccine), appointments in vaccines])
+        cursor.executemany(Report.add_caregiver_usage_sqlite,
+                           [(d, caregiver, appointments, open_slots) for (d, caregiver), (appointments, open_slots) in caregivers])
+
+    @staticmethod
+    def _totals(changes):
+        # one delta per row, in key order so concurrent writers lock rows in the same order
+        vaccines = {}
+        caregivers = {}
+        for d, vaccine, caregiver, appointments, open_slots in changes:
+            if vaccine is not None and appointments != 0:
+                vaccines[(d, vaccine)] = vaccines.get((d, vaccine), 0) + appointments
+            booked, free = caregivers.get((d, caregiver), (0, 0))
+            caregivers[(d, caregiver)] = (booked + appointments, free + open_slots)
+        return sorted(vaccines.items()), sorted(caregivers.items())
+
+    # Recomputes the summaries of every day from Appointments and Availabilities,
+    # e.g. after loading either table directly
+    @staticmethod
+    def rebuild():
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("DELETE FROM DailyVaccineUsage")
+            cursor.execute("DELETE FROM DailyCaregiverUsage")
+            cursor.execute("INSERT INTO DailyVaccineUsage (Time, v_name, Appointments)"
+                           " SELECT Time, v_name, COUNT(*) FROM Appointments GROUP BY Time, v_name")
+            cursor.execute("INSERT INTO DailyCaregiverUsage (Time, c_name, Appointments, OpenSlots)"
+                           " SELECT Time, c_name, SUM(Appointments), SUM(OpenSlots) FROM ("
+                           " SELECT Time, c_name, 1 AS Appointments, 0 AS OpenSlots FROM Appointments"
+                           " UNION ALL SELECT Time, Username, 0, 1 FROM Availabilities) u GROUP BY Time, c_name")
+            conn.commit()
+        except DatabaseError:
+            # print("Error occurred when rebuilding the report summaries")
+            raise
+        finally:
+            cm.close_connection()
@@ -1,10 +1,31 @@
 import sys
+import os
+import threading
+import time
 sys.path.append("../db/*")
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.ConnectionManager import ConnectionManager, DatabaseError
+from db.Instrumentation import get_instrumentation
+from model.DoseLedger import DoseLedger
 
 
 class Vaccine:
+    # The balance (Vaccines.Doses) only changes through relative UPDATEs that
+    # hand back the new count, per backend; the same transaction records the
+    # change in the DoseLedger. UPDLOCK and SERIALIZABLE on the increase hold
+    # the key range, so two first deliveries of a new vaccine can't both miss
+    # the UPDATE and both INSERT.
+    increase_doses = {
+        "mssql": "UPDATE Vaccines WITH (UPDLOCK, SERIALIZABLE) SET Doses = Doses + %d OUTPUT inserted.Doses WHERE Name = %s",
+        "sqlite": "UPDATE Vaccines SET Doses = Doses + %d WHERE Name = %s RETURNING Doses",
+    }
+    decrease_doses = {
+        "mssql": "UPDATE Vaccines SET Doses = Doses - %d OUTPUT inserted.Doses WHERE Name = %s AND Doses >= %d",
+        "sqlite": "UPDATE Vaccines SET Doses = Doses - %d WHERE Name = %s AND Doses >= %d RETURNING Doses",
+    }
+
+    # runs of a dose update that lost a race for locks before giving up
+    update_attempts = 3
+
     def __init__(self, vaccine_name, available_doses):
         self.vaccine_name = vaccine_name
         self.available_doses = available_doses
@@ -21,7 +42,7 @@ class Vaccine:
             for row in cursor:
                 self.available_doses = row[1]
                 return self
-        except pymssql.Error:
+        except DatabaseError:
             # print("Error occurred when getting Vaccine")
             raise
         finally:
@@ -42,58 +63,187 @@ class Vaccine:
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        add_doses = "INSERT INTO VACCINES VALUES (%s, %d)"
+        add_doses = "INSERT INTO VACCINES (Name, Doses) VALUES (%s, %d)"
         try:
             cursor.execute(add_doses, (self.vaccine_name, self.available_doses))
+            DoseLedger.add(cm.backend, cursor, self.vaccine_name, DoseLedger.UNLOTTED, None, self.available_doses, "receipt")
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+            vaccine_catalog.invalidate()
+        except DatabaseError:
             # print("Error occurred when insert Vaccines")
             raise
         finally:
             cm.close_connection()
 
-    # Increment the available doses
+    # Add num doses with one relative UPDATE, so concurrent additions can't
+    # overwrite each other; returns the new count, read back from the same
+    # statement. Raises ValueError if there is no such vaccine.
     def increase_available_doses(self, num):
         if num <= 0:
             raise ValueError("Argument cannot be negative!")
-        self.available_doses += num
+        doses = self._update_doses(self._increase, num, DoseLedger.UNLOTTED, None, "adjustment", False)
+        if doses is None:
+            dose_updates.count("missing")
+            raise ValueError("No such vaccine!")
+        self.available_doses = doses
+        return doses
+
+    # Take num doses, guarded in the same UPDATE so stock never goes negative
+    # however many bookings race for the last doses; returns the new count.
+    # Raises ValueError if there aren't num doses left.
+    def decrease_available_doses(self, num):
+        if num <= 0:
+            raise ValueError("Argument cannot be negative!")
+        doses = self._update_doses(self._decrease, num)
+        if doses is None:
+            dose_updates.count("rejected")
+            raise ValueError("Not enough available doses!")
+        self.available_doses = doses
+        return doses
+
+    # Receive num doses, from lot (expiring on expires) if given, creating the
+    # vaccine if this is its first delivery; returns the new count
+    def add_doses(self, num, lot=None, expires=None):
+        if num <= 0:
+            raise ValueError("Argument cannot be negative!")
+        self.available_doses = self._update_doses(self._increase, num, lot or DoseLedger.UNLOTTED, expires, "receipt", True)
+        return self.available_doses
 
-        cm = ConnectionManager()
-        conn = cm.create_connection()
-        cursor = conn.cursor()
+    def _increase(self, cm, cursor, num, lot, expires, kind, create):
+        cursor.execute(self.increase_doses[cm.backend.name], (num, self.vaccine_name))
+        row = cursor.fetchone()
+        if row is not None:
+            doses = row[0]
+        elif create:
+            cursor.execute("INSERT INTO Vaccines (Name, Doses) VALUES (%s, %d)", (self.vaccine_name, num))
+            doses = num
+        else:
+            return None
+        DoseLedger.add(cm.backend, cursor, self.vaccine_name, lot, expires, num, kind)
+        return doses
+
+    def _decrease(self, cm, cursor, num):
+        cursor.execute(self.decrease_doses[cm.backend.name], (num, self.vaccine_name, num))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        DoseLedger.take(cm.backend, cursor, self.vaccine_name, num, "adjustment")
+        return row[0]
+
+    def _update_doses(self, change, *args):
+        # runs change(cm, cursor, *args) as one transaction and returns the dose
+        # count it leaves, or None if it changed nothing. A change that lost a race
+        # for locks (deadlock victim, lock timeout) is run again, up to
+        # update_attempts times.
+        for attempt in range(1, self.update_attempts + 1):
+            cm = ConnectionManager()
+            conn = cm.create_connection()
+            cursor = conn.cursor()
+            try:
+                doses = change(cm, cursor, *args)
+                # you must call commit() to persist your data if you don't set autocommit to True
+                conn.commit()
+            except DatabaseError as e:
+                conn.rollback()
+                if attempt < self.update_attempts and cm.backend.retryable(e):
+                    dose_updates.count("retries")
+                    continue
+                # print("Error occurred when updating vaccine availability")
+                raise
+            finally:
+                cm.close_connection()
+            if doses is None:
+                return None
+            dose_updates.count("updates")
+            vaccine_catalog.invalidate()
+            return doses
 
-        update_vaccine_availability = "UPDATE vaccines SET Doses = %d WHERE name = %s"
-        try:
-            cursor.execute(update_vaccine_availability, (self.available_doses, self.vaccine_name))
-            # you must call commit() to persist your data if you don't set autocommit to True
-            conn.commit()
-        except pymssql.Error:
-            # print("Error occurred when updating vaccine availability")
-            raise
-        finally:
-            cm.close_connection()
+    def __str__(self):
+        return f"(Vaccine Name: {self.vaccine_name}, Available Doses: {self.available_doses})"
 
-    # Decrement the available doses
-    def decrease_available_doses(self, num):
-        if self.available_doses - num < 0:
-            ValueError("Not enough available doses!")
-        self.available_doses -= num
 
+class DoseUpdates:
+    """
+    Counts dose updates: ones that changed a count, ones retried after losing a
+    race for locks, decreases the stock guard refused and increases of unknown
+    vaccines.
+    Reported through the instrumentation as scheduler_vaccine_doses_*_total.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"updates": 0, "retries": 0, "rejected": 0, "missing": 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class VaccineCatalog:
+    """
+    In-process, read-through cache of the whole Vaccines table for display
+    reads such as search_caregiver_schedule. Entries live for ttl seconds and
+    are dropped whenever this process changes a dose count. Bookings never
+    trust it: they re-check doses inside their own transaction.
+    """
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._vaccines = None  # [(name, doses)] ordered by name
+        self._expires = 0.0
+        self._generation = 0  # bumped by invalidate()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # all (name, doses) pairs, ordered by name
+    def get_all(self):
+        with self._lock:
+            if self._vaccines is not None and time.monotonic() < self._expires:
+                self.hits += 1
+                return self._vaccines
+            self.misses += 1
+            generation = self._generation
+        vaccines = self._load()
+        with self._lock:
+            # unless a change invalidated the cache meanwhile: what we read may predate it
+            if generation == self._generation:
+                self._vaccines = vaccines
+                self._expires = time.monotonic() + self.ttl
+        return vaccines
+
+    def invalidate(self):
+        with self._lock:
+            self._vaccines = None
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _load(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        update_vaccine_availability = "UPDATE vaccines SET Doses = %d WHERE name = %s"
+        get_vaccines = "SELECT Name, Doses FROM Vaccines ORDER BY Name"
         try:
-            cursor.execute(update_vaccine_availability, (self.available_doses, self.vaccine_name))
-            # you must call commit() to persist your data if you don't set autocommit to True
-            conn.commit()
-        except pymssql.Error:
-            # print("Error occurred when updating vaccine availability")
+            cursor.execute(get_vaccines)
+            return [(row[0], row[1]) for row in cursor.fetchall()]
+        except DatabaseError:
             raise
         finally:
             cm.close_connection()
 
-    def __str__(self):
-        return f"(Vaccine Name: {self.vaccine_name}, Available Doses: {self.available_doses})"
+
+# the process-wide catalog; VaccineCacheTTL=0 turns caching off
+vaccine_catalog = VaccineCatalog(ttl=float(os.getenv("VaccineCacheTTL", "5")))
+
+dose_updates = DoseUpdates()
+get_instrumentation().register("vaccine_doses", dose_updates.stats)
+get_instrumentation().register("vaccine_catalog", vaccine_catalog.stats)
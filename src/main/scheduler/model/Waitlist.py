@@ -0,0 +1,256 @@
+import sys
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager, DatabaseError
+from model.Appointment import Appointment
+from model.Vaccine import vaccine_catalog
+from model.DoseLedger import DoseLedger
+from model.Report import Report
+
+
+class Waitlist:
+    # waiting patients looked at per promotion transaction
+    promote_batch_size = 100
+
+    # Books the next batch of waiting patients, oldest first, in one
+    # transaction and one round trip: for each entry it takes a dose, claims
+    # the earliest free slot in the entry's date range and a dose from a lot
+    # still good that day ({claim_lot}), the same way reserve does, and
+    # removes the entry once it is booked. Entries that can't be served yet
+    # keep their place; the batch's bookings are added to the daily summaries
+    # in one go ({usage}). {where} picks the entries a change could help and
+    # {order} comes from Appointment.assignment_orders.
+    promote_mssql = """
+        SET NOCOUNT ON;
+        SET XACT_ABORT ON;
+        DECLARE @after int = %d, @batch int = %d;
+        DECLARE @entries TABLE (ID int PRIMARY KEY, p_name varchar(255), v_name varchar(255), FirstDay date, LastDay date);
+        DECLARE @claimed TABLE (Time date, Slot smallint, Username varchar(255));
+        DECLARE @lot TABLE (Lot varchar(64));
+        DECLARE @usage TABLE (Time date, v_name varchar(255), c_name varchar(255), Appointments int, OpenSlots int);
+        DECLARE @promoted TABLE (WaitlistID int, ID int, Time date, Slot smallint, p_name varchar(255), c_name varchar(255), v_name varchar(255));
+        DECLARE @id int, @patient varchar(255), @vaccine varchar(255), @first date, @last date, @time date;
+
+        BEGIN TRANSACTION;
+
+        INSERT INTO @entries
+            SELECT TOP (@batch) ID, p_name, v_name, FirstDay, LastDay FROM Waitlist WITH (UPDLOCK, ROWLOCK, READPAST)
+            WHERE ID > @after AND ({where})
+            ORDER BY ID;
+
+        SET @id = @after;
+        WHILE 1 = 1
+        BEGIN
+            SELECT TOP (1) @id = ID, @patient = p_name, @vaccine = v_name, @first = FirstDay, @last = LastDay
+                FROM @entries WHERE ID > @id ORDER BY ID;
+            IF @@ROWCOUNT = 0 BREAK;
+
+            UPDATE Vaccines SET Doses = Doses - 1 WHERE Name = @vaccine AND Doses > 0;
+            IF @@ROWCOUNT = 0 CONTINUE;
+
+            DELETE FROM @claimed;
+            WITH slot AS (
+                SELECT TOP (1) Time, Slot, Username FROM Availabilities a WITH (UPDLOCK, ROWLOCK, READPAST)
+                WHERE Time BETWEEN @first AND @last
+                ORDER BY Time, Slot, {order}
+            )
+            DELETE FROM slot OUTPUT deleted.Time, deleted.Slot, deleted.Username INTO @claimed;
+            IF NOT EXISTS (SELECT * FROM @claimed)
+            BEGIN
+                UPDATE Vaccines SET Doses = Doses + 1 WHERE Name = @vaccine;
+                CONTINUE;
+            END
+
+            SELECT @time = Time FROM @claimed;
+            DELETE FROM @lot;
+            {claim_lot}
+            IF NOT EXISTS (SELECT * FROM @lot)
+            BEGIN
+                INSERT INTO Availabilities (Time, Username, Slot) SELECT Time, Username, Slot FROM @claimed;
+                UPDATE Vaccines SET Doses = Doses + 1 WHERE Name = @vaccine;
+                CONTINUE;
+            END
+
+            INSERT INTO Appointments (Time, p_name, c_name, v_name, Slot, Lot)
+                OUTPUT @id, inserted.ID, inserted.Time, inserted.Slot, inserted.p_name, inserted.c_name, inserted.v_name INTO @promoted
+                SELECT Time, @patient, Username, @vaccine, Slot, (SELECT Lot FROM @lot) FROM @claimed;
+            INSERT INTO DoseLedger (v_name, Lot, Kind, Doses, AppointmentID)
+                SELECT @vaccine, l.Lot, 'reservation', -1, p.ID FROM @promoted p CROSS JOIN @lot l WHERE p.WaitlistID = @id;
+            INSERT INTO @usage SELECT Time, @vaccine, Username, 1, -1 FROM @claimed;
+            DELETE FROM Waitlist WHERE ID = @id;
+        END
+        {usage}
+
+        COMMIT TRANSACTION;
+        SELECT COUNT(*) AS Entries, MAX(ID) AS LastID FROM @entries;
+        SELECT ID, Time, Slot, p_name, c_name, v_name FROM @promoted ORDER BY WaitlistID;
+    """
+
+    claim_range_sqlite = """
+        DELETE FROM Availabilities
+        WHERE rowid = (SELECT rowid FROM Availabilities a WHERE Time BETWEEN %s AND %s ORDER BY Time, Slot, {order} LIMIT 1)
+        RETURNING Time, Slot, Username
+    """
+
+    def __init__(self, patient, vaccine, first=None, last=None, waitlist_id=None, position=None):
+        self.patient = patient
+        self.vaccine = vaccine
+        self.first = first
+        self.last = last
+        self.waitlist_id = waitlist_id
+        self.position = position
+
+    # getters
+    def get_waitlist_id(self):
+        return self.waitlist_id
+
+    def get_position(self):
+        return self.position
+
+    # Put the patient on the waitlist for the vaccine on any day from first to
+    # last, behind everyone already waiting; fills in the entry's id and its
+    # position among the patients waiting for the vaccine
+    def join(self):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor(as_dict=True)
+
+        try:
+            cursor.execute("SELECT Name FROM Vaccines WHERE Name = %s", self.vaccine)
+            if cursor.fetchone() is None:
+                raise ValueError("No such vaccine!")
+            cursor.execute("SELECT ID FROM Waitlist WHERE p_name = %s AND v_name = %s", (self.patient, self.vaccine))
+            if cursor.fetchone() is not None:
+                raise ValueError("Already on the waitlist for " + self.vaccine + "!")
+            if cm.backend.name == "sqlite":
+                cursor.execute("INSERT INTO Waitlist (p_name, v_name, FirstDay, LastDay) VALUES (%s, %s, %s, %s) RETURNING ID",
+                               (self.patient, self.vaccine, self.first, self.last))
+            else:
+                cursor.execute("INSERT INTO Waitlist (p_name, v_name, FirstDay, LastDay) OUTPUT inserted.ID VALUES (%s, %s, %s, %s)",
+                               (self.patient, self.vaccine, self.first, self.last))
+            self.waitlist_id = cursor.fetchone()['ID']
+            cursor.execute("SELECT COUNT(*) AS Position FROM Waitlist WHERE v_name = %s AND ID <= %d",
+                           (self.vaccine, self.waitlist_id))
+            self.position = cursor.fetchone()['Position']
+            # you must call commit() to persist your data if you don't set autocommit to True
+            conn.commit()
+        except DatabaseError:
+            # print("Error occurred when joining the waitlist")
+            raise
+        finally:
+            cm.close_connection()
+        return self
+
+    # Take the patient off the waitlist for the vaccine; returns whether they were on it
+    def leave(self):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("DELETE FROM Waitlist WHERE p_name = %s AND v_name = %s", (self.patient, self.vaccine))
+            left = cursor.rowcount > 0
+            conn.commit()
+        except DatabaseError:
+            # print("Error occurred when leaving the waitlist")
+            raise
+        finally:
+            cm.close_connection()
+        return left
+
+    # Hands freed capacity to waiting patients in the order they joined, one
+    # batch of promote_batch_size entries per transaction. Only entries for one
+    # of vaccines, or whose range overlaps [first, last], are considered (all
+    # entries without either). Returns the booked Appointments.
+    @staticmethod
+    def promote(vaccines=None, first=None, last=None, strategy=None):
+        orders = Appointment.assignment_orders.get(strategy or Appointment.default_strategy)
+        if orders is None:
+            raise ValueError("Unknown assignment strategy: " + str(strategy or Appointment.default_strategy))
+
+        conditions = []
+        params = ()
+        if vaccines:
+            conditions.append("v_name IN (" + ", ".join(["%s"] * len(vaccines)) + ")")
+            params += tuple(vaccines)
+        if first is not None:
+            conditions.append("(FirstDay <= %s AND LastDay >= %s)")
+            params += (last if last is not None else first, first)
+        where = " OR ".join(conditions) or "1 = 1"
+
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor(as_dict=True)
+
+        promoted = []
+        after = 0
+        try:
+            while True:
+                if cm.backend.name == "sqlite":
+                    entries, last_id, rows = Waitlist._promote_sqlite(cursor, orders["sqlite"], where, params, after)
+                else:
+                    entries, last_id, rows = Waitlist._promote_mssql(cursor, orders["mssql"], where, params, after)
+                conn.commit()
+                promoted.extend(rows)
+                if entries < Waitlist.promote_batch_size:
+                    break
+                after = last_id
+        except DatabaseError:
+            # print("Error occurred when promoting the waitlist")
+            raise
+        finally:
+            cm.close_connection()
+        if len(promoted) != 0:
+            vaccine_catalog.invalidate()
+        return [Appointment(row['Time'], row['p_name'], row['v_name'], caregiver=row['c_name'], appointment_id=row['ID'],
+                            slot=row['Slot'])
+                for row in promoted]
+
+    @staticmethod
+    def _promote_mssql(cursor, order, where, params, after):
+        cursor.execute(Waitlist.promote_mssql.format(where=where, order=order, claim_lot=DoseLedger.claim_lot_mssql,
+                                                      usage=Report.apply_usage_mssql),
+                       (after, Waitlist.promote_batch_size) + params)
+        batch = cursor.fetchone()
+        cursor.nextset()
+        return batch['Entries'], batch['LastID'], cursor.fetchall()
+
+    @staticmethod
+    def _promote_sqlite(cursor, order, where, params, after):
+        cursor.execute("SELECT ID, p_name, v_name, FirstDay, LastDay FROM Waitlist WHERE ID > %d AND (" + where + ")"
+                       " ORDER BY ID LIMIT %d", (after,) + params + (Waitlist.promote_batch_size,))
+        entries = cursor.fetchall()
+
+        # what this batch has already found used up, so later entries don't ask again
+        promoted = []
+        out_of_doses = set()
+        no_slots = []
+        for entry in entries:
+            if entry['v_name'] in out_of_doses:
+                continue
+            if any(first <= entry['FirstDay'] and entry['LastDay'] <= last for first, last in no_slots):
+                continue
+            cursor.execute("UPDATE Vaccines SET Doses = Doses - 1 WHERE Name = %s AND Doses > 0", entry['v_name'])
+            if cursor.rowcount == 0:
+                out_of_doses.add(entry['v_name'])
+                continue
+            cursor.execute(Waitlist.claim_range_sqlite.format(order=order), (entry['FirstDay'], entry['LastDay']))
+            claimed = cursor.fetchone()
+            if claimed is None:
+                cursor.execute("UPDATE Vaccines SET Doses = Doses + 1 WHERE Name = %s", entry['v_name'])
+                no_slots.append((entry['FirstDay'], entry['LastDay']))
+                continue
+            lot = DoseLedger.claim_sqlite(cursor, entry['v_name'], claimed['Time'])
+            if lot is None:
+                cursor.execute("INSERT INTO Availabilities (Time, Username, Slot) VALUES (%s, %s, %d)",
+                               (claimed['Time'], claimed['Username'], claimed['Slot']))
+                cursor.execute("UPDATE Vaccines SET Doses = Doses + 1 WHERE Name = %s", entry['v_name'])
+                continue
+            cursor.execute("INSERT INTO Appointments (Time, p_name, c_name, v_name, Slot, Lot) VALUES (%s, %s, %s, %s, %d, %s) RETURNING ID",
+                           (claimed['Time'], entry['p_name'], claimed['Username'], entry['v_name'], claimed['Slot'], lot))
+            appointment_id = cursor.fetchone()['ID']
+            DoseLedger.record(cursor, entry['v_name'], lot, "reservation", -1, appointment_id)
+            cursor.execute("DELETE FROM Waitlist WHERE ID = %d", entry['ID'])
+            promoted.append({'ID': appointment_id, 'Time': claimed['Time'], 'Slot': claimed['Slot'],
+                             'p_name': entry['p_name'], 'c_name': claimed['Username'], 'v_name': entry['v_name']})
+        Report.record_sqlite(cursor, [(row['Time'], row['v_name'], row['c_name'], 1, -1) for row in promoted])
+        return len(entries), entries[-1]['ID'] if entries else after, promoted
@@ -0,0 +1,426 @@
+import asyncio
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from model.Vaccine import Vaccine, vaccine_catalog
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Appointment import Appointment
+from model.Waitlist import Waitlist
+from model.DoseLedger import DoseLedger
+from model.Report import Report
+from util.Util import Util
+from util.HashService import get_hash_service
+from db.ConnectionManager import ConnectionManager, DatabaseError
+
+
+class Result:
+    """
+    Outcome of a service call: whether it succeeded, the message to show the
+    user, any structured data and, for failures, the underlying error.
+    promoted lists the appointments the call booked for waitlisted patients
+    by freeing up doses or slots.
+    """
+
+    def __init__(self, ok, message=None, data=None, error=None):
+        self.ok = ok
+        self.message = message
+        self.data = data
+        self.error = error
+        self.promoted = []
+
+    def __repr__(self):
+        return f"Result(ok={self.ok!r}, message={self.message!r})"
+
+
+class SchedulerService:
+    """
+    The scheduler's operations as coroutines returning Results.
+
+    Every call runs for a Session, which holds the login state and the
+    connection the call's database work runs on. Blocking database and hashing
+    work runs on a thread pool of `workers` threads (PoolMaxSize by default),
+    so one event loop can serve many clients at once; with workers=0 it runs
+    on the calling thread, which is what the single-user CLI wants.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = int(os.getenv("PoolMaxSize", "10"))
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    async def _run(self, fn, *args):
+        if self.executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _stream(self, fn, *args):
+        # async-iterates the blocking generator fn(*args), which runs on a worker
+        # thread and hands items over as soon as it produces them
+        if self.executor is None:
+            for item in fn(*args):
+                yield item
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def produce():
+            try:
+                for item in fn(*args):
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+        producer = loop.run_in_executor(self.executor, produce)
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+        await producer
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    # accounts; these hash passwords, so they don't hold the session's connection meanwhile
+
+    async def create_patient(self, session, username, password):
+        return await self._run(self._create_account, Patient, "Patient", username, password,
+                               "Username taken, try again", "Create patient failed", "Created user " + username)
+
+    async def create_caregiver(self, session, username, password):
+        return await self._run(self._create_account, Caregiver, "Caregivers", username, password,
+                               "Username taken, try again!", "Failed to create user.", "Created user  " + username)
+
+    async def login_patient(self, session, username, password):
+        if session.user is not None:
+            return Result(False, "User already logged in, try again")
+        return await self._login(session, Patient, username, password, "Login patient failed")
+
+    async def login_caregiver(self, session, username, password):
+        if session.user is not None:
+            return Result(False, "User already logged in.")
+        return await self._login(session, Caregiver, username, password, "Login failed.")
+
+    async def logout(self, session):
+        if session.user is None:
+            return Result(False, "Please login first")
+        session.logout()
+        return Result(True, "Successfully logged out")
+
+    # schedule
+
+    async def search_caregiver_schedule(self, session, first, last):
+        try:
+            days = [day async for day in self.stream_availability(session, first, last)]
+            vaccines = await self.vaccines(session)
+        except PermissionError as e:
+            return Result(False, str(e))
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        return Result(True, data={"days": days, "vaccines": vaccines})
+
+    # yields (date, [(slot, [caregiver usernames])]) for each day in [first, last] with a free
+    # caregiver, slots being minutes after midnight in order
+    def stream_availability(self, session, first, last):
+        if session.user is None:
+            raise PermissionError("Please login first!")
+        return self._stream(session.iterate, self._caregiver_availability, first, last)
+
+    # (name, doses) for every vaccine, from the display cache
+    async def vaccines(self, session):
+        return await self._run(session.call, vaccine_catalog.get_all)
+
+    # books the slot (minutes after midnight) if given, else the earliest free slot of day d
+    async def reserve(self, session, d, vaccine, strategy=None, slot=None):
+        if session.caregiver is not None:
+            return Result(False, "Please login as a patient!")
+        if session.patient is None:
+            return Result(False, "Please login first!")
+        return await self._run(session.call, self._reserve, session.patient, d, vaccine, strategy, slot)
+
+    # slots are the start times (minutes after midnight) to open on each date, by default Util.day_slots()
+    async def upload_availability(self, session, dates, slots=None):
+        if session.caregiver is None:
+            return Result(False, "Please login as a caregiver first!")
+        return await self._run(session.call, self._upload_availability, session.caregiver, dates, slots)
+
+    async def join_waitlist(self, session, first, last, vaccine):
+        if session.caregiver is not None:
+            return Result(False, "Please login as a patient!")
+        if session.patient is None:
+            return Result(False, "Please login first!")
+        return await self._run(session.call, self._join_waitlist, session.patient, first, last, vaccine)
+
+    async def leave_waitlist(self, session, vaccine):
+        if session.patient is None:
+            return Result(False, "Please login as a patient first!")
+        return await self._run(session.call, self._leave_waitlist, session.patient, vaccine)
+
+    async def cancel(self, session, appointment_id):
+        if session.user is None:
+            return Result(False, "Log in first!")
+        return await self._run(session.call, self._cancel, session.user, appointment_id)
+
+    async def cancel_day(self, session, d):
+        if session.caregiver is None:
+            return Result(False, "Please login as a caregiver first!")
+        # only ever the caller's own day: closing it also closes their slots
+        return await self._run(session.call, self._cancel_day, d, session.username)
+
+    async def add_doses(self, session, vaccine_name, doses, lot=None, expires=None):
+        if session.caregiver is None:
+            return Result(False, "Please login as a caregiver first!")
+        return await self._run(session.call, self._add_doses, vaccine_name, doses, lot, expires)
+
+    async def dose_history(self, session, vaccine_name, limit=20):
+        if session.caregiver is None:
+            return Result(False, "Please login as a caregiver first!")
+        return await self._run(session.call, self._dose_history, vaccine_name, limit)
+
+    async def report(self, session, first, last):
+        if session.caregiver is None:
+            return Result(False, "Please login as a caregiver first!")
+        return await self._run(session.call, self._report, first, last)
+
+    async def show_appointments(self, session, filters=None):
+        try:
+            rows = [row async for row in self.stream_appointments(session, filters or {})]
+        except PermissionError as e:
+            return Result(False, str(e))
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        return Result(True, data=rows)
+
+    # yields (id, vaccine, date, slot, other party) for the session user's appointments in ID order.
+    # filters may hold "after" (an ID), "limit", "from" and "to" (dates).
+    def stream_appointments(self, session, filters):
+        if session.user is None:
+            raise PermissionError("Please login first!")
+        return self._stream(session.iterate, self._appointment_rows, session.user, filters)
+
+    async def _login(self, session, model, username, password, failed):
+        result = await self._run(self._get_user, model, username, password, failed)
+        if result.ok:
+            session.login(result.data)
+        return result
+
+    # blocking implementations, run on the executor
+
+    def _create_account(self, model, table, username, password, taken, failed, created):
+        try:
+            if self._username_exists(table, username):
+                return Result(False, taken)
+        except DatabaseError as e:
+            return Result(False, "Error occurred when checking username", error=e)
+        problem = Util.check_password(password)
+        if problem is not None:
+            return Result(False, problem)
+
+        salt = Util.generate_salt()
+        hash = get_hash_service().generate_hash(password, salt)
+        try:
+            model(username, salt=salt, hash=hash).save_to_db()
+        except Exception as e:
+            return Result(False, failed, error=e)
+        return Result(True, created)
+
+    @staticmethod
+    def _username_exists(table, username):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        select_username = "SELECT Username FROM " + table + " WHERE Username = %s"
+        try:
+            cursor.execute(select_username, username)
+            return cursor.fetchone() is not None
+        finally:
+            cm.close_connection()
+
+    @staticmethod
+    def _get_user(model, username, password, failed):
+        try:
+            user = model(username, password=password).get()
+        except Exception as e:
+            return Result(False, failed, error=e)
+        if user is None:
+            return Result(False, failed)
+        return Result(True, "Logged in as: " + username, data=user)
+
+    @staticmethod
+    def _caregiver_availability(first, last):
+        # one range query in primary key order whose rows are grouped by day and slot as they stream in
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        find_caregivers_for_dates = "SELECT Time, Slot, Username FROM Availabilities WHERE Time BETWEEN %s AND %s ORDER BY Time, Slot, Username"
+        try:
+            cursor.execute(find_caregivers_for_dates, (first, last))
+            for d, day in itertools.groupby(cursor, key=lambda row: row[0]):
+                yield d, [(slot, [row[2] for row in rows]) for slot, rows in itertools.groupby(day, key=lambda row: row[1])]
+        finally:
+            cm.close_connection()
+
+    @staticmethod
+    def _reserve(user, d, vaccine, strategy, slot):
+        # claim a caregiver's slot, take a dose and book the appointment in one transaction
+        try:
+            appointment = Appointment(d, user.username, vaccine, slot=slot).reserve(strategy)
+        except ValueError as e:
+            return Result(False, str(e))
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        return Result(True, "Appointment ID " + str(appointment.appointment_id) + ", Caregiver username " + str(appointment.caregiver)
+                      + ", Time " + Util.format_time(appointment.slot), data=appointment)
+
+    @staticmethod
+    def _upload_availability(user, dates, slots):
+        try:
+            duplicates = user.upload_availabilities(dates, slots)
+        except DatabaseError as e:
+            return Result(False, "Upload Availability Failed", error=e)
+        except Exception as e:
+            return Result(False, "Error occurred when uploading availability", error=e)
+        result = Result(True, data={"uploaded": len(set(dates)) - len(duplicates), "duplicates": duplicates})
+        if result.data["uploaded"] != 0:
+            SchedulerService._promote(result, first=min(dates), last=max(dates))
+        return result
+
+    @staticmethod
+    def _join_waitlist(user, first, last, vaccine):
+        try:
+            entry = Waitlist(user.username, vaccine, first, last).join()
+        except ValueError as e:
+            return Result(False, str(e))
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        result = Result(True, "Joined the waitlist for " + vaccine + ", position " + str(entry.position), data=entry)
+        # capacity may already be free; everyone ahead in the queue still goes first
+        return SchedulerService._promote(result, vaccines=[vaccine])
+
+    @staticmethod
+    def _leave_waitlist(user, vaccine):
+        try:
+            left = Waitlist(user.username, vaccine).leave()
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        if not left:
+            return Result(False, "Not on the waitlist for " + vaccine + "!")
+        return Result(True, "Left the waitlist for " + vaccine + "!")
+
+    @staticmethod
+    def _cancel(user, appointment_id):
+        # delete the appointment, return the dose and re-open the slot in one transaction;
+        # users can only cancel their own appointments, so other IDs look like missing ones
+        if isinstance(user, Patient):
+            appointment = Appointment(None, user.username, None, appointment_id=appointment_id)
+        else:
+            appointment = Appointment(None, None, None, caregiver=user.username, appointment_id=appointment_id)
+        try:
+            appointment = appointment.cancel()
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        if appointment is None:
+            return Result(False, "Appointment not found!")
+        result = Result(True, "Availability canceled!", data=appointment)
+        return SchedulerService._promote(result, vaccines=[appointment.vaccine], first=appointment.time, last=appointment.time)
+
+    @staticmethod
+    def _cancel_day(d, caregiver):
+        try:
+            cancelled = Appointment.cancel_day(d, caregiver)
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        result = Result(True, data=cancelled)
+        # the day's slots are closed, but the returned doses may serve someone else
+        if len(cancelled) != 0:
+            SchedulerService._promote(result, vaccines=sorted({appointment.vaccine for appointment in cancelled}))
+        return result
+
+    @staticmethod
+    def _add_doses(vaccine_name, doses, lot, expires):
+        try:
+            # adds a new (vaccine, doses) entry if the vaccine is not in the database yet, else
+            # adds the new doses to the existing entry; one statement, so concurrent deliveries all count.
+            # The delivery goes into the lot's ledger in the same transaction.
+            Vaccine(vaccine_name, 0).add_doses(doses, lot, expires)
+        except Exception as e:
+            return Result(False, "Error occurred when adding doses", error=e)
+        return SchedulerService._promote(Result(True, "Doses updated!"), vaccines=[vaccine_name])
+
+    @staticmethod
+    def _dose_history(vaccine_name, limit):
+        try:
+            lots, entries = DoseLedger.history(vaccine_name, limit)
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        if len(lots) == 0:
+            return Result(False, "No such vaccine!")
+        return Result(True, data=(lots, entries))
+
+    @staticmethod
+    def _report(first, last):
+        try:
+            report = Report(first, last).load()
+        except DatabaseError as e:
+            return Result(False, "Please try again!", error=e)
+        return Result(True, data=report)
+
+    @staticmethod
+    def _promote(result, vaccines=None, first=None, last=None):
+        # books waitlisted patients into what a successful call freed up. The call
+        # itself has already committed, so a failure here only leaves the capacity
+        # free for the next promotion to hand out.
+        try:
+            result.promoted = Waitlist.promote(vaccines, first, last)
+        except DatabaseError:
+            result.promoted = []
+        return result
+
+    @staticmethod
+    def _appointment_rows(user, filters):
+        # patients see the caregiver of each appointment, caregivers the patient
+        if isinstance(user, Patient):
+            column, other = "p_name", "c_name"
+        else:
+            column, other = "c_name", "p_name"
+
+        # keyset pagination over the (name, ID) index; only the shown columns are read
+        show_appointments = "SELECT ID, v_name, Time, Slot, " + other + " FROM Appointments WHERE " + column + " = %s"
+        params = [user.username]
+        if "after" in filters:
+            show_appointments += " AND ID > %d"
+            params.append(filters["after"])
+        if "from" in filters:
+            show_appointments += " AND Time >= %s"
+            params.append(filters["from"])
+        if "to" in filters:
+            show_appointments += " AND Time <= %s"
+            params.append(filters["to"])
+        show_appointments += " ORDER BY ID"
+
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        if "limit" in filters:
+            show_appointments = cm.backend.limit(show_appointments, filters["limit"])
+        cursor = conn.cursor()
+        try:
+            cursor.execute(show_appointments, tuple(params))
+            while True:
+                rows = cursor.fetchmany(100)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            cm.close_connection()
@@ -0,0 +1,172 @@
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from db.ConnectionManager import ConnectionManager
+
+
+class Session:
+    """
+    One client of the scheduler: who is logged in, when and as what, and the
+    pooled connection its commands run on.
+
+    A session runs one command at a time. By default it takes a connection
+    from the pool for each command and hands it back afterwards, so idle
+    sessions hold none; with keep_connection=True (a CLI or batch run) it
+    keeps one connection until it is closed.
+    """
+
+    def __init__(self, keep_connection=False):
+        self.token = secrets.token_urlsafe(24)
+        self.keep_connection = keep_connection
+        self.user = None
+        self.logged_in_at = None
+        self.created = time.monotonic()
+        self.last_seen = self.created
+        self.conn = None
+        self.lock = threading.RLock()
+
+    @property
+    def patient(self):
+        return self.user if isinstance(self.user, Patient) else None
+
+    @property
+    def caregiver(self):
+        return self.user if isinstance(self.user, Caregiver) else None
+
+    @property
+    def username(self):
+        return None if self.user is None else self.user.username
+
+    @property
+    def role(self):
+        if self.patient is not None:
+            return "patient"
+        if self.caregiver is not None:
+            return "caregiver"
+        return None
+
+    def login(self, user):
+        self.user = user
+        self.logged_in_at = time.time()
+
+    def logout(self):
+        self.user = None
+        self.logged_in_at = None
+
+    @contextmanager
+    def active(self):
+        # serializes the session's commands and pins its connection to this thread
+        with self.lock:
+            self.last_seen = time.monotonic()
+            pool = ConnectionManager.get_pool()
+            if self.conn is None:
+                self.conn = pool.acquire()
+            try:
+                with ConnectionManager.pinned(self.conn):
+                    yield self
+            finally:
+                if self.keep_connection:
+                    # don't carry a failed command's open transaction into the next one
+                    self.conn.rollback()
+                else:
+                    conn, self.conn = self.conn, None
+                    pool.release(conn)
+
+    # runs fn(*args) as one of this session's commands
+    def call(self, fn, *args):
+        with self.active():
+            return fn(*args)
+
+    # iterates the generator fn(*args) as one of this session's commands
+    def iterate(self, fn, *args):
+        with self.active():
+            yield from fn(*args)
+
+    def close(self):
+        with self.lock:
+            self.logout()
+            if self.conn is not None:
+                conn, self.conn = self.conn, None
+                ConnectionManager.get_pool().release(conn)
+
+
+class SessionRegistry:
+    """
+    The live sessions of a process by token. A session expires once it has
+    been idle for ttl seconds; expired sessions are closed and forgotten the
+    next time they are looked up or swept.
+    """
+
+    def __init__(self, ttl=1800.0):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+
+    def create(self, keep_connection=False):
+        session = Session(keep_connection=keep_connection)
+        with self._lock:
+            self._sessions[session.token] = session
+            self.created += 1
+        return session
+
+    # Returns the live session for token, or None if it is unknown or has expired
+    def get(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if time.monotonic() - session.last_seen <= self.ttl:
+                session.last_seen = time.monotonic()
+                return session
+            del self._sessions[token]
+            self.expired += 1
+        session.close()
+        return None
+
+    def remove(self, token):
+        with self._lock:
+            session = self._sessions.pop(token, None)
+        if session is not None:
+            session.close()
+
+    # Closes every expired session and returns how many there were
+    def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [token for token, session in self._sessions.items() if now - session.last_seen > self.ttl]
+            sessions = [self._sessions.pop(token) for token in expired]
+            self.expired += len(sessions)
+        for session in sessions:
+            session.close()
+        return len(sessions)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+# Returns the process-wide SessionRegistry; sessions expire after SessionTTL idle seconds
+def get_session_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = SessionRegistry(ttl=float(os.getenv("SessionTTL", "1800")))
+    return _registry
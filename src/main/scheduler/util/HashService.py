@@ -0,0 +1,117 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from util.Util import Util
+
+
+class HashService:
+    """
+    Runs Util.generate_hash on a pool of worker processes so a burst of logins
+    or account creations uses every core instead of queueing on one.
+
+    With cache_size > 0 it also remembers successful verifications for
+    cache_ttl seconds, keyed by (username, salt, sha256 of the password) and
+    tied to the stored hash, so re-authenticating the same session does not
+    re-derive the key. Failed verifications are never cached.
+    """
+
+    def __init__(self, workers=None, cache_size=0, cache_ttl=60.0):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._cache = OrderedDict()  # key -> (stored hash, expiry)
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def generate_hash(self, password, salt):
+        if self.workers == 0:
+            return Util.generate_hash(password, salt)
+        return self._get_executor().submit(Util.generate_hash, password, salt).result()
+
+    # Hashes many (password, salt) pairs, spread over the worker processes
+    def generate_hashes(self, pairs):
+        pairs = list(pairs)
+        if self.workers == 0:
+            return [Util.generate_hash(password, salt) for password, salt in pairs]
+        passwords = [password for password, _ in pairs]
+        salts = [salt for _, salt in pairs]
+        chunksize = max(1, len(pairs) // (self.workers * 4))
+        return list(self._get_executor().map(Util.generate_hash, passwords, salts, chunksize=chunksize))
+
+    # Checks password against the salt and hash stored for username
+    def verify(self, username, password, salt, stored_hash):
+        key = None
+        if self.cache_size > 0:
+            key = (username, bytes(salt), hashlib.sha256(password.encode('utf-8')).digest())
+            if self._cache_lookup(key, stored_hash):
+                return True
+
+        calculated_hash = self.generate_hash(password, salt)
+        if not hmac.compare_digest(bytes(calculated_hash), bytes(stored_hash)):
+            return False
+        if key is not None:
+            self._cache_store(key, stored_hash)
+        return True
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _cache_lookup(self, key, stored_hash):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] > time.monotonic() and entry[0] == bytes(stored_hash):
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return True
+            if entry is not None:
+                del self._cache[key]
+            self.cache_misses += 1
+            return False
+
+    def _cache_store(self, key, stored_hash):
+        with self._cache_lock:
+            self._cache[key] = (bytes(stored_hash), time.monotonic() + self.cache_ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+# Returns the process-wide HashService, configured by HashWorkers (0 hashes on
+# the calling thread), HashCacheSize (0 disables the cache) and HashCacheTTL
+def get_hash_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                workers = os.getenv("HashWorkers")
+                _service = HashService(
+                    workers=None if workers is None else int(workers),
+                    cache_size=int(os.getenv("HashCacheSize", "0")),
+                    cache_ttl=float(os.getenv("HashCacheTTL", "60")),
+                )
+    return _service
@@ -1,5 +1,10 @@
+import datetime
 import hashlib
 import os
+import re
+
+
+WEEKDAYS = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
 
 
 class Util:
@@ -15,3 +20,75 @@ class Util:
             dklen=16
         )
         return key
+
+    # parses a mm-dd-yyyy date, raising ValueError if it is malformed or does not exist
+    def parse_date(date):
+        tokens = date.split("-")
+        if [len(token) for token in tokens] != [2, 2, 4] or not all(token.isdigit() for token in tokens):
+            raise ValueError("Please enter a valid date!")
+        month, day, year = (int(token) for token in tokens)
+        try:
+            return datetime.date(year, month, day)
+        except ValueError:
+            raise ValueError("Please enter a valid date!")
+
+    # returns the dates from first to last inclusive, only on the given weekdays (e.g. "mon,wed,fri") if any
+    def date_range(first, last, weekdays=None):
+        if last < first:
+            raise ValueError("Please enter a valid date range!")
+        days = set(WEEKDAYS.values())
+        if weekdays is not None:
+            names = weekdays.lower().split(",")
+            if not all(name in WEEKDAYS for name in names):
+                raise ValueError("Please enter weekdays as e.g. mon,wed,fri!")
+            days = {WEEKDAYS[name] for name in names}
+        dates = []
+        d = first
+        while d <= last:
+            if d.weekday() in days:
+                dates.append(d)
+            d += datetime.timedelta(days=1)
+        return dates
+
+    # parses a hh:mm time of day into minutes after midnight, raising ValueError if it is malformed
+    def parse_time(time):
+        hours, separator, minutes = time.partition(":")
+        if not separator or not hours.isdigit() or len(minutes) != 2 or not minutes.isdigit() \
+                or int(hours) > 23 or int(minutes) > 59:
+            raise ValueError("Please enter a valid time!")
+        return int(hours) * 60 + int(minutes)
+
+    # formats minutes after midnight as hh:mm
+    def format_time(minutes):
+        return "%02d:%02d" % divmod(minutes, 60)
+
+    # returns the start (in minutes after midnight) of each slot of length minutes in hours ("09:00-17:00");
+    # they default to AvailabilityHours and SlotMinutes, and without a length the whole window is one slot
+    def day_slots(hours=None, length=None):
+        if hours is None:
+            hours = os.getenv("AvailabilityHours", "09:00-17:00")
+        if length is None:
+            length = int(os.getenv("SlotMinutes", "0"))
+        first, separator, last = hours.partition("-")
+        if not separator:
+            raise ValueError("Please enter hours as e.g. 09:00-17:00!")
+        start, end = Util.parse_time(first), Util.parse_time(last)
+        if end <= start:
+            raise ValueError("Please enter hours as e.g. 09:00-17:00!")
+        if length <= 0:
+            return [start]
+        return list(range(start, end - length + 1, length)) or [start]
+
+    # returns why password is too weak, or None if it is strong enough
+    def check_password(password):
+        if len(password) < 8:
+            return "Please enter a password of at least 8 characters"
+        if not re.search(r'[A-Z]', password):
+            return "Password must contain at least one uppercase letter!"
+        if not re.search(r'[a-z]', password):
+            return "Password must contain at least one lowercase letter!"
+        if not re.search(r'[0-9]', password):
+            return "Please enter a password of at least one number!"
+        if not re.search(r'[!@#?]', password):
+            return "Please enter a password of at least one special character!"
+        return None
@@ -0,0 +1,87 @@
+"""
+Regression test for the command loop: a long session must run in constant
+stack depth and memory now that handlers return to start() instead of
+calling it again.
+
+    python -m pytest tests/test_repl.py
+
+Runs against a throwaway SQLite database; no SQL Server is needed.
+"""
+import os
+import sys
+import tempfile
+import tracemalloc
+
+os.environ["DBBackend"] = "sqlite"
+os.environ["SQLiteDatabase"] = os.path.join(tempfile.mkdtemp(), "repl.db")
+os.environ["HashWorkers"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "main", "scheduler"))
+
+import Scheduler  # noqa: E402
+
+COMMANDS = 100000
+
+# after this many commands the loop has warmed up (connections, caches, plans)
+WARM_UP = 10000
+
+
+class Script:
+    """
+    Stands in for stdin: hands start() one line per readline(), generated on
+    the fly, and samples traced memory once warmed up and at the end.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+        self.memory = []
+
+    def readline(self):
+        if self.read in (WARM_UP, len(self.lines)):
+            self.memory.append(tracemalloc.get_traced_memory()[0])
+        if self.read == len(self.lines):
+            return ""
+        line = self.lines[self.read]
+        self.read += 1
+        return line + "\n"
+
+
+def stack_depth():
+    frame = sys._getframe()
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def test_long_session_runs_in_constant_stack_and_memory(monkeypatch):
+    setup = ["create_caregiver repl_c Passw0rd!x", "login_caregiver repl_c Passw0rd!x", "add_doses repl_v 1"]
+    loop = ["add_doses repl_v 1", "show_appointments", "", "no_such_command"]
+    lines = setup + [loop[n % len(loop)] for n in range(COMMANDS - len(setup))]
+
+    depths = set()
+    add_doses = Scheduler.COMMANDS["add_doses"]
+
+    def measured(session, tokens):
+        depths.add(stack_depth())
+        return add_doses(session, tokens)
+
+    monkeypatch.setitem(Scheduler.COMMANDS, "add_doses", measured)
+    script = Script(lines)
+    monkeypatch.setattr(sys, "stdin", script)
+
+    with open(os.devnull, "w") as devnull:
+        monkeypatch.setattr(sys, "stdout", devnull)
+        tracemalloc.start()
+        try:
+            Scheduler.start()
+        finally:
+            tracemalloc.stop()
+        monkeypatch.undo()
+
+    assert script.read == COMMANDS
+    # every command is dispatched from the same frame of the loop
+    assert len(depths) == 1
+    warmed_up, finished = script.memory
+    assert finished - warmed_up < 1 << 20